@@ -2,26 +2,47 @@ from __future__ import annotations
 
 import logging, sys
 log = logging.getLogger("uvicorn.error")  
-import csv
+import asyncio
 import html
 import json
 import os
 import re
+import socket
 import textwrap
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, Token
 from datetime import datetime
 from pathlib import Path
-from typing import List, Tuple, Optional
+from collections import Counter, deque
+from itertools import islice
+from typing import Callable, Iterator, List, Literal, Tuple, Optional
 
-from anthropic import Anthropic
+from anthropic import Anthropic, APIConnectionError, APIStatusError, AsyncAnthropic
+from openai import AsyncOpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential_jitter
 
+import http_clients
+from dedup import plan_dedup
+from downloads import compressed_copies, file_response
+from http_clients import HttpClients
+from jobs import Job, JobRegistry
+from journal import JobJournal
+from metrics import Registry, process_rss_bytes
+from key_pool import ApiKey, KeyPool
+from providers import (OPENAI_MODEL, OpenAIProvider, Provider, ProviderRouter, estimate_tokens,
+                       parse_provider_weights, providers_stats)
+from rate_limit import retry_after_seconds
+from response_cache import ResponseCache
+from sse import SSEBroker
+from tracing import instant, load_chrome_trace, set_lane, span, start_trace, stop_trace
+from writers import MEDIA_TYPES, JsonlRowWriter, make_writer, read_rows
+
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse, FileResponse
-from threading import Thread
-from queue import Queue
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 import uuid
-from fastapi import Query
+from fastapi import Header, Query
 
 # логи
 import logging
@@ -40,10 +61,38 @@ def _enable_timestamps_in_uvicorn_logs():
             lg.addHandler(h)
         lg.propagate = False
 
+# Трансляция логов клиенту стрима: один обработчик на общем логгере отдаёт запись функции
+# из contextvar. Её видят только задачи своего запуска (asyncio копирует контекст в задачи
+# и asyncio.to_thread), поэтому параллельные стримы не получают чужие строки. Без
+# подписчика запись не форматируется.
+_log_sink: ContextVar[Optional[Callable[[str], None]]] = ContextVar("log_sink", default=None)
+
+class _ContextLogHandler(logging.Handler):
+    def emit(self, record: logging.LogRecord) -> None:
+        sink = _log_sink.get()
+        if sink is None:
+            return
+        try:
+            ts = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S")
+            sink(f"{ts} {record.levelname}:     {record.getMessage()}")
+        except Exception:
+            pass
+
+_CONTEXT_LOG_HANDLER = _ContextLogHandler()
+
+def _route_logs_to(emit: Callable[[str], None]) -> Token:
+    # Обработчик вешаем при первом стриме: uvicorn при настройке логирования снимает
+    # чужие обработчики, а _enable_timestamps_in_uvicorn_logs смотрит, есть ли они вообще
+    if _CONTEXT_LOG_HANDLER not in log.handlers:
+        log.addHandler(_CONTEXT_LOG_HANDLER)
+    return _log_sink.set(emit)
+
 # ─────────────────────────────── НАСТРОЙКИ ПУТЕЙ ───────────────────────────────
 # ВСЕ файлы читаем/пишем в хостовую папку (монтируемую как /work).
 BASE_DIR = Path(os.getenv("HOST_WORKDIR", "/work"))
 BASE_DIR.mkdir(parents=True, exist_ok=True)
+# Журналы и файлы заданий
+JOBS_DIR = BASE_DIR / "jobs"
 
 # ─────────────────────────────── ПРОМПТЫ ───────────────────
 SYSTEM_PROMPT_TZ = (
@@ -174,39 +223,187 @@ ARTICLE_USER_PROMPT_TEMPLATE = textwrap.dedent(
     """
 ).strip()
 
-# Модель и параметры Claude
+# Модель и параметры Claude; модели этапов можно задать отдельно (например, ТЗ — на более дешёвой)
 MODEL_NAME = "claude-sonnet-4-20250514"
+MODEL_NAME_TZ = os.getenv("CLAUDE_MODEL_TZ", MODEL_NAME)
+MODEL_NAME_ARTICLE = os.getenv("CLAUDE_MODEL_ARTICLE", MODEL_NAME)
+# Цены за 1M токенов (in/out), USD
+MODEL_PRICES = {
+    "claude-sonnet-4-20250514": (3.0, 15.0),
+    "claude-sonnet-4-5-20250929": (3.0, 15.0),
+    "claude-opus-4-1-20250805": (15.0, 75.0),
+    "claude-haiku-4-5-20251001": (1.0, 5.0),
+    "claude-3-5-haiku-20241022": (0.8, 4.0),
+}
 MAX_TOKENS_TZ = 3500
 MAX_TOKENS_ARTICLE = 10000
 TEMPERATURE = 1.0
 
+# Message Batches: интервал опроса статуса, лимит запросов в одном батче, скидка
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+BATCH_MAX_REQUESTS = 10_000
+BATCH_DISCOUNT = 0.5
+
+# Загрузка файлов: размер куска при записи на диск
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Кэш ответов LLM на диске (BASE_DIR/cache), лимит в мегабайтах
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", "1024"))
+
+# Лимиты аккаунта Anthropic в минуту до первого ответа API (дальше — по заголовкам anthropic-ratelimit-*);
+# пусто — до первого ответа не ограничиваем. При пуле ключей — на каждый ключ (в auth.json можно
+# задать свои). Попыток на один запрос (429 ждёт retry-after)
+ANTHROPIC_RPM = int(os.getenv("ANTHROPIC_RPM", "0")) or None
+ANTHROPIC_INPUT_TPM = int(os.getenv("ANTHROPIC_INPUT_TPM", "0")) or None
+ANTHROPIC_OUTPUT_TPM = int(os.getenv("ANTHROPIC_OUTPUT_TPM", "0")) or None
+CLAUDE_MAX_ATTEMPTS = int(os.getenv("CLAUDE_MAX_ATTEMPTS", "6"))
+# На сколько секунд ключ из пула выводится из ротации после 401/403
+ANTHROPIC_KEY_COOLDOWN = float(os.getenv("ANTHROPIC_KEY_COOLDOWN", "300"))
+
+# Провайдеры LLM и их веса: каждый вызов ТЗ/статьи уходит провайдеру по весам, а при 429/5xx/529
+# следующая попытка — другому (вес 0 — только запасной), например "anthropic:3,openai:1".
+# Модели OpenAI по этапам; наибольшая пауза провайдера после ошибок 5xx/529 подряд (секунды)
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "anthropic")
+OPENAI_MODEL_TZ = os.getenv("OPENAI_MODEL_TZ", OPENAI_MODEL)
+OPENAI_MODEL_ARTICLE = os.getenv("OPENAI_MODEL_ARTICLE", OPENAI_MODEL)
+LLM_PROVIDER_BACKOFF_MAX = float(os.getenv("LLM_PROVIDER_BACKOFF_MAX", "30"))
+
+# Общий пул HTTP-соединений к API на процесс сервера: лимит соединений, сколько держать
+# открытыми без запросов и сколько секунд, HTTP/2 (нужен pip install h2, без него — HTTP/1.1).
+# HTTP_WARMUP — сколько соединений к каждому провайдеру открыть при старте (0 — не прогревать)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2 = os.getenv("HTTP2", "1") == "1"
+HTTP_WARMUP = int(os.getenv("HTTP_WARMUP", "0"))
+
+# Трассировка заданий (JOBS_DIR/<job_id>/trace.jsonl) по умолчанию; можно включить на отдельный запуск
+TRACE_JOBS = os.getenv("TRACE_JOBS", "0") == "1"
+
+# Дедупликация групп перед генерацией (по умолчанию выключена, включается и на отдельный запуск):
+# точные дубли главного запроса генерируются один раз, группы с пересечением ключей по Jaccard
+# не ниже порога только отмечаются в отчёте (0 — только точные дубли); DEDUP_COLLAPSE_NEAR=1 —
+# схлопывать и похожие
+DEDUP_GROUPS = os.getenv("DEDUP_GROUPS", "0") == "1"
+DEDUP_JACCARD = float(os.getenv("DEDUP_JACCARD", "0.9"))
+DEDUP_COLLAPSE_NEAR = os.getenv("DEDUP_COLLAPSE_NEAR", "0") == "1"
+
+# Сколько групп обрабатывается одновременно (по умолчанию для сервера): статей, ТЗ и сколько
+# готовых ТЗ может ждать свободного слота статьи
+DEFAULT_CONCURRENCY = int(os.getenv("ARTICLES_CONCURRENCY", "4"))
+DEFAULT_TZ_CONCURRENCY = int(os.getenv("ARTICLES_TZ_CONCURRENCY", str(DEFAULT_CONCURRENCY)))
+PIPELINE_BUFFER = int(os.getenv("ARTICLES_PIPELINE_BUFFER", str(DEFAULT_CONCURRENCY * 2)))
+# Очередь заданий /jobs (SQLite): групп в работе на один воркер, воркеров внутри API-процесса,
+# аренда группы (продлевается, пока воркер жив), попыток на группу, пауза при пустой очереди
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(DEFAULT_CONCURRENCY)))
+EMBEDDED_WORKERS = int(os.getenv("EMBEDDED_WORKERS", "1"))
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "300"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "5"))
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "2"))
+# Пауза перед повтором группы после ошибки: QUEUE_RETRY_BACKOFF, 2×, 4×… секунд, не больше
+# QUEUE_RETRY_BACKOFF_MAX — короткий сбой провайдеров не сжигает все попытки за секунды
+QUEUE_RETRY_BACKOFF = float(os.getenv("QUEUE_RETRY_BACKOFF", "15"))
+QUEUE_RETRY_BACKOFF_MAX = float(os.getenv("QUEUE_RETRY_BACKOFF_MAX", "600"))
+# Как быстро воркер замечает отмену задания /jobs и прерывает группы в работе (секунды)
+QUEUE_CANCEL_CHECK_SECONDS = float(os.getenv("QUEUE_CANCEL_CHECK_SECONDS", "2"))
+# Как часто API проверяет опоздание event loop (секунды, 0 — не проверять)
+EVENT_LOOP_MONITOR_INTERVAL = float(os.getenv("EVENT_LOOP_MONITOR_INTERVAL", "0.25"))
+# SSE-стримы: событий в буфере задания для переподключения, сколько хранить поток после
+# завершения (секунды), пауза между ping при отсутствии событий (секунды)
+SSE_BUFFER_EVENTS = int(os.getenv("SSE_BUFFER_EVENTS", "10000"))
+SSE_RETAIN_SECONDS = float(os.getenv("SSE_RETAIN_SECONDS", "600"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# Сколько секунд стрим может идти без подключённых клиентов, прежде чем генерация будет
+# отменена (время на переподключение); 0 — не отменять
+SSE_ABANDON_SECONDS = float(os.getenv("SSE_ABANDON_SECONDS", "60"))
+# Как часто GET /jobs/{job_id}/rows?follow=true проверяет журнал на новые строки (секунды)
+ROWS_POLL_SECONDS = float(os.getenv("ROWS_POLL_SECONDS", "1"))
+# Через сколько секунд после отдачи /download_once удаляет файл: в это время прерванную
+# загрузку можно докачать (Range), каждое обращение продлевает срок; 0 — удалять сразу
+DOWNLOAD_ONCE_GRACE_SECONDS = float(os.getenv("DOWNLOAD_ONCE_GRACE_SECONDS", "300"))
+
 # ─────────────────────────────── УТИЛИТЫ ───────────
-def load_anthropic_key() -> str:
+def load_anthropic_keys() -> list[dict]:
+    # Пул ключей: ANTHROPIC_API_KEYS (через запятую) или ANTHROPIC_API_KEY в окружении, иначе
+    # auth.json: "ANTHROPIC_API_KEYS": ["sk-...", {"key": "sk-...", "name": "...", "rpm": 50}, ...]
+    # или "ANTHROPIC_API_KEY": "sk-..."
+    if (keys := os.environ.get("ANTHROPIC_API_KEYS")):
+        return [{"key": k.strip()} for k in keys.split(",") if k.strip()]
     if (key := os.environ.get("ANTHROPIC_API_KEY")):
-        return key
+        return [{"key": key}]
     auth_file = BASE_DIR / "auth.json"
     if auth_file.exists():
         with auth_file.open(encoding="utf-8") as f:
             data = json.load(f)
+            if data.get("ANTHROPIC_API_KEYS"):
+                return [k if isinstance(k, dict) else {"key": k} for k in data["ANTHROPIC_API_KEYS"]]
             if "ANTHROPIC_API_KEY" in data:
-                return data["ANTHROPIC_API_KEY"]
+                return [{"key": data["ANTHROPIC_API_KEY"]}]
     raise RuntimeError("ANTHROPIC_API_KEY не найден ни в окружении, ни в auth.json")
 
-def anthropic_cost_usd(input_tokens: int, output_tokens: int) -> float:
-    # Sonnet 4: $3 / $15 за 1M токенов (in/out)
-    cin = 3.0 / 1_000_000
-    cout = 15.0 / 1_000_000
-    return input_tokens * cin + output_tokens * cout
+def load_anthropic_key() -> str:
+    return load_anthropic_keys()[0]["key"]
+
+def load_openai_key() -> str:
+    if (key := os.environ.get("OPENAI_API_KEY")):
+        return key
+    auth_file = BASE_DIR / "auth.json"
+    if auth_file.exists():
+        with auth_file.open(encoding="utf-8") as f:
+            data = json.load(f)
+            if "OPENAI_API_KEY" in data:
+                return data["OPENAI_API_KEY"]
+    raise RuntimeError("OPENAI_API_KEY не найден ни в окружении, ни в auth.json")
+
+def load_vector_store_id(required: bool = True) -> Optional[str]:
+    # vector store с примерами статей для OpenAI (file_search): OPENAI_VECTOR_STORE_ID или state.json
+    if (vs := os.environ.get("OPENAI_VECTOR_STORE_ID")):
+        return vs
+    state_file = BASE_DIR / "state.json"
+    if not state_file.exists():
+        if required:
+            raise RuntimeError("Файл state.json не найден в рабочей папке. В нём должен быть vector_store_id.")
+        return None
+    with state_file.open(encoding="utf-8") as f:
+        state = json.load(f)
+    if "vector_store_id" not in state and required:
+        raise RuntimeError("В state.json отсутствует ключ vector_store_id.")
+    return state.get("vector_store_id")
+
+def anthropic_cost_usd(input_tokens: int, output_tokens: int, cache_write_tokens: int = 0,
+                       cache_read_tokens: int = 0, batch: bool = False, model: str = MODEL_NAME) -> float:
+    # Неизвестная модель — по ценам Sonnet 4 ($3 / $15 за 1M токенов)
+    price_in, price_out = MODEL_PRICES.get(model, MODEL_PRICES[MODEL_NAME])
+    cin = price_in / 1_000_000
+    cout = price_out / 1_000_000
+    # Prompt caching: запись в кэш ×1.25 от входа, чтение ×0.1
+    cost = (input_tokens * cin + output_tokens * cout
+            + cache_write_tokens * cin * 1.25 + cache_read_tokens * cin * 0.1)
+    # Message Batches API — скидка 50% на вход и выход
+    return cost * BATCH_DISCOUNT if batch else cost
 
 def slugify(text_: str) -> str:
     text_ = re.sub(r"<[^>]+>", "", text_)
     text_ = re.sub(r"[^\w\s-]", "", text_, flags=re.U).strip().lower()
     return re.sub(r"[\s_-]+", "-", text_)
 
-def parse_groups(csv_path: Path) -> list[str]:
+def iter_groups(csv_path: Path, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+    # Лениво читает группы [start, end) — файл целиком в память не попадает,
+    # а чтение останавливается сразу после end
     with csv_path.open(encoding="utf-8", errors="ignore") as f:
-        lines = [line.strip() for line in f if line.strip()]
-    return lines[1:] 
+        lines = (line.strip() for line in f)
+        groups = islice((line for line in lines if line), 1, None)  # без заголовка
+        yield from islice(groups, start, end)
+
+def count_groups(csv_path: Path, start: int = 0, end: Optional[int] = None) -> int:
+    with span("count_groups") as sp:
+        n = sum(1 for _ in iter_groups(csv_path, start, end))
+        sp.set(groups=n)
+    return n
+
+def parse_groups(csv_path: Path) -> list[str]:
+    with span("parse_groups"):
+        return list(iter_groups(csv_path))
 
 def extract_keywords(block: str) -> List[Tuple[str, int]]:
     pairs: List[Tuple[str, int]] = []
@@ -219,20 +416,85 @@ def extract_keywords(block: str) -> List[Tuple[str, int]]:
     return pairs
 
 # ─────────────────────────────── КЛИЕНТ CLAUDE ─────────────────────────
+RESPONSE_CACHE = ResponseCache(BASE_DIR / "cache", max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+_key_pool: Optional[KeyPool] = None
+
+def get_key_pool() -> KeyPool:
+    # Ключи читаются при первом запросе к API (импорт app не требует ключа)
+    global _key_pool
+    if _key_pool is None:
+        _key_pool = KeyPool(load_anthropic_keys(), ANTHROPIC_RPM, ANTHROPIC_INPUT_TPM, ANTHROPIC_OUTPUT_TPM,
+                            revoked_cooldown=ANTHROPIC_KEY_COOLDOWN)
+        log.info("🔑 Ключей Anthropic в пуле: %d", len(_key_pool.keys))
+    return _key_pool
+
+# ─────────────────────────────── МЕТРИКИ ───────────────────────────────
+# GET /metrics; у процессов worker.py свои счётчики, очередь и задания — общие (из БД)
+METRICS = Registry()
+STAGE_SECONDS = METRICS.histogram(
+    "articles_stage_seconds", "Длительность этапа обработки группы (tz, article, postprocess, csv_write)", ("stage",))
+LLM_TOKENS = METRICS.counter(
+    "articles_llm_tokens_total", "Токены LLM по этапам (input, output, cache_write, cache_read)", ("stage", "kind"))
+LLM_OUTPUT_TPS = METRICS.histogram(
+    "articles_llm_output_tokens_per_second", "Скорость генерации одного ответа, выходных токенов в секунду", ("stage",),
+    buckets=(5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200, 300))
+LLM_RETRIES = METRICS.counter("articles_llm_retries_total", "Повторы запросов к LLM по провайдеру и причине",
+                              ("provider", "reason"))
+LLM_RATE_LIMITED = METRICS.counter("articles_llm_rate_limited_total", "Ответы 429 от Claude")
+COST_USD = METRICS.counter("articles_cost_usd_total", "Стоимость запросов к LLM, USD", ("stage",))
+GROUPS_PROCESSED = METRICS.counter("articles_groups_total", "Группы по результату (done, duplicate, skipped, failed, cancelled)", ("result",))
+ACTIVE_RUNS = METRICS.gauge("articles_active_runs", "Генерации без очереди, идущие в этом процессе")
+# job_id генераций без очереди, идущих в этом процессе (для GET /jobs/{job_id}/rows?follow=true)
+_RUNNING_JOBS: set[str] = set()
+METRICS.gauge("articles_jobs", "Задания очереди /jobs по статусам", ("status",),
+              fn=lambda: {(status,): n for status, n in JOBS.counts().items()})
+METRICS.gauge("articles_queue_depth", "Группы очереди, ожидающие обработки или в работе", fn=lambda: JOBS.depth())
+METRICS.gauge("articles_rate_limiter_throttled_seconds", "Суммарное ожидание запросов в ограничителе, секунд",
+              fn=lambda: _key_pool.throttled_seconds if _key_pool else 0.0)
+METRICS.gauge("articles_api_key_cost_usd", "Стоимость запросов к Claude по ключам пула, USD", ("key",),
+              fn=lambda: {(k.name,): k.cost_usd for k in _key_pool.keys} if _key_pool else {})
+METRICS.gauge("articles_api_key_requests", "Запросы к Claude по ключам пула", ("key",),
+              fn=lambda: {(k.name,): k.requests for k in _key_pool.keys} if _key_pool else {})
+METRICS.gauge("articles_api_key_active", "1 — ключ в ротации, 0 — выведен после 401/403", ("key",),
+              fn=lambda: {(k.name,): int(k.disabled_until <= time.monotonic()) for k in _key_pool.keys}
+              if _key_pool else {})
+METRICS.gauge("articles_provider_cost_usd", "Стоимость запросов по провайдерам LLM, USD", ("provider",),
+              fn=lambda: {(name,): p["cost_usd"] for name, p in providers_stats().items()})
+METRICS.gauge("articles_provider_requests", "Запросы к провайдерам LLM (с повторами)", ("provider",),
+              fn=lambda: {(name,): p["requests"] for name, p in providers_stats().items()})
+METRICS.gauge("articles_provider_spillover", "Вызовы, ушедшие к провайдеру, пока другой был на паузе или в лимитах",
+              ("provider",), fn=lambda: {(name,): p["spillover"] for name, p in providers_stats().items()})
+METRICS.gauge("articles_provider_available", "1 — провайдер принимает запросы, 0 — на паузе после ошибок",
+              ("provider",), fn=lambda: {(name,): int(p["status"] == "active") for name, p in providers_stats().items()})
+METRICS.gauge("articles_http_requests", "HTTP-запросы к API через общий пул соединений", ("pool",),
+              fn=lambda: {(n,): p["requests"] for n, p in _http_pool_stats().items()})
+METRICS.gauge("articles_http_connections_opened", "Новые соединения (TCP + TLS) общего пула с запуска", ("pool",),
+              fn=lambda: {(n,): p["connections_opened"] for n, p in _http_pool_stats().items()})
+METRICS.gauge("articles_http_open_connections", "Открытые соединения общего пула сейчас", ("pool",),
+              fn=lambda: {(n,): p["open_connections"] for n, p in _http_pool_stats().items()})
+METRICS.gauge("articles_sse_streams", "Подключённые клиенты SSE-стримов заданий", fn=lambda: BROKER.subscribers())
+EVENT_LOOP_LAG = METRICS.histogram(
+    "articles_event_loop_lag_seconds", "Опоздание пробуждения event loop API относительно заданной паузы",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+EVENT_LOOP_LAG_MAX = METRICS.gauge("articles_event_loop_lag_max_seconds", "Наибольшее опоздание event loop с запуска")
+METRICS.gauge("process_resident_memory_bytes", "Резидентная память процесса, байт", fn=process_rss_bytes)
+
+# Повторы делают ProviderRouter (генерация) и tenacity (синхронные запросы, батчи), встроенные
+# повторы SDK выключены. Ключ клиента — первый из пула; каждый запрос подставляет выбранный пулом (ApiKey.headers)
 def get_anthropic_client() -> Anthropic:
-    return Anthropic(api_key=load_anthropic_key())
+    # синхронные клиенты делят один httpx.Client процесса — соединения не открываются заново
+    return Anthropic(api_key=get_key_pool().keys[0].secret, max_retries=0, http_client=http_clients.sync_client(
+        HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY))
 
-@retry(wait=wait_exponential_jitter(initial=1, max=20), stop=stop_after_attempt(3))
-def claude_complete(client: Anthropic, system_prompt: str, user_text: str,
-                    max_tokens: int, temperature: float) -> tuple[str, int, int]:
-    msg = client.messages.create(
-        model=MODEL_NAME,
-        system=system_prompt,
-        messages=[{"role": "user", "content": user_text}],
-        max_tokens=max_tokens,
-        temperature=temperature,
-    )
-    
+def get_async_anthropic_client() -> AsyncAnthropic:
+    # клиент на один запуск (закрывает вызывающий); в сервере — общий, см. shared_llm_client
+    return AsyncAnthropic(api_key=get_key_pool().keys[0].secret, max_retries=0)
+
+def _cached_system(system_prompt: str) -> list[dict]:
+    # Системный промпт одинаков для всех групп — помечаем его как кэшируемый префикс
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+def _message_text_usage(msg) -> tuple[str, int, int, int, int]:
     parts: list[str] = []
     for b in msg.content:
         if getattr(b, "type", None) == "text":
@@ -241,153 +503,1017 @@ def claude_complete(client: Anthropic, system_prompt: str, user_text: str,
     usage = getattr(msg, "usage", None)
     in_toks = getattr(usage, "input_tokens", 0) if usage else 0
     out_toks = getattr(usage, "output_tokens", 0) if usage else 0
-    return text, in_toks, out_toks
-
-# ─────────────────────────────── ОСНОВНАЯ ФУНКЦИЯ ───────────────────────
-def generate_articles(input_csv: Path, groups_start: int, groups_end: Optional[int], save_html: bool = False, client_emit=None):
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-
-    # --- ТРАНСЛЯЦИЯ ЛОГОВ К КЛИЕНТУ (если передали client_emit) ---
-    # Сохраняем оригинальные методы
-    _orig_info = log.info
-    _orig_warning = log.warning
-    _orig_error = log.error
-    _orig_exception = log.exception
+    cache_write = (getattr(usage, "cache_creation_input_tokens", 0) or 0) if usage else 0
+    cache_read = (getattr(usage, "cache_read_input_tokens", 0) or 0) if usage else 0
+    return text, in_toks, out_toks, cache_write, cache_read
+
+_backoff = wait_exponential_jitter(initial=1, max=20)
+
+def _retry_wait(retry_state) -> float:
+    # 429 — ждём ровно retry-after от API, остальные ошибки — экспоненциально с джиттером
+    exc = retry_state.outcome.exception()
+    reason = str(exc.status_code) if isinstance(exc, APIStatusError) else type(exc).__name__
+    LLM_RETRIES.inc(provider="anthropic", reason=reason)
+    wait = None
+    if isinstance(exc, APIStatusError) and exc.status_code == 429:
+        wait = retry_after_seconds(exc.response.headers)
+    if wait is None:
+        wait = _backoff(retry_state)
+    instant("retry", reason=reason, attempt=retry_state.attempt_number, wait_s=round(wait, 2))
+    return wait
+
+def _limiter_error(key: ApiKey, e: Exception, reserve_in: int, reserve_out: int) -> None:
+    key.errors += 1
+    key.limiter.settle(reserve_in, reserve_out, 0, 0)
+    if isinstance(e, APIStatusError):
+        key.limiter.update(e.response.headers)
+        if e.status_code == 429:
+            LLM_RATE_LIMITED.inc()
+            key.limiter.penalize(retry_after_seconds(e.response.headers))
+        elif e.status_code in (401, 403):
+            # ключ отозван или заблокирован — следующие попытки пойдут через другие ключи
+            get_key_pool().disable(key, "revoked" if e.status_code == 401 else "forbidden")
+            log.warning("🔑 Ключ %s: %d от API — выведен из ротации на %.0f с",
+                        key.name, e.status_code, ANTHROPIC_KEY_COOLDOWN)
+
+def _limiter_done(key: ApiKey, headers, reserve_in: int, reserve_out: int,
+                  result: tuple[str, int, int, int, int], model: str) -> None:
+    key.limiter.update(headers)
+    key.limiter.settle(reserve_in, reserve_out, result[1] + result[3], result[2])
+    get_key_pool().record(key, result[1] + result[3] + result[4], result[2],
+                          anthropic_cost_usd(*result[1:], model=model))
+
+@retry(wait=_retry_wait, stop=stop_after_attempt(CLAUDE_MAX_ATTEMPTS))
+def _claude_request(client: Anthropic, system_prompt: str, user_text: str,
+                    max_tokens: int, temperature: float, model: str = MODEL_NAME) -> tuple[str, int, int, int, int]:
+    reserve_in = estimate_tokens(system_prompt, user_text)
+    with span("rate_limit_wait"):
+        key = get_key_pool().acquire_blocking(reserve_in, max_tokens)
+    with span("claude_request", model=model, max_tokens=max_tokens, key=key.name) as sp:
+        try:
+            raw = client.messages.with_raw_response.create(
+                model=model,
+                system=_cached_system(system_prompt),
+                messages=[{"role": "user", "content": user_text}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                extra_headers=key.headers,
+            )
+        except Exception as e:
+            _limiter_error(key, e, reserve_in, max_tokens)
+            raise
+        result = _message_text_usage(raw.parse())
+        _limiter_done(key, raw.headers, reserve_in, max_tokens, result, model)
+        sp.set(in_tokens=result[1], out_tokens=result[2], cache_read=result[4])
+    return result
+
+async def _aclaude_request(client: AsyncAnthropic, system_prompt: str, user_text: str,
+                           max_tokens: int, temperature: float, model: str = MODEL_NAME) -> tuple[str, int, int, int, int]:
+    reserve_in = estimate_tokens(system_prompt, user_text)
+    with span("rate_limit_wait"):
+        key = await get_key_pool().acquire(reserve_in, max_tokens)
+    with span("claude_request", model=model, max_tokens=max_tokens, key=key.name) as sp:
+        try:
+            raw = await client.messages.with_raw_response.create(
+                model=model,
+                system=_cached_system(system_prompt),
+                messages=[{"role": "user", "content": user_text}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                extra_headers=key.headers,
+            )
+        except Exception as e:
+            _limiter_error(key, e, reserve_in, max_tokens)
+            raise
+        result = _message_text_usage(raw.parse())
+        _limiter_done(key, raw.headers, reserve_in, max_tokens, result, model)
+        sp.set(in_tokens=result[1], out_tokens=result[2], cache_read=result[4])
+    return result
+
+async def _aclaude_stream_request(client: AsyncAnthropic, system_prompt: str, user_text: str,
+                                  max_tokens: int, temperature: float, on_delta,
+                                  model: str = MODEL_NAME) -> tuple[str, int, int, int, int]:
+    reserve_in = estimate_tokens(system_prompt, user_text)
+    with span("rate_limit_wait"):
+        key = await get_key_pool().acquire(reserve_in, max_tokens)
+    # on_delta(None) в начале каждой попытки — клиент сбрасывает частичный текст неудачной попытки
+    on_delta(None)
+    with span("claude_request", model=model, max_tokens=max_tokens, stream=True, key=key.name) as sp:
+        t0 = time.perf_counter()
+        first_token = None
+        try:
+            async with client.messages.stream(
+                model=model,
+                system=_cached_system(system_prompt),
+                messages=[{"role": "user", "content": user_text}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                extra_headers=key.headers,
+            ) as stream:
+                async for text in stream.text_stream:
+                    if first_token is None:
+                        first_token = time.perf_counter() - t0
+                    on_delta(text)
+                msg = await stream.get_final_message()
+        except Exception as e:
+            _limiter_error(key, e, reserve_in, max_tokens)
+            raise
+        result = _message_text_usage(msg)
+        _limiter_done(key, stream.response.headers, reserve_in, max_tokens, result, model)
+        sp.set(in_tokens=result[1], out_tokens=result[2], cache_read=result[4],
+               ttft_ms=round(first_token * 1000) if first_token is not None else None)
+    return result
 
-    def _emit(prefix, msg, args):
-        if client_emit:
+def claude_complete(client: Anthropic, system_prompt: str, user_text: str,
+                    max_tokens: int, temperature: float, use_cache: bool = True,
+                    model: str = MODEL_NAME) -> tuple[str, int, int, int, int]:
+    # Попадание в кэш ответов — без запроса к API и без стоимости
+    key = ResponseCache.make_key(model, system_prompt, user_text, max_tokens, temperature)
+    if use_cache and (hit := RESPONSE_CACHE.get(key)):
+        return hit["text"], 0, 0, 0, 0
+    result = _claude_request(client, system_prompt, user_text, max_tokens, temperature, model)
+    if use_cache and result[0]:
+        RESPONSE_CACHE.put(key, {"text": result[0]})
+    return result
+
+@retry(wait=_retry_wait, stop=stop_after_attempt(CLAUDE_MAX_ATTEMPTS))
+async def _aretry(coro_fn, *args, **kwargs):
+    return await coro_fn(*args, **kwargs)
+
+async def _cancel_batch(client: AsyncAnthropic, batch_id: str, api_key) -> None:
+    # Тем же ключом, что создал батч: он живёт в аккаунте этого ключа
+    try:
+        await client.messages.batches.cancel(batch_id, extra_headers=api_key.headers)
+        log.warning("📦 Батч %s отменён", batch_id)
+    except Exception as e:
+        log.warning("📦 Не удалось отменить батч %s: %s", batch_id, e)
+
+async def aclaude_batch(client: AsyncAnthropic, system_prompt: str, prompts: dict[str, str],
+                        max_tokens: int, temperature: float, use_cache: bool = True,
+                        model: str = MODEL_NAME) -> dict[str, Optional[tuple[str, int, int, int, int]]]:
+    """
+    Отправляет промпты одним (или несколькими, по BATCH_MAX_REQUESTS) батчем Message Batches API,
+    ждёт завершения и возвращает {custom_id: (text, in, out, cache_write, cache_read)}; неуспешные — None.
+    """
+    results: dict[str, Optional[tuple[str, int, int, int, int]]] = {cid: None for cid in prompts}
+    keys = {cid: ResponseCache.make_key(model, system_prompt, user_text, max_tokens, temperature)
+            for cid, user_text in prompts.items()}
+    items = []
+    for cid, user_text in prompts.items():
+        if use_cache and (hit := RESPONSE_CACHE.get(keys[cid])):
+            results[cid] = (hit["text"], 0, 0, 0, 0)
+        else:
+            items.append((cid, user_text))
+    if len(items) < len(prompts):
+        log.info("📦 Из кэша ответов: %d, в батч: %d", len(prompts) - len(items), len(items))
+    for start in range(0, len(items), BATCH_MAX_REQUESTS):
+        chunk = items[start:start + BATCH_MAX_REQUESTS]
+        # батч живёт в аккаунте создавшего ключа — опрос и результаты тем же ключом
+        api_key = get_key_pool().pin()
+        with span("batch_submit", model=model, requests=len(chunk), key=api_key.name):
+            batch = await _aretry(client.messages.batches.create, extra_headers=api_key.headers, requests=[
+                {
+                    "custom_id": cid,
+                    "params": {
+                        "model": model,
+                        "system": _cached_system(system_prompt),
+                        "messages": [{"role": "user", "content": user_text}],
+                        "max_tokens": max_tokens,
+                        "temperature": temperature,
+                    },
+                }
+                for cid, user_text in chunk
+            ])
+        log.info("📦 Батч %s отправлен: %d запросов", batch.id, len(chunk))
+
+        with span("batch_wait", batch_id=batch.id):
             try:
-                ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                client_emit(f"{ts} {prefix}:     {msg % args}")
-            except Exception:
-                pass
+                while batch.processing_status != "ended":
+                    await asyncio.sleep(BATCH_POLL_INTERVAL)
+                    batch = await _aretry(client.messages.batches.retrieve, batch.id, extra_headers=api_key.headers)
+                    c = batch.request_counts
+                    log.info("📦 Батч %s: %s (готово %d, в работе %d, ошибок %d)",
+                             batch.id, batch.processing_status, c.succeeded, c.processing,
+                             c.errored + c.expired + c.canceled)
+            except asyncio.CancelledError:
+                # Отмена задания: батч на стороне API иначе доработает и будет оплачен
+                await asyncio.shield(_cancel_batch(client, batch.id, api_key))
+                raise
+
+        with span("batch_results", batch_id=batch.id):
+            async for entry in await _aretry(client.messages.batches.results, batch.id, extra_headers=api_key.headers):
+                if entry.result.type == "succeeded":
+                    results[entry.custom_id] = _message_text_usage(entry.result.message)
+                    _, in_toks, out_toks, cache_write, cache_read = results[entry.custom_id]
+                    get_key_pool().record(api_key, in_toks + cache_write + cache_read, out_toks,
+                                          anthropic_cost_usd(in_toks, out_toks, cache_write, cache_read,
+                                                             batch=True, model=model))
+                    if use_cache and results[entry.custom_id][0]:
+                        RESPONSE_CACHE.put(keys[entry.custom_id], {"text": results[entry.custom_id][0]})
+                else:
+                    log.warning("📦 Запрос %s в батче %s завершился: %s", entry.custom_id, batch.id, entry.result.type)
+    return results
+
+# ─────────────────────────────── ПРОВАЙДЕРЫ LLM ───────────────────────
+class AnthropicProvider(Provider):
+    name = "anthropic"
+    transient_errors = (*Provider.transient_errors, APIConnectionError)
+
+    def __init__(self, client: AsyncAnthropic, weight: float = 1.0, owns_client: bool = True):
+        super().__init__(weight, backoff_max=LLM_PROVIDER_BACKOFF_MAX, auth_cooldown=ANTHROPIC_KEY_COOLDOWN,
+                         owns_client=owns_client)
+        self.client = client
+
+    def model_for(self, stage: str) -> str:
+        return MODEL_NAME_TZ if stage == "tz" else MODEL_NAME_ARTICLE
+
+    async def complete(self, stage: str, system_prompt: str, user_text: str, max_tokens: int,
+                       temperature: float, on_delta=None) -> tuple[str, int, int, int, int]:
+        model = self.model_for(stage)
+        if on_delta:
+            return await _aclaude_stream_request(self.client, system_prompt, user_text, max_tokens, temperature,
+                                                 on_delta, model)
+        return await _aclaude_request(self.client, system_prompt, user_text, max_tokens, temperature, model)
+
+    def cost_usd(self, result: tuple[str, int, int, int, int], model: str) -> float:
+        return anthropic_cost_usd(*result[1:], model=model)
+
+    def ready_in(self, input_tokens: int, output_tokens: int) -> float:
+        return get_key_pool().ready_in(input_tokens, output_tokens)
+
+    def cooldown_for(self, exc: Exception) -> tuple[str, float]:
+        # 429 и отзыв ключа касаются одного ключа: пул уже остановил его (это видно в ready_in),
+        # провайдер на паузу не ставим, пока в пуле есть активные ключи
+        status = getattr(exc, "status_code", None)
+        if status == 429 or (status in (401, 403) and get_key_pool().active()):
+            return str(status), 0.0
+        return super().cooldown_for(exc)
+
+def _on_llm_retry(provider: Provider, reason: str, attempt: int, cooldown: float) -> None:
+    LLM_RETRIES.inc(provider=provider.name, reason=reason)
+    instant("retry", provider=provider.name, reason=reason, attempt=attempt, cooldown_s=round(cooldown, 2))
+    if cooldown > 0 and provider.health.failures == 1:
+        log.warning("⚠️ %s: ошибка %s — провайдер на паузе %.1f с, запросы идут через остальных",
+                    provider.name, reason, cooldown)
+
+def shared_llm_client(shared: HttpClients, name: str):
+    # Клиент SDK провайдера name поверх общего пула соединений (один на процесс API)
+    if name == "anthropic":
+        return shared.sdk(name, lambda c: AsyncAnthropic(api_key=get_key_pool().keys[0].secret, max_retries=0,
+                                                         http_client=c))
+    return shared.sdk(name, lambda c: AsyncOpenAI(api_key=load_openai_key(), max_retries=0, http_client=c))
+
+def make_llm_router(spec: Optional[str] = None) -> ProviderRouter:
+    # spec — "anthropic:3,openai:1" (None — LLM_PROVIDERS); попыток на вызов — CLAUDE_MAX_ATTEMPTS
+    # на каждого провайдера. В цикле сервера — общие клиенты (start_http_clients), иначе — свои на запуск
+    shared = http_clients.current()
+    providers: list[Provider] = []
+    for name, weight in parse_provider_weights(spec or LLM_PROVIDERS):
+        if name == "anthropic":
+            client = shared_llm_client(shared, name) if shared else get_async_anthropic_client()
+            providers.append(AnthropicProvider(client, weight, owns_client=shared is None))
+        else:
+            client = (shared_llm_client(shared, name) if shared
+                      else AsyncOpenAI(api_key=load_openai_key(), max_retries=0))
+            providers.append(OpenAIProvider(
+                client, weight,
+                model_tz=OPENAI_MODEL_TZ, model_article=OPENAI_MODEL_ARTICLE,
+                vector_store_id=load_vector_store_id(required=False),
+                backoff_max=LLM_PROVIDER_BACKOFF_MAX, owns_client=shared is None,
+            ))
+    return ProviderRouter(providers, RESPONSE_CACHE, max_attempts=CLAUDE_MAX_ATTEMPTS * len(providers),
+                          on_retry=_on_llm_retry)
+
+# ─────────────────────────────── ОБРАБОТКА ГРУППЫ ───────────────────────
+def _tz_prompt(keywords: List[Tuple[str, int]]) -> str:
+    main_query = keywords[0][0]
+    phrases_block = "\n".join(f"{k} частотность {f}" for k, f in keywords)
+    return TZ_USER_PROMPT_TEMPLATE.format(
+        main_query=main_query, phrases_block=phrases_block
+    )
+
+def _article_prompt(i: int, tz_text: str) -> str:
+    article_id = f"ID{i:05d}"
+    return ARTICLE_USER_PROMPT_TEMPLATE.format(
+        article_id=article_id, tz_text=tz_text
+    )
 
-    def _info(msg, *args, **kwargs):
-        _orig_info(msg, *args, **kwargs)
-        _emit("INFO", msg, args)
+def _build_row(i: int, main_query: str, tz_text: str, html_text: str) -> dict:
+    # снять возможные ```html
+    with span("strip_fences", chars=len(html_text)):
+        fence = re.compile(r"^```\s*html\s*$|^```$", re.I)
+        html_text = "\n".join(
+            line for line in html_text.splitlines() if not fence.match(line)
+        ).strip()
+
+    # Метаданные/заголовок
+    with span("extract_title_slug"):
+        h1 = re.search(r"<h1[^>]*>(.*?)</h1>", html_text, flags=re.I | re.S)
+        title = html.unescape(h1.group(1).strip()) if h1 else main_query.title()
+        slug = slugify(title)
+
+    return {"index": i, "title": title, "slug": slug, "tz": tz_text, "html": html_text}
+
+def _stage_costs(res: dict) -> tuple[float, float]:
+    # Обычный режим считает стоимость у провайдера этапа; батч — всегда Anthropic
+    if "tz_cost" in res:
+        return res["tz_cost"], res["art_cost"]
+    tz_cost  = anthropic_cost_usd(res["tz_in_tokens"], res["tz_out_tokens"],
+                                  res["tz_cache_write"], res["tz_cache_read"], batch=res["batch"],
+                                  model=res.get("tz_model", MODEL_NAME))
+    art_cost = anthropic_cost_usd(res["art_in_tokens"], res["art_out_tokens"],
+                                  res["art_cache_write"], res["art_cache_read"], batch=res["batch"],
+                                  model=res.get("art_model", MODEL_NAME))
+    return tz_cost, art_cost
+
+def _group_cost(res: dict) -> float:
+    return sum(_stage_costs(res))
+
+def _observe_stage(stage: str, seconds: float, out_tokens: int) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if out_tokens and seconds > 0:  # ответ из кэша — без токенов, скорость не считаем
+        LLM_OUTPUT_TPS.observe(out_tokens / seconds, stage=stage)
+
+def _observe_group(res: dict) -> None:
+    # Токены и стоимость — в метрики (в момент генерации, даже если строку потом отбросят)
+    for stage, prefix, cost in zip(("tz", "article"), ("tz", "art"), _stage_costs(res)):
+        LLM_TOKENS.inc(res[f"{prefix}_in_tokens"], stage=stage, kind="input")
+        LLM_TOKENS.inc(res[f"{prefix}_out_tokens"], stage=stage, kind="output")
+        LLM_TOKENS.inc(res[f"{prefix}_cache_write"], stage=stage, kind="cache_write")
+        LLM_TOKENS.inc(res[f"{prefix}_cache_read"], stage=stage, kind="cache_read")
+        COST_USD.inc(cost, stage=stage)
+    GROUPS_PROCESSED.inc(result="done")
+
+@asynccontextmanager
+async def _stage_slot(slots: Optional[asyncio.Semaphore], stage: str):
+    # Слот этапа конвейера; ожидание слота видно в трассе отдельным спаном
+    if slots is None:
+        yield
+        return
+    with span(f"wait_{stage}_slot"):
+        await slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+async def _process_group(llm: ProviderRouter, i: int, block: str, total: int,
+                         use_cache: bool = True, on_delta=None,
+                         tz_slots: Optional[asyncio.Semaphore] = None,
+                         art_slots: Optional[asyncio.Semaphore] = None) -> Optional[dict]:
+    # on_delta(i, stage, text) — потоковая выдача текста ТЗ ("tz") и статьи ("article");
+    # tz_slots/art_slots — отдельные лимиты параллельности этапов (конвейер в agenerate_articles)
+    log.info("Обрабатывается группа %d из %d", i, total)
+
+    with span("extract_keywords"):
+        keywords = extract_keywords(block)
+    if not keywords:
+        log.warning("Группа %d не содержит ключей — пропущена", i)
+        GROUPS_PROCESSED.inc(result="skipped")
+        return None
+
+    # 1) ТЗ => провайдер по весам (при ошибках — другой)
+    async with _stage_slot(tz_slots, "tz"), span("tz") as sp:
+        t0 = time.perf_counter()
+        tz, tz_provider = await llm.complete(
+            "tz", SYSTEM_PROMPT_TZ, _tz_prompt(keywords),
+            max_tokens=MAX_TOKENS_TZ, temperature=TEMPERATURE, use_cache=use_cache,
+            on_delta=(lambda text: on_delta(i, "tz", text)) if on_delta else None,
+        )
+        tz_text, tz_in_tokens, tz_out_tokens, tz_cache_write, tz_cache_read = tz
+        sp.set(provider=tz_provider.name)
+        _observe_stage("tz", time.perf_counter() - t0, tz_out_tokens)
+
+    # 2) Статья => провайдер по весам
+    async with _stage_slot(art_slots, "article"), span("article") as sp:
+        t0 = time.perf_counter()
+        art, art_provider = await llm.complete(
+            "article", SYSTEM_PROMPT_ARTICLE, _article_prompt(i, tz_text),
+            max_tokens=MAX_TOKENS_ARTICLE, temperature=TEMPERATURE, use_cache=use_cache,
+            on_delta=(lambda text: on_delta(i, "article", text)) if on_delta else None,
+        )
+        html_text, art_in_tokens, art_out_tokens, art_cache_write, art_cache_read = art
+        sp.set(provider=art_provider.name)
+        _observe_stage("article", time.perf_counter() - t0, art_out_tokens)
+
+    with span("postprocess"):
+        t0 = time.perf_counter()
+        row = _build_row(i, keywords[0][0], tz_text, html_text)
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="postprocess")
+
+    res = {
+        **row,
+        "tz_in_tokens": tz_in_tokens,
+        "tz_out_tokens": tz_out_tokens,
+        "art_in_tokens": art_in_tokens,
+        "art_out_tokens": art_out_tokens,
+        "tz_cache_write": tz_cache_write,
+        "tz_cache_read": tz_cache_read,
+        "art_cache_write": art_cache_write,
+        "art_cache_read": art_cache_read,
+        "tz_model": tz_provider.model_for("tz"),
+        "art_model": art_provider.model_for("article"),
+        "tz_provider": tz_provider.name,
+        "art_provider": art_provider.name,
+        "tz_cost": tz_provider.cost_usd(tz, tz_provider.model_for("tz")),
+        "art_cost": art_provider.cost_usd(art, art_provider.model_for("article")),
+        "batch": False,
+    }
+    _observe_group(res)
+    return res
+
+async def _process_groups_batch(client: AsyncAnthropic, items: list[tuple[int, str]],
+                                use_cache: bool = True) -> list[Optional[dict]]:
+    # Все ТЗ — одним батчем, затем все статьи — вторым
+    keywords_by_i: dict[int, List[Tuple[str, int]]] = {}
+    for i, block in items:
+        keywords = extract_keywords(block)
+        if keywords:
+            keywords_by_i[i] = keywords
+        else:
+            log.warning("Группа %d не содержит ключей — пропущена", i)
+            GROUPS_PROCESSED.inc(result="skipped")
+
+    log.info("📦 Батч ТЗ: %d групп", len(keywords_by_i))
+    tz_results = await aclaude_batch(
+        client, SYSTEM_PROMPT_TZ,
+        {f"g{i:05d}": _tz_prompt(kw) for i, kw in keywords_by_i.items()},
+        max_tokens=MAX_TOKENS_TZ, temperature=TEMPERATURE, use_cache=use_cache, model=MODEL_NAME_TZ
+    )
 
-    def _warning(msg, *args, **kwargs):
-        _orig_warning(msg, *args, **kwargs)
-        _emit("WARNING", msg, args)
+    tz_by_i = {i: tz_results[f"g{i:05d}"] for i in keywords_by_i if tz_results[f"g{i:05d}"]}
+    log.info("📦 Батч статей: %d групп", len(tz_by_i))
+    art_results = await aclaude_batch(
+        client, SYSTEM_PROMPT_ARTICLE,
+        {f"g{i:05d}": _article_prompt(i, tz[0]) for i, tz in tz_by_i.items()},
+        max_tokens=MAX_TOKENS_ARTICLE, temperature=TEMPERATURE, use_cache=use_cache, model=MODEL_NAME_ARTICLE
+    )
 
-    def _error(msg, *args, **kwargs):
-        _orig_error(msg, *args, **kwargs)
-        _emit("ERROR", msg, args)
+    results: list[Optional[dict]] = []
+    for i, _ in items:
+        tz = tz_by_i.get(i)
+        art = art_results.get(f"g{i:05d}")
+        if i not in keywords_by_i:
+            results.append(None)
+            continue
+        if not (tz and art):
+            # не попадает в журнал — будет перезапущена при возобновлении задания
+            log.error("Группа %d не сгенерирована в батче — пропущена", i)
+            GROUPS_PROCESSED.inc(result="failed")
+            results.append({"index": i, "failed": True})
+            continue
+        results.append({
+            **_build_row(i, keywords_by_i[i][0][0], tz[0], art[0]),
+            "tz_in_tokens": tz[1],
+            "tz_out_tokens": tz[2],
+            "art_in_tokens": art[1],
+            "art_out_tokens": art[2],
+            "tz_cache_write": tz[3],
+            "tz_cache_read": tz[4],
+            "art_cache_write": art[3],
+            "art_cache_read": art[4],
+            "tz_model": MODEL_NAME_TZ,
+            "art_model": MODEL_NAME_ARTICLE,
+            "tz_provider": "anthropic",
+            "art_provider": "anthropic",
+            "batch": True,
+        })
+        _observe_group(results[-1])
+    return results
 
-    def _exception(msg, *args, **kwargs):
-        _orig_exception(msg, *args, **kwargs)
-        _emit("ERROR", msg, args)
+# ─────────────────────────────── ОСНОВНАЯ ФУНКЦИЯ ───────────────────────
+async def agenerate_articles(input_csv: Path, groups_start: int, groups_end: Optional[int], save_html: bool = False,
+                             client_emit=None, concurrency: Optional[int] = None, batch: bool = False,
+                             use_cache: bool = True, job_id: Optional[str] = None, resume: bool = False,
+                             on_progress=None, on_delta=None, tz_concurrency: Optional[int] = None,
+                             trace: Optional[bool] = None, output_format: str = "csv",
+                             dedup: Optional[bool] = None, providers: Optional[str] = None):
+    # providers — провайдеры LLM с весами ("anthropic:3,openai:1"), None — LLM_PROVIDERS
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
-    # Подменяем методы на время выполнения
-    log.info = _info
-    log.warning = _warning
-    log.error = _error
-    log.exception = _exception
+    # Логи этого запуска (и его задач) уходят клиенту, если передали client_emit
+    sink_token = _route_logs_to(client_emit) if client_emit else None
 
+    journal: Optional[JobJournal] = None
+    job_trace = None
+    llm: Optional[ProviderRouter] = None
+    ACTIVE_RUNS.inc()
     try:
 
-        client = get_anthropic_client()
-
         # Пути на хосте
         input_csv = input_csv if input_csv.is_absolute() else (BASE_DIR / input_csv)
         if not input_csv.exists():
             raise FileNotFoundError(f"Входной CSV не найден: {input_csv}")
 
-        out_csv = BASE_DIR / "articles.csv"
-
-        groups = parse_groups(input_csv)
-        log.info("Загружено групп: %d", len(groups))
-        groups_slice = groups[groups_start:] if groups_end is None else groups[groups_start:groups_end]
-        log.info("Будет обработано групп: %d (с %d по %d)", len(groups_slice), groups_start + 1, (groups_end or len(groups)))
-        log.info("🚀 Старт обработки...")
-
-        with out_csv.open("w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=["title", "slug", "tz", "html"])
-            writer.writeheader()
+        # Журнал и результат — в папке задания, параллельные задания не мешают друг другу
+        job_id = job_id or uuid.uuid4().hex
+        if TRACE_JOBS if trace is None else trace:
+            job_trace = start_trace(job_id, JOBS_DIR / job_id / "trace.jsonl")
+            set_lane(0, "задание")
+        out_csv = JOBS_DIR / job_id / "articles.csv"
+        out_csv.parent.mkdir(parents=True, exist_ok=True)
+        journal = JobJournal(JOBS_DIR / job_id / "journal.jsonl")
+        start_rec, done_recs, _ = journal.read() if resume else (None, [], None)
+        if resume and start_rec is None:
+            raise FileNotFoundError(f"Журнал задания не найден: {job_id}")
+        done = {r["i"] for r in done_recs}
+        prev_cost = sum(r.get("cost", 0.0) for r in done_recs)
+        rows_path = out_csv
+        if start_rec is not None:
+            # журналы до появления форматов вывода — CSV, строки в out_csv
+            out_csv = Path(start_rec["out_csv"])
+            output_format = start_rec.get("output_format", "csv")
+            rows_path = Path(start_rec.get("rows_path", out_csv))
+            dedup = start_rec.get("dedup", False)
+            providers = providers or start_rec.get("providers")
+        dedup_jaccard = start_rec.get("dedup_jaccard", DEDUP_JACCARD) if start_rec else DEDUP_JACCARD
+        # журналы до появления флага схлопывали и похожие группы
+        dedup_collapse_near = start_rec.get("dedup_collapse_near", True) if start_rec else DEDUP_COLLAPSE_NEAR
+        dedup = DEDUP_GROUPS if dedup is None else dedup
+        providers = providers or LLM_PROVIDERS
+        llm = make_llm_router(providers)
+        if batch and llm.get("anthropic") is None:
+            raise RuntimeError("Message Batches доступны только у Anthropic — добавьте anthropic в providers")
+        if len(llm.providers) > 1:
+            log.info("🔀 Провайдеры LLM: %s", ", ".join(f"{p.name} (вес {p.weight:g})" for p in llm.providers))
+
+        # Дубли групп не генерируем: план считается заново при возобновлении (вход тот же)
+        plan = None
+        if dedup:
+            with span("dedup"):
+                plan = await asyncio.to_thread(plan_dedup, (
+                    (i, [k for k, _ in extract_keywords(block)])
+                    for i, block in enumerate(iter_groups(input_csv, groups_start, groups_end), 1)
+                ), dedup_jaccard, dedup_collapse_near)
+            (JOBS_DIR / job_id / "dedup.json").write_text(
+                json.dumps(plan.report(), ensure_ascii=False, indent=1), encoding="utf-8")
+            log.info("🧹 Дедупликация: уникальных групп %d из %d, дублей %d (точных %d, похожих %d) — "
+                     "LLM-вызовов не понадобится: %d", plan.groups - len(plan.duplicates), plan.groups,
+                     len(plan.duplicates), plan.exact, plan.near, plan.llm_calls_saved)
+            if plan.flagged:
+                log.info("🧹 Похожих групп отмечено в отчёте, но генерируются: %d (схлопывать — DEDUP_COLLAPSE_NEAR=1)",
+                         len(plan.flagged))
+        duplicates = plan.duplicates if plan else {}
+        followers = plan.followers.copy() if plan else Counter()
+        # строки представителей, у которых ещё будут дубли (копия уходит в результат за каждый)
+        rep_rows: dict[int, dict] = {}
+
+        # подсчёт — проход по всему файлу, не держим им event loop
+        groups_total = plan.groups if plan else await asyncio.to_thread(count_groups, input_csv, groups_start,
+                                                                        groups_end)
+        log.info("Будет обработано групп: %d (с %d по %d)", groups_total, groups_start + 1, groups_start + groups_total)
+        if done:
+            log.info("♻️ Возобновление задания %s: уже готово групп %d, осталось %d",
+                     job_id, len(done), groups_total - len(done))
+        concurrency = max(1, concurrency or DEFAULT_CONCURRENCY)
+        tz_concurrency = max(1, tz_concurrency or DEFAULT_TZ_CONCURRENCY)
+        if batch:
+            log.info("🚀 Старт обработки (Message Batches)...")
+            if on_delta:
+                log.warning("Потоковая выдача текста в режиме батча недоступна — статьи придут целиком")
+        else:
+            log.info("🚀 Старт обработки (параллельно ТЗ: %d, статей: %d, буфер ТЗ: %d)...",
+                     tz_concurrency, concurrency, PIPELINE_BUFFER)
+
+        pending = ((i, block) for i, block in enumerate(iter_groups(input_csv, groups_start, groups_end), 1)
+                   if i not in done)
+        groups_done = len(done)
+        if on_progress:
+            on_progress(groups_done, groups_total, prev_cost)
+        # Конвейер ТЗ → статья: у этапов свои лимиты, ТЗ пишутся наперёд, и готовые ТЗ ждут
+        # свободного слота статьи (не больше PIPELINE_BUFFER сверх работающих групп)
+        tz_slots = asyncio.Semaphore(tz_concurrency)
+        art_slots = asyncio.Semaphore(concurrency)
+
+        async def run_group(i: int, block: str) -> Optional[dict]:
+            set_lane(i, f"группа {i}")
+            try:
+                with span("group", i=i):
+                    return await _process_group(llm, i, block, groups_total, use_cache, on_delta,
+                                                tz_slots, art_slots)
+            except Exception:
+                GROUPS_PROCESSED.inc(result="failed")
+                raise
+
+        # Окно задач: в памяти не больше групп, чем слотов обоих этапов плюс буфер
+        window: deque[tuple[int, asyncio.Task]] = deque()
+        window_size = tz_concurrency + concurrency + PIPELINE_BUFFER
+
+        async def ordered_results():
+            if batch:
+                items = list(pending)
+                todo = [item for item in items if item[0] not in duplicates]
+                batch_results = await _process_groups_batch(llm.get("anthropic").client, todo, use_cache)
+                by_i = dict(zip((i for i, _ in todo), batch_results))
+                for i, _ in items:
+                    yield i, by_i[i] if i in by_i else {"duplicate_of": duplicates[i]["of"]}
+                return
+
+            def fill():
+                while len(window) < window_size:
+                    nxt = next(pending, None)
+                    if nxt is None:
+                        break
+                    if nxt[0] in duplicates:
+                        window.append((nxt[0], None))  # дубль — строка будет скопирована
+                    else:
+                        window.append((nxt[0], asyncio.create_task(run_group(*nxt))))
+
+            # Группы обрабатываются параллельно, но отдаются строго по порядку
+            fill()
+            while window:
+                i, task = window[0]
+                res = await task if task is not None else {"duplicate_of": duplicates[i]["of"]}
+                window.popleft()
+                fill()
+                yield i, res
+
+        # Файл строк: offset в журнале — его размер после последней записанной группы
+        writer = make_writer(output_format, out_csv.parent)
+        if start_rec is not None:
+            # отрезаем возможную недописанную строку после последней записанной группы
+            writer.rows_path = rows_path
+            offset = writer.open(done_recs[-1]["offset"] if done_recs else start_rec["offset"])
+        else:
+            offset = writer.open()
+            journal.append({
+                "type": "start", "job_id": job_id, "input_csv": str(input_csv),
+                "groups_start": groups_start, "groups_end": groups_end, "save_html": save_html,
+                "batch": batch, "out_csv": str(writer.path), "output_format": output_format,
+                "rows_path": str(writer.rows_path), "offset": offset,
+                "dedup": plan is not None, "dedup_jaccard": dedup_jaccard,
+                "dedup_collapse_near": dedup_collapse_near, "providers": providers,
+            })
+        out_csv = writer.path
+        generated = sum(1 for r in done_recs if not r.get("skipped") and "duplicate_of" not in r)
+        # стоимость по провайдерам (вместе с группами до возобновления)
+        provider_costs: Counter = Counter()
+        for r in done_recs:
+            provider_costs.update(r.get("provider_costs", {}))
+        if done_recs and plan is not None:
+            # строки представителей, сгенерированных до возобновления, — из файла строк
+            for r in done_recs:
+                if "duplicate_of" in r:
+                    followers[r["duplicate_of"]] -= 1
+            prev_offset = start_rec["offset"]
+            for r in done_recs:
+                if followers[r["i"]] > 0 and r["offset"] > prev_offset:
+                    rep_rows[r["i"]] = read_rows(output_format, writer.rows_path, prev_offset, r["offset"])[0]
+                prev_offset = r["offset"]
+        _RUNNING_JOBS.add(job_id)
 
-            total_cost = 0.0
+        try:
+            total_cost = prev_cost
             saved_html_files: list[str] = []
 
-            for i, block in enumerate(groups_slice, 1):
-                log.info("Обрабатывается группа %d из %d", i, len(groups_slice))
-
-                keywords = extract_keywords(block)
-                if not keywords:
-                    log.warning("Группа %d не содержит ключей — пропущена", i)
-                    continue
+            try:
+                async for i, res in ordered_results():
+                    if res is None:
+                        journal.append({"type": "group", "i": i, "skipped": True, "offset": offset})
+                        groups_done += 1
+                        if on_progress:
+                            on_progress(groups_done, groups_total, total_cost)
+                        continue
+                    if "duplicate_of" in res:
+                        rep_i = res["duplicate_of"]
+                        followers[rep_i] -= 1
+                        row = rep_rows.get(rep_i) if followers[rep_i] > 0 else rep_rows.pop(rep_i, None)
+                        if row is None:
+                            # представитель не сгенерирован (ошибка в батче) — повторится при возобновлении
+                            log.error("Группа %d — дубль группы %d, которая не сгенерирована — пропущена", i, rep_i)
+                            GROUPS_PROCESSED.inc(result="failed")
+                            continue
+                        # копия со своим slug (номер группы), чтобы строки результата не совпадали по slug
+                        row = {**row, "slug": f"{row['slug']}-{i}"}
+                        with span("csv_write", i=i):
+                            offset = writer.write(row)
+                        journal.append({"type": "group", "i": i, "slug": row["slug"], "duplicate_of": rep_i,
+                                        "cost": 0.0, "offset": offset})
+                        GROUPS_PROCESSED.inc(result="duplicate")
+                        log.info("♻️ Группа %d — дубль группы %d (%s): строка скопирована без генерации",
+                                 i, rep_i, duplicates[i]["kind"])
+                        groups_done += 1
+                        if on_progress:
+                            on_progress(groups_done, groups_total, total_cost)
+                        continue
+                    if res.get("failed"):
+                        continue
+
+                    # Запись в общий файл результата
+                    with span("csv_write", i=i):
+                        t0 = time.perf_counter()
+                        offset = writer.write(res)
+                        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="csv_write")
+                    log.info("✅ Сохранено в %s: %s", output_format.upper(), res["slug"])
+                    generated += 1
+                    if followers[i] > 0:
+                        rep_rows[i] = {k: res[k] for k in ("title", "slug", "tz", "html")}
+
+                    # (Опционально) сохранить отдельный html на хосте
+                    if save_html:
+                        out_dir = BASE_DIR / "output"
+                        out_dir.mkdir(exist_ok=True)
+                        out_file = out_dir / f"{res['slug']}.html"
+                        out_file.write_text(res["html"], encoding="utf-8")
+                        saved_html_files.append(str(out_file))
+                        log.info("💾 HTML-файл сохранён на хосте: %s", out_file)
+
+                    # Стоимость — у провайдера каждого этапа
+                    tz_cost, art_cost = _stage_costs(res)
+                    art_total_cost = tz_cost + art_cost
+                    total_cost += art_total_cost
+                    group_costs = Counter()
+                    group_costs[res["tz_provider"]] += tz_cost
+                    group_costs[res["art_provider"]] += art_cost
+                    provider_costs.update(group_costs)
+
+                    journal.append({"type": "group", "i": i, "slug": res["slug"],
+                                    "cost": art_total_cost, "offset": offset,
+                                    "provider_costs": dict(group_costs)})
+                    groups_done += 1
+                    if on_progress:
+                        on_progress(groups_done, groups_total, total_cost)
+
+                    log.info(
+                        "🔸 Группа %d | Токены ТЗ (in/out): %s/%s | Статья (in/out): %s/%s | "
+                        "Кэш (запись/чтение): %s/%s | Стоимость: $%.4f (сумма: $%.4f)%s",
+                        res["index"], res["tz_in_tokens"], res["tz_out_tokens"],
+                        res["art_in_tokens"], res["art_out_tokens"],
+                        res["tz_cache_write"] + res["art_cache_write"], res["tz_cache_read"] + res["art_cache_read"],
+                        art_total_cost, total_cost,
+                        f" | ТЗ: {res['tz_provider']}, статья: {res['art_provider']}" if len(llm.providers) > 1 else ""
+                    )
+            finally:
+                # при ошибке/отмене не продолжаем оставшиеся группы
+                tasks = [task for _, task in window]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
 
-                main_query = keywords[0][0]
-                phrases_block = "\n".join(f"{k} частотность {f}" for k, f in keywords)
-
-                # 1) ТЗ => Claude
-                tz_prompt = TZ_USER_PROMPT_TEMPLATE.format(
-                    main_query=main_query, phrases_block=phrases_block
-                )
-                tz_text, tz_in_tokens, tz_out_tokens = claude_complete(
-                    client, SYSTEM_PROMPT_TZ, tz_prompt,
-                    max_tokens=MAX_TOKENS_TZ, temperature=TEMPERATURE
-                )
-
-                # 2) Статья => Claude
-                article_id = f"ID{i:05d}"
-                art_prompt = ARTICLE_USER_PROMPT_TEMPLATE.format(
-                    article_id=article_id, tz_text=tz_text
-                )
-                html_text, art_in_tokens, art_out_tokens = claude_complete(
-                    client, SYSTEM_PROMPT_ARTICLE, art_prompt,
-                    max_tokens=MAX_TOKENS_ARTICLE, temperature=TEMPERATURE
-                )
-
-                # снять возможные ```html
-                fence = re.compile(r"^```\s*html\s*$|^```$", re.I)
-                html_text = "\n".join(
-                    line for line in html_text.splitlines() if not fence.match(line)
-                ).strip()
-
-                # Метаданные/заголовок
-                h1 = re.search(r"<h1[^>]*>(.*?)</h1>", html_text, flags=re.I | re.S)
-                title = html.unescape(h1.group(1).strip()) if h1 else main_query.title()
-                slug = slugify(title)
-
-                # Запись в общий CSV
-                writer.writerow({"title": title, "slug": slug, "tz": tz_text, "html": html_text})
-                log.info("✅ Сохранено в CSV: %s", slug)
-
-                # (Опционально) сохранить отдельный html на хосте
-                if save_html:
-                    out_dir = BASE_DIR / "output"
-                    out_dir.mkdir(exist_ok=True)
-                    out_file = out_dir / f"{slug}.html"
-                    out_file.write_text(html_text, encoding="utf-8")
-                    saved_html_files.append(str(out_file))
-                    log.info("💾 HTML-файл сохранён на хосте: %s", out_file)
-
-                # Стоимость (Anthropic)
-                tz_cost  = anthropic_cost_usd(tz_in_tokens, tz_out_tokens)
-                art_cost = anthropic_cost_usd(art_in_tokens, art_out_tokens)
-                art_total_cost = tz_cost + art_cost
-                total_cost += art_total_cost
-
-                log.info(
-                    "🔸 Токены ТЗ (in/out): %s/%s | Статья (in/out): %s/%s | Стоимость: $%.4f (сумма: $%.4f)",
-                    tz_in_tokens, tz_out_tokens, art_in_tokens, art_out_tokens, art_total_cost, total_cost
-                )
+        journal.append({"type": "done", "total_cost": total_cost})
+        journal.close()
 
         log.info("Готово → файл %s", out_csv)
         log.info("ИТОГОВАЯ сумма: $%.4f", total_cost)
+        if len(provider_costs) > 1:
+            log.info("💳 По провайдерам: %s", ", ".join(f"{name} ${cost:.4f}" for name, cost in provider_costs.items()))
+        if plan is not None and plan.duplicates:
+            # экономия — по средней стоимости сгенерированной группы этого задания
+            saved_cost = total_cost / generated * len(plan.duplicates) if generated else 0.0
+            log.info("🧹 Дедупликация: дублей %d, LLM-вызовов сэкономлено %d (~$%.4f)",
+                     len(plan.duplicates), plan.llm_calls_saved, saved_cost)
+        if use_cache:
+            cache_stats = RESPONSE_CACHE.stats()
+            log.info("Кэш ответов: попаданий %d, промахов %d", cache_stats["hits"], cache_stats["misses"])
 
         return {
+            "job_id": job_id,
             "articles_csv": str(out_csv),
+            "output_format": output_format,
             "total_cost": round(total_cost, 4),
-            "groups_processed": len(groups_slice),
+            "cost_by_provider": {name: round(cost, 4) for name, cost in provider_costs.items()},
+            "groups_processed": groups_total,
             "saved_html_files": saved_html_files,
+            "dedup": {**plan.summary(), "report": str(JOBS_DIR / job_id / "dedup.json")} if plan else None,
         }
     finally:
-        # Восстанавливаем оригинальные методы, чтобы не влиять на параллельные запросы
-        log.info = _orig_info
-        log.warning = _orig_warning
-        log.error = _orig_error
-        log.exception = _orig_exception
+        ACTIVE_RUNS.dec()
+        if llm is not None:
+            await llm.close()
+        if job_id is not None:
+            _RUNNING_JOBS.discard(job_id)
+        if job_trace is not None:
+            stop_trace(job_trace)
+        if journal is not None:
+            journal.close()
+        if sink_token is not None:
+            _log_sink.reset(sink_token)
+
+def generate_articles(input_csv: Path, groups_start: int, groups_end: Optional[int], save_html: bool = False,
+                      client_emit=None, concurrency: Optional[int] = None, batch: bool = False,
+                      use_cache: bool = True, job_id: Optional[str] = None, resume: bool = False,
+                      on_progress=None, on_delta=None, tz_concurrency: Optional[int] = None,
+                      trace: Optional[bool] = None, output_format: str = "csv", dedup: Optional[bool] = None,
+                      providers: Optional[str] = None):
+    # Синхронная обёртка (для скриптов и sync-эндпоинта): свой event loop на вызов
+    return asyncio.run(agenerate_articles(
+        input_csv=input_csv,
+        groups_start=groups_start,
+        groups_end=groups_end,
+        save_html=save_html,
+        client_emit=client_emit,
+        concurrency=concurrency,
+        batch=batch,
+        use_cache=use_cache,
+        job_id=job_id,
+        resume=resume,
+        on_progress=on_progress,
+        on_delta=on_delta,
+        tz_concurrency=tz_concurrency,
+        trace=trace,
+        output_format=output_format,
+        dedup=dedup,
+        providers=providers,
+    ))
+
+async def aresume_job(job_id: str, client_emit=None, concurrency: Optional[int] = None, use_cache: bool = True,
+                      on_progress=None, tz_concurrency: Optional[int] = None, trace: Optional[bool] = None):
+    # Продолжить прерванное задание с теми же параметрами: готовые группы пропускаются,
+    # новые строки дописываются в тот же файл
+    start_rec, _, _ = JobJournal(JOBS_DIR / job_id / "journal.jsonl").read()
+    if start_rec is None:
+        raise FileNotFoundError(f"Журнал задания не найден: {job_id}")
+    if start_rec.get("queue"):
+        raise RuntimeError(f"Задание {job_id} из очереди — продолжить: POST /jobs/{job_id}/resume")
+    return await agenerate_articles(
+        input_csv=Path(start_rec["input_csv"]),
+        groups_start=start_rec["groups_start"],
+        groups_end=start_rec["groups_end"],
+        save_html=start_rec["save_html"],
+        client_emit=client_emit,
+        concurrency=concurrency,
+        batch=start_rec["batch"],
+        use_cache=use_cache,
+        job_id=job_id,
+        resume=True,
+        on_progress=on_progress,
+        tz_concurrency=tz_concurrency,
+        trace=trace,
+    )
+
+async def _save_upload_input(job_id: str, file: UploadFile) -> Path:
+    # Входной CSV лежит рядом с журналом задания, чтобы задание можно было возобновить.
+    # Пишем кусками — загрузка любого размера не держится в памяти целиком
+    job_dir = JOBS_DIR / job_id
+    job_dir.mkdir(parents=True, exist_ok=True)
+    input_path = job_dir / "input.csv"
+    with input_path.open("wb") as f:
+        while (chunk := await file.read(UPLOAD_CHUNK_SIZE)):
+            f.write(chunk)
+    return input_path
+
+# ─────────────────────────────── ОЧЕРЕДЬ ЗАДАНИЙ ───────────────────────
+JOBS = JobRegistry(JOBS_DIR, BASE_DIR / "queue.db",
+                   lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS,
+                   retry_backoff=QUEUE_RETRY_BACKOFF, retry_backoff_max=QUEUE_RETRY_BACKOFF_MAX)
+
+def _write_job_rows(job_id: str, params: dict, groups: list[tuple[int, Optional[dict]]], offset: int,
+                    final: bool) -> int:
+    # Дописывает готовые группы задания очереди в его файл (формат — output_format) и отмечает их
+    # в журнале задания, по которому строки отдаёт GET /jobs/{job_id}/rows; возвращает новую позицию
+    # файла строк. Parquet собирается один раз, последним вызовом, до этого строки копятся в .jsonl
+    output_format = params.get("output_format", "csv")
+    job_dir = JOBS.job_dir(job_id)
+    writer = make_writer(output_format, job_dir)
+    if output_format == "parquet" and not final:
+        writer = JsonlRowWriter(writer.rows_path)
+    journal = JobJournal(job_dir / "journal.jsonl")
+    # записи групп, отмеченных до падения без фиксации в очереди, откатываем вместе с хвостом файла
+    journal.truncate(lambda rec: rec.get("type") == "start" or rec.get("i", 0) < groups[0][0])
+    rows = [row for _, row in groups if row is not None]
+    t0 = time.perf_counter()
+    try:
+        with span("csv_write", rows=len(rows)):
+            offset = writer.open(offset)
+            for i, row in groups:
+                if row is None:
+                    journal.append({"type": "group", "i": i, "skipped": True, "offset": offset})
+                    continue
+                offset = writer.write(row)
+                journal.append({"type": "group", "i": i, "slug": row["slug"], "offset": offset})
+            if final:
+                journal.append({"type": "done"})
+    finally:
+        writer.close()
+        journal.close()
+    if rows:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="csv_write")
+    if params.get("save_html"):
+        out_dir = BASE_DIR / "output"
+        out_dir.mkdir(exist_ok=True)
+        for row in rows:
+            (out_dir / f"{row['slug']}.html").write_text(row["html"], encoding="utf-8")
+    return offset
+
+async def _run_queue_task(llm: ProviderRouter, worker_id: str, task: dict):
+    # Трасса задания — только на время этой группы (слот воркера переиспользуется)
+    job_trace = None
+    if task["params"].get("trace"):
+        job_trace = start_trace(task["job_id"], JOBS.job_dir(task["job_id"]) / "trace.jsonl")
+    try:
+        await _run_queue_group(llm, worker_id, task)
+    finally:
+        if job_trace is not None:
+            stop_trace(job_trace)
+
+async def _run_queue_group(llm: ProviderRouter, worker_id: str, task: dict):
+    job_id, idx, params = task["job_id"], task["idx"], task["params"]
+
+    set_lane(idx, f"группа {idx}")
+    group = asyncio.create_task(
+        _process_group(llm, idx, task["block"], task["total"], params.get("use_cache", True)))
+    job_cancelled = lease_lost = False
+
+    async def keep_lease():
+        # Продлеваем аренду и часто проверяем отмену задания (её мог сделать другой процесс)
+        nonlocal job_cancelled, lease_lost
+        last_beat = time.monotonic()
+        while True:
+            await asyncio.sleep(min(QUEUE_CANCEL_CHECK_SECONDS, QUEUE_LEASE_SECONDS / 3))
+            try:
+                if await asyncio.to_thread(JOBS.is_cancelled, job_id):
+                    job_cancelled = True
+                    group.cancel()
+                    return
+                if time.monotonic() - last_beat >= QUEUE_LEASE_SECONDS / 3:
+                    if not await asyncio.to_thread(JOBS.heartbeat, job_id, idx, worker_id):
+                        # группу уже отдали другому воркеру — дальше генерировать её незачем
+                        lease_lost = True
+                        group.cancel()
+                        return
+                    last_beat = time.monotonic()
+            except Exception as e:
+                # ошибка базы очереди (например, она занята) — пробуем снова на следующем круге,
+                # пока аренда не истекла
+                log.warning("Задание %s, группа %d: не удалось продлить аренду: %s", job_id, idx, e)
+
+    heartbeat = asyncio.create_task(keep_lease())
+    try:
+        with span("group", i=idx, worker=worker_id, attempt=task["attempt"]):
+            res = await group
+    except asyncio.CancelledError:
+        if lease_lost:
+            log.warning("Задание %s, группа %d: аренда потеряна — группа прервана", job_id, idx)
+            return
+        if not job_cancelled:
+            raise
+        GROUPS_PROCESSED.inc(result="cancelled")
+        log.info("Задание %s отменено — группа %d прервана", job_id, idx)
+        return
+    except Exception as e:
+        GROUPS_PROCESSED.inc(result="failed")
+        final = await asyncio.to_thread(JOBS.fail, job_id, idx, worker_id, str(e))
+        log.warning("Задание %s, группа %d: ошибка (попытка %d)%s: %s", job_id, idx, task["attempt"],
+                    " — попытки исчерпаны" if final else "", e)
+        return
+    finally:
+        heartbeat.cancel()
+
+    cost = _group_cost(res) if res else 0.0
+    if not await asyncio.to_thread(JOBS.complete, job_id, idx, worker_id, res, cost):
+        # аренду успели забрать (воркер завис дольше QUEUE_LEASE_SECONDS) или задание отменили
+        log.warning("Задание %s, группа %d: аренда потеряна или задание отменено, результат отброшен", job_id, idx)
+        return
+    if res:
+        log.info("🔸 Задание %s, группа %d | Токены ТЗ (in/out): %s/%s | Статья (in/out): %s/%s | Стоимость: $%.4f",
+                 job_id, idx, res["tz_in_tokens"], res["tz_out_tokens"],
+                 res["art_in_tokens"], res["art_out_tokens"], cost)
+
+    for row in await asyncio.to_thread(_flush_job, job_id, params):
+        log.info("✅ Задание %s: сохранено: %s", job_id, row["slug"])
+
+def _flush_job(job_id: str, params: dict) -> list[dict]:
+    # Дописать готовые по порядку строки задания и завершить его, если группы кончились
+    return JOBS.flush_ready(job_id, lambda groups, offset, final: _write_job_rows(job_id, params, groups, offset,
+                                                                                   final))
+
+def _finish_stalled_jobs() -> None:
+    # Задания, чей последний воркер упал между complete и flush_ready, иначе навсегда остались бы running
+    for job_id in JOBS.stalled():
+        job = JOBS.get(job_id)
+        if job is not None:
+            for row in _flush_job(job_id, job.params):
+                log.info("✅ Задание %s: сохранено: %s", job_id, row["slug"])
+
+async def run_queue_worker(worker_id: str, concurrency: int, stop: Optional[asyncio.Event] = None):
+    """
+    Цикл воркера очереди: concurrency слотов, каждый берёт группу в аренду,
+    генерирует ТЗ и статью (провайдеры — LLM_PROVIDERS) и дописывает готовые строки в CSV задания.
+    """
+    llm = make_llm_router()
+    log.info("Воркер %s запущен (групп одновременно: %d)", worker_id, concurrency)
+
+    async def slot():
+        while not (stop and stop.is_set()):
+            try:
+                task = await asyncio.to_thread(JOBS.lease, worker_id)
+                if task is None:
+                    await asyncio.to_thread(_finish_stalled_jobs)
+            except Exception:
+                log.exception("Воркер %s: ошибка очереди", worker_id)
+                task = None
+            if task is None:
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            await _run_queue_task(llm, worker_id, task)
+
+    try:
+        await asyncio.gather(*(slot() for _ in range(max(1, concurrency))))
+    finally:
+        await llm.close()
+        log.info("Воркер %s остановлен", worker_id)
 
 # ─────────────────────────────── FASTAPI ────────────────────────────────
 class GenerateRequest(BaseModel):
@@ -395,29 +1521,171 @@ class GenerateRequest(BaseModel):
     groups_start: int = 0
     groups_end: Optional[int] = None  # null => до конца
     save_html: bool = False
+    concurrency: Optional[int] = None  # статей одновременно, null => ARTICLES_CONCURRENCY
+    tz_concurrency: Optional[int] = None  # ТЗ одновременно, null => ARTICLES_TZ_CONCURRENCY
+    batch: bool = False  # Message Batches API: дешевле, но без интерактивной задержки
+    use_cache: bool = True  # false => не брать и не сохранять ответы в кэш
+    trace: Optional[bool] = None  # трасса в JOBS_DIR/<job_id>/trace.jsonl, null => TRACE_JOBS
+    output_format: Literal["csv", "jsonl", "parquet"] = "csv"  # формат файла результата
+    dedup: Optional[bool] = None  # не генерировать дубли групп, null => DEDUP_GROUPS
+    providers: Optional[str] = None  # провайдеры LLM с весами ("anthropic:3,openai:1"), null => LLM_PROVIDERS
+
+class ResumeRequest(BaseModel):
+    job_id: str
+    concurrency: Optional[int] = None
+    tz_concurrency: Optional[int] = None
+    use_cache: bool = True
+    trace: Optional[bool] = None
 
 app = FastAPI(title="Articles Generator API (Claude)")
 
+# Фоновые задачи генерации, запущенные из эндпоинтов
+_background_tasks: set[asyncio.Task] = set()
+
+# События стримов по заданиям: несколько подписчиков, переподключение с Last-Event-ID
+BROKER = SSEBroker(max_events=SSE_BUFFER_EVENTS, retain_seconds=SSE_RETAIN_SECONDS)
+
+# Идущие стрим-генерации: job_id -> задача и причина отмены (если отменяли)
+_stream_runs: dict[str, asyncio.Task] = {}
+_cancel_reasons: dict[str, str] = {}
+
+def _cancel_run(job_id: str, reason: str) -> bool:
+    # Отмена задачи прерывает запросы в работе (agenerate_articles снимает задачи групп и
+    # закрывает клиент), новые группы не стартуют; журнал остаётся для возобновления
+    task = _stream_runs.get(job_id)
+    if task is None or task.done():
+        return False
+    _cancel_reasons.setdefault(job_id, reason)
+    task.cancel()
+    return True
+
+async def _cancel_when_abandoned(job_id: str, stream, grace: float):
+    # Клиенты отключились и не вернулись за grace секунд — генерацию никто не ждёт
+    step = min(1.0, grace / 4)
+    idle = 0.0
+    while job_id in _stream_runs:
+        await asyncio.sleep(step)
+        idle = idle + step if stream.subscribers == 0 else 0.0
+        if idle >= grace:
+            if _cancel_run(job_id, "клиент отключился"):
+                log.warning("Стрим %s: клиентов нет %.0f с — генерация отменена", job_id, grace)
+            return
+
+def _spawn(coro) -> asyncio.Task:
+    # держим ссылку на задачу, иначе её может собрать GC
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 @app.on_event("startup")
 async def _setup_logging_format():
     _enable_timestamps_in_uvicorn_logs()
-    
+
+# ─────────────────────────────── ОБЩИЕ HTTP-КЛИЕНТЫ ───────────────────────
+# Общие клиенты API на процесс сервера (в скриптах через asyncio.run — свои на каждый запуск)
+_shared_http: Optional[HttpClients] = None
+
+def _http_pool_stats() -> dict:
+    return _shared_http.stats()["pools"] if _shared_http else {}
+
+async def _warm_up_http(shared: HttpClients, connections: int):
+    # Открываем соединения заранее, чтобы первые задания не платили за TCP и TLS
+    names = [name for name, _ in parse_provider_weights(LLM_PROVIDERS)]
+    results = await asyncio.gather(
+        *(shared.pool(name).warm_up(str(shared_llm_client(shared, name).base_url), connections) for name in names),
+        return_exceptions=True)
+    for name, res in zip(names, results):
+        if isinstance(res, BaseException):
+            log.warning("Прогрев соединений %s не удался: %s", name, res)
+        else:
+            log.info("🔥 Прогрев %s: открыто соединений %d", name, res)
+
+async def start_http_clients():
+    # Старт приложения: общий пул соединений и клиенты SDK поверх него; app_openai вызывает то же
+    global _shared_http
+    if _shared_http is not None:
+        return
+    _shared_http = HttpClients(HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY, http2=HTTP2)
+    http_clients.install(_shared_http)
+    if _shared_http.http2_unavailable:
+        log.warning("HTTP2=1, но пакет h2 не установлен (pip install h2) — соединения по HTTP/1.1 с keep-alive")
+    if HTTP_WARMUP > 0:
+        _spawn(_warm_up_http(_shared_http, HTTP_WARMUP))
+
+async def stop_http_clients():
+    global _shared_http
+    shared, _shared_http = _shared_http, None
+    http_clients.install(None)
+    if shared is not None:
+        await shared.aclose()
+
+app.add_event_handler("startup", start_http_clients)
+app.add_event_handler("shutdown", stop_http_clients)
+
+@app.on_event("startup")
+async def _start_embedded_workers():
+    # Воркеры очереди внутри API-процесса (EMBEDDED_WORKERS=0 — только отдельные процессы worker.py)
+    for n in range(EMBEDDED_WORKERS):
+        _spawn(run_queue_worker(f"{socket.gethostname()}-{os.getpid()}-api{n}", WORKER_CONCURRENCY))
+
+async def _monitor_event_loop(interval: float):
+    # Долгие синхронные участки в корутинах видны как опоздание пробуждения после sleep
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        if lag > worst:
+            worst = lag
+            EVENT_LOOP_LAG_MAX.set(worst)
+
+@app.on_event("startup")
+async def _start_event_loop_monitor():
+    if EVENT_LOOP_MONITOR_INTERVAL > 0:
+        _spawn(_monitor_event_loop(EVENT_LOOP_MONITOR_INTERVAL))
+
 @app.post("/articles_generator")
-def articles_generator(req: GenerateRequest):
+async def articles_generator(req: GenerateRequest):
+    # в цикле сервера — чтобы запуск шёл через общий пул соединений
     try:
-        result = generate_articles(
+        result = await agenerate_articles(
             input_csv=Path(req.input_csv),
             groups_start=req.groups_start,
             groups_end=req.groups_end,
             save_html=req.save_html,
+            concurrency=req.concurrency,
+            tz_concurrency=req.tz_concurrency,
+            batch=req.batch,
+            use_cache=req.use_cache,
+            trace=req.trace,
+            output_format=req.output_format,
+            dedup=req.dedup,
+            providers=req.providers,
         )
         return {"ok": True, **result}
-    except FileNotFoundError as e:
+    except (FileNotFoundError, RuntimeError, ValueError) as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception:
         log.exception("Ошибка генерации")
         raise HTTPException(status_code=500, detail="Internal error")
 
+@app.post("/articles_generator_resume")
+async def articles_generator_resume(req: ResumeRequest):
+    try:
+        result = await aresume_job(req.job_id, concurrency=req.concurrency, use_cache=req.use_cache,
+                                   tz_concurrency=req.tz_concurrency, trace=req.trace)
+        return {"ok": True, **result}
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception:
+        log.exception("Ошибка генерации")
+        raise HTTPException(status_code=500, detail={"error": "Internal error", "job_id": req.job_id})
+
 @app.post("/articles_generator_upload")
 async def articles_generator_upload(
     background: BackgroundTasks,
@@ -426,22 +1694,37 @@ async def articles_generator_upload(
     groups_end: int | None = Form(None),
     save_html: bool = Form(False),
     keep_server_copy: bool = Form(True),
+    concurrency: int | None = Form(None),
+    tz_concurrency: int | None = Form(None),
+    batch: bool = Form(False),
+    use_cache: bool = Form(True),
+    trace: bool | None = Form(None),
+    output_format: Literal["csv", "jsonl", "parquet"] = Form("csv"),
+    dedup: bool | None = Form(None),
+    providers: str | None = Form(None),
 ):
     log.info(
         "UPLOAD start: %s, groups_start=%s, groups_end=%s, save_html=%s, keep=%s",
         file.filename, groups_start, groups_end, save_html, keep_server_copy
     )
-    tmp_name = f"{uuid.uuid4()}_{file.filename}"
-    tmp_path = BASE_DIR / tmp_name
-    with tmp_path.open("wb") as f:
-        f.write(await file.read())
+    job_id = uuid.uuid4().hex
+    tmp_path = await _save_upload_input(job_id, file)
 
     try:
-        result = generate_articles(
+        result = await agenerate_articles(
             input_csv=tmp_path,
             groups_start=groups_start,
             groups_end=groups_end,
             save_html=save_html,
+            concurrency=concurrency,
+            tz_concurrency=tz_concurrency,
+            batch=batch,
+            use_cache=use_cache,
+            job_id=job_id,
+            trace=trace,
+            output_format=output_format,
+            dedup=dedup,
+            providers=providers,
         )
         csv_path = Path(result["articles_csv"])
 
@@ -457,15 +1740,15 @@ async def articles_generator_upload(
 
         return FileResponse(
             csv_path,
-            media_type="text/csv",
-            filename="articles.csv",
+            media_type=MEDIA_TYPES[csv_path.suffix],
+            filename=csv_path.name,
             headers=headers,
             background=background,
         )
     except Exception:
-        try: os.remove(tmp_path)
-        except: pass
-        raise
+        # входной файл и журнал остаются — задание можно возобновить по job_id
+        log.exception("Ошибка генерации")
+        raise HTTPException(status_code=500, detail={"error": "Internal error", "job_id": job_id})
 
 @app.post("/articles_generator_stream_upload")
 async def articles_generator_stream_upload(
@@ -475,30 +1758,64 @@ async def articles_generator_stream_upload(
     groups_end: int | None = Form(None),
     save_html: bool = Form(False),
     keep_server_copy: bool = Form(True),
+    concurrency: int | None = Form(None),
+    tz_concurrency: int | None = Form(None),
+    batch: bool = Form(False),
+    use_cache: bool = Form(True),
+    trace: bool | None = Form(None),
+    stream_tokens: bool = Form(False),
+    cancel_on_disconnect: bool = Form(True),
+    output_format: Literal["csv", "jsonl", "parquet"] = Form("csv"),
+    dedup: bool | None = Form(None),
+    providers: str | None = Form(None),
 ):
     """
     Загружаем CSV и сразу стримим клиенту процесс обработки (логи + результат).
+    stream_tokens=true — дополнительно текст ТЗ и статей по мере генерации:
+      event: delta_start  data: {"group": i, "stage": "tz"|"article"}  — начало (или повтор) генерации, частичный текст сбросить
+      event: delta        data: {"group": i, "stage": "tz"|"article", "text": "..."}
+    События нумеруются (id); job_id — в заголовке X-Job-Id. После обрыва поток можно дочитать:
+    GET /articles_generator_stream/{job_id} с заголовком Last-Event-ID.
+    Если клиентов нет дольше SSE_ABANDON_SECONDS (cancel_on_disconnect=false — не отменять),
+    или вызван POST /articles_generator_stream/{job_id}/cancel, генерация останавливается:
+    data: {"_cancelled": "<причина>", "job_id": ...}; готовые группы — в журнале, продолжить
+    можно через /articles_generator_resume.
+    Готовые строки можно забирать, не дожидаясь конца: GET /jobs/{job_id}/rows?follow=true.
     """
-    tmp_name = f"{uuid.uuid4()}_{file.filename}"
-    tmp_path = BASE_DIR / tmp_name
-    with tmp_path.open("wb") as f:
-        f.write(await file.read())
+    job_id = uuid.uuid4().hex
+    tmp_path = await _save_upload_input(job_id, file)
 
-    q = Queue()
-    DONE = object()
+    stream = BROKER.open(job_id)
+    stream.publish("processing started", "start")
 
     def emit(line: str):
-        q.put(f"data: {line}\n\n")
+        stream.publish(line)
 
-    def worker():
+    def emit_delta(i: int, stage: str, text: Optional[str]):
+        if text is None:
+            stream.publish(json.dumps({"group": i, "stage": stage}, ensure_ascii=False), "delta_start")
+        else:
+            stream.publish(json.dumps({"group": i, "stage": stage, "text": text}, ensure_ascii=False), "delta")
+
+    async def worker():
         try:
             emit(f"INFO:     UPLOAD start: {file.filename}, groups_start={groups_start}, groups_end={groups_end}, save_html={save_html}, keep={keep_server_copy}")
-            result = generate_articles(
+            result = await agenerate_articles(
                 input_csv=tmp_path,
                 groups_start=groups_start,
                 groups_end=groups_end,
                 save_html=save_html,
-                client_emit=emit,         
+                client_emit=emit,
+                concurrency=concurrency,
+                tz_concurrency=tz_concurrency,
+                batch=batch,
+                use_cache=use_cache,
+                job_id=job_id,
+                trace=trace,
+                on_delta=emit_delta if stream_tokens else None,
+                output_format=output_format,
+                dedup=dedup,
+                providers=providers,
             )
             emit(json.dumps({
             "_result": {
@@ -506,53 +1823,306 @@ async def articles_generator_stream_upload(
                 "download_url": f"/download_once?path={result['articles_csv']}"
             }
         }, ensure_ascii=False))
+            try: os.remove(tmp_path)
+            except: pass
+        except asyncio.CancelledError:
+            reason = _cancel_reasons.get(job_id, "остановка сервера")
+            log.info("Стрим %s отменён: %s", job_id, reason)
+            emit(json.dumps({"_cancelled": reason, "job_id": job_id}, ensure_ascii=False))
+            raise
         except Exception as e:
-            emit(json.dumps({"_error": str(e)}, ensure_ascii=False))
+            # входной файл и журнал остаются — задание можно возобновить по job_id
+            emit(json.dumps({"_error": str(e), "job_id": job_id}, ensure_ascii=False))
         finally:
             if not keep_server_copy:
                 try: os.remove(result["articles_csv"])
                 except: pass
-            try: os.remove(tmp_path)
-            except: pass
-            q.put(DONE)
-
-    Thread(target=worker, daemon=True).start()
+            _stream_runs.pop(job_id, None)
+            _cancel_reasons.pop(job_id, None)
+            stream.publish("done", "end")
+            stream.close()
+
+    _stream_runs[job_id] = _spawn(worker())
+    if cancel_on_disconnect and SSE_ABANDON_SECONDS > 0:
+        _spawn(_cancel_when_abandoned(job_id, stream, SSE_ABANDON_SECONDS))
+
+    return _sse_response(stream, 0)
+
+def _sse_response(stream, last_event_id: int) -> StreamingResponse:
+    # X-Accel-Buffering: nginx не копит поток в буфере
+    return StreamingResponse(
+        stream.subscribe(last_event_id, heartbeat=SSE_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"X-Job-Id": stream.job_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    def gen():
-        yield "event: start\ndata: processing started\n\n"
+@app.get("/articles_generator_stream/{job_id}")
+async def articles_generator_stream(
+    job_id: str,
+    last_event_id: int | None = Query(None, description="номер последнего полученного события, если нельзя передать заголовок"),
+    last_event_id_header: str | None = Header(None, alias="Last-Event-ID"),
+):
+    """
+    Подписка на события задания, запущенного через /articles_generator_stream_upload:
+    переподключение после обрыва (досылаются события после Last-Event-ID, пока они в буфере)
+    или ещё один наблюдатель. Если часть событий вытеснена из буфера — event: gap {"missed": n}.
+    """
+    stream = BROKER.get(job_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Поток задания не найден (завершён давно или не существовал)")
+    if last_event_id is None and last_event_id_header:
+        try:
+            last_event_id = int(last_event_id_header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID должен быть числом")
+    return _sse_response(stream, last_event_id or 0)
+
+@app.post("/articles_generator_stream/{job_id}/cancel")
+async def articles_generator_stream_cancel(job_id: str):
+    if BROKER.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Поток задания не найден")
+    if not _cancel_run(job_id, "отменено по запросу"):
+        raise HTTPException(status_code=409, detail="Генерация уже завершена")
+    log.info("STREAM cancel requested: %s", job_id)
+    return {"job_id": job_id, "status": "cancelling"}
+
+
+
+def _create_queue_job(job_id: str, params: dict) -> Job:
+    # Пустой файл результата и запись start журнала — как у /articles_generator*; строки
+    # дописывают воркеры (_write_job_rows). Файлы и SQLite — синхронно, поэтому в потоке
+    writer = make_writer(params["output_format"], JOBS.job_dir(job_id))
+    try:
+        offset = writer.open()
+    finally:
+        writer.close()
+    journal = JobJournal(JOBS.job_dir(job_id) / "journal.jsonl")
+    journal.append({
+        "type": "start", "job_id": job_id, "queue": True, "input_csv": params["input_csv"],
+        "groups_start": params["groups_start"], "groups_end": params["groups_end"], "save_html": params["save_html"],
+        "out_csv": str(writer.path), "output_format": params["output_format"], "rows_path": str(writer.rows_path),
+        "offset": offset,
+    })
+    journal.close()
+    groups = iter_groups(Path(params["input_csv"]), params["groups_start"], params["groups_end"])
+    return JOBS.create(job_id, params, enumerate(groups, 1), writer.path, offset)
+
+@app.post("/jobs")
+async def submit_job(
+    file: UploadFile = File(...),
+    groups_start: int = Form(0),
+    groups_end: int | None = Form(None),
+    save_html: bool = Form(False),
+    use_cache: bool = Form(True),
+    trace: bool | None = Form(None),
+    output_format: Literal["csv", "jsonl", "parquet"] = Form("csv"),
+):
+    """
+    Ставит задание в очередь и сразу возвращает job_id; прогресс — GET /jobs/{job_id},
+    готовые строки по ходу — GET /jobs/{job_id}/rows, результат — GET /jobs/{job_id}/download.
+    Группы обрабатывают воркеры очереди.
+    """
+    job_id = uuid.uuid4().hex
+    input_path = await _save_upload_input(job_id, file)
+    try:
+        job = await asyncio.to_thread(_create_queue_job, job_id, {
+            "filename": file.filename,
+            "input_csv": str(input_path),
+            "groups_start": groups_start,
+            "groups_end": groups_end,
+            "save_html": save_html,
+            "use_cache": use_cache,
+            "trace": TRACE_JOBS if trace is None else trace,
+            "output_format": output_format,
+        })
+    except RuntimeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    log.info("JOB submitted: %s (%s, групп: %d)", job_id, file.filename, job.groups_total)
+    return {
+        **job.model_dump(),
+        "status_url": f"/jobs/{job_id}",
+        "download_url": f"/jobs/{job_id}/download",
+    }
+
+@app.get("/jobs")
+def list_jobs():
+    return [job.model_dump() for job in JOBS.list()]
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job.model_dump()
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    job = await asyncio.to_thread(JOBS.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    if job.status not in ("failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Задание в статусе {job.status}")
+    await asyncio.to_thread(JOBS.resume, job_id)
+    return (await asyncio.to_thread(JOBS.get, job_id)).model_dump()
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    # Новые группы не выдаются, группы в работе прерываются за QUEUE_CANCEL_CHECK_SECONDS;
+    # готовые строки остаются в CSV, продолжить — POST /jobs/{job_id}/resume
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    if not JOBS.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Задание в статусе {job.status}")
+    log.info("JOB cancelled: %s", job_id)
+    return JOBS.get(job_id).model_dump()
+
+@app.get("/jobs/{job_id}/download")
+async def job_download(job_id: str, accept_encoding: str | None = Header(None)):
+    job = await asyncio.to_thread(JOBS.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Задание ещё не готово: {job.status}")
+    path = Path(job.articles_csv)
+    return await asyncio.to_thread(file_response, path, MEDIA_TYPES.get(path.suffix, "application/octet-stream"),
+                                   path.name, accept_encoding)
+
+@app.get("/jobs/{job_id}/rows")
+async def job_rows(
+    job_id: str,
+    after: int = Query(0, description="номер (seq) последней полученной строки — отдать строки после неё"),
+    follow: bool = Query(False, description="ждать новые строки, пока генерация идёт"),
+):
+    """
+    Готовые строки запуска через /articles_generator* или задания очереди POST /jobs, пока
+    генерация ещё идёт: NDJSON, строка на группу —
+      {"seq": n, "group": i, "title": ..., "slug": ..., "tz": ..., "html": ...}
+    Формат файла результата не важен: границы строк берутся из журнала задания.
+    follow=true — держать соединение и досылать новые строки до конца генерации;
+    после обрыва продолжить с after=<seq последней строки>.
+    """
+    journal = JobJournal(JOBS_DIR / job_id / "journal.jsonl")
+    start_rec, _, _ = await asyncio.to_thread(journal.read)
+    if start_rec is None:
+        raise HTTPException(status_code=404, detail="Журнал задания не найден")
+    output_format = start_rec.get("output_format", "csv")
+    rows_path = Path(start_rec.get("rows_path", start_rec["out_csv"]))
+
+    def read_new(seq: int) -> tuple[list[str], int, bool]:
+        # Записи групп идут в журнале в порядке записи строк: строка seq — участок файла
+        # от смещения предыдущей записи до своего
+        _, groups, done = journal.read()
+        seq = min(seq, len(groups))
+        lines = []
+        prev = groups[seq - 1]["offset"] if seq else start_rec["offset"]
+        for n, rec in enumerate(groups[seq:], seq + 1):
+            if rec["offset"] > prev:
+                for row in read_rows(output_format, rows_path, prev, rec["offset"]):
+                    lines.append(json.dumps({"seq": n, "group": rec["i"], **row}, ensure_ascii=False) + "\n")
+            prev = rec["offset"]
+        return lines, len(groups), done is not None
+
+    def running() -> bool:
+        if job_id in _RUNNING_JOBS:
+            return True
+        job = JOBS.get(job_id)
+        return job is not None and job.status in ("queued", "running")
+
+    async def rows():
+        seq = max(0, after)
         while True:
-            item = q.get()
-            if item is DONE:
-                break
-            yield item
-        yield "event: end\ndata: done\n\n"
-
-    return StreamingResponse(gen(), media_type="text/event-stream")
-
-
-
-@app.get("/download")
-def download(path: str = Query(..., description="Абсолютный путь к файлу в контейнере")):
+            running_now = await asyncio.to_thread(running)
+            lines, seq, done = await asyncio.to_thread(read_new, seq)
+            for line in lines:
+                yield line
+            if done or not follow or not running_now:
+                return
+            await asyncio.sleep(ROWS_POLL_SECONDS)
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson",
+                             headers={"X-Job-Id": job_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}/trace")
+def job_trace(job_id: str):
+    # Трасса задания в формате Chrome trace (chrome://tracing, ui.perfetto.dev); и для /jobs, и для
+    # запусков через /articles_generator* (их job_id — в ответе)
+    path = JOBS_DIR / job_id / "trace.jsonl"
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Трасса не найдена (запуск без trace=true или TRACE_JOBS=1)")
+    return JSONResponse(load_chrome_trace(path),
+                        headers={"Content-Disposition": f'attachment; filename="trace-{job_id}.json"'})
+
+@app.get("/cache/stats")
+def cache_stats():
+    return RESPONSE_CACHE.stats()
+
+@app.get("/rate_limit/stats")
+def rate_limit_stats():
+    # Лимиты, остаток и расход по каждому ключу пула
+    return get_key_pool().stats()
+
+@app.get("/providers/stats")
+def provider_stats():
+    # Паузы, запросы, токены и стоимость по провайдерам LLM с запуска процесса
+    return {"configured": LLM_PROVIDERS, "providers": providers_stats()}
+
+@app.get("/http/stats")
+def http_stats():
+    # Общий пул соединений к API: запросы против новых соединений (reuse_ratio), версия HTTP, прогрев
+    if _shared_http is None:
+        return {"enabled": False}
+    return {"enabled": True, **_shared_http.stats()}
+
+@app.get("/metrics")
+def metrics():
+    # Формат Prometheus text exposition
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+def _download_path(path: str) -> Path:
     p = Path(path).resolve()
     base = BASE_DIR.resolve()
-    if not (p.exists() and (p == base or base in p.parents)):
+    if not (p.is_file() and (p == base or base in p.parents)):
         raise HTTPException(status_code=404, detail="Файл не найден")
-    return FileResponse(p, media_type="text/csv", filename=p.name)
+    return p
 
-@app.get("/download_once")
-def download_once(path: str = Query(..., description="Абсолютный путь к файлу в контейнере")):
-    p = Path(path).resolve()
-    base = BASE_DIR.resolve()
-    if not (p.exists() and (p == base or base in p.parents)):
-        raise HTTPException(status_code=404, detail="Файл не найден")
+@app.get("/download")
+async def download(
+    path: str = Query(..., description="Абсолютный путь к файлу в контейнере"),
+    accept_encoding: str | None = Header(None),
+):
+    # gzip/zstd по Accept-Encoding, докачка по Range; X-Content-SHA256 — сумма несжатого файла
+    p = _download_path(path)
+    media_type = MEDIA_TYPES.get(p.suffix, "application/octet-stream")
+    return await asyncio.to_thread(file_response, p, media_type, p.name, accept_encoding)
+
+# Отложенное удаление файлов /download_once: путь -> задача
+_pending_removals: dict[Path, asyncio.Task] = {}
+
+async def _remove_later(p: Path, delay: float):
+    await asyncio.sleep(delay)
+    _pending_removals.pop(p, None)
+    for f in (p, *compressed_copies(p)):
+        f.unlink(missing_ok=True)
+
+async def _schedule_removal(p: Path):
+    previous = _pending_removals.pop(p, None)
+    if previous is not None:
+        previous.cancel()
+    _pending_removals[p] = _spawn(_remove_later(p, DOWNLOAD_ONCE_GRACE_SECONDS))
 
-    # отдаём файл и планируем его удалить после отдачи
+@app.get("/download_once")
+async def download_once(
+    path: str = Query(..., description="Абсолютный путь к файлу в контейнере"),
+    accept_encoding: str | None = Header(None),
+):
+    p = _download_path(path)
+    # пока идёт (до)качка, файл не удаляем; после отдачи — через DOWNLOAD_ONCE_GRACE_SECONDS
+    previous = _pending_removals.pop(p, None)
+    if previous is not None:
+        previous.cancel()
     background = BackgroundTasks()
-    background.add_task(os.remove, p)
-
-    return FileResponse(
-        p,
-        media_type="text/csv",
-        filename=p.name,
-        background=background
-    )
\ No newline at end of file
+    background.add_task(_schedule_removal, p)
+
+    media_type = MEDIA_TYPES.get(p.suffix, "application/octet-stream")
+    return await asyncio.to_thread(file_response, p, media_type, p.name, accept_encoding, background=background)
@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ─────────────────────────────── ФЕЙКОВЫЙ LLM API ДЛЯ БЕНЧМАРКА ───────────────────────────────
+# Локальный сервер с ответами в формате Anthropic Messages (обычные, потоковые, Message Batches)
+# и OpenAI (chat.completions, responses). Задержка первого токена — логнормальная, дальше
+# текст идёт с заданной скоростью токенов в секунду; длина ответа — доля от max_tokens.
+# Можно включить случайные 429/5xx и лимиты RPM/TPM со скользящим окном в минуту и
+# заголовками anthropic-ratelimit-* — так проверяется ограничитель и повторы приложения.
+# Лимиты, как у настоящего API, считаются отдельно на каждый ключ (x-api-key / Bearer);
+# ключи из revoked_keys получают 401.
+# Запуск: python bench/fake_llm.py --port 9990 --config fake.json
+
+DEFAULT_CONFIG = {
+    "ttft_ms": 800.0,            # медиана задержки до первого токена
+    "ttft_sigma": 0.4,           # разброс логнормального распределения (0 — фиксированная задержка)
+    "tokens_per_second": 80.0,   # скорость выдачи выходных токенов
+    "output_ratio": 0.5,         # средняя длина ответа как доля max_tokens
+    "output_ratio_sigma": 0.15,
+    "max_output_tokens": 8000,   # потолок длины ответа
+    "chars_per_token": 3.0,      # сколько символов текста приходится на токен
+    "rate_429": 0.0,             # доля случайных 429 (помимо лимитов)
+    "rate_5xx": 0.0,             # доля ответов 500/529
+    "error_ms": 50.0,            # задержка перед ответом с ошибкой
+    "retry_after": 1.0,          # retry-after для случайных 429, секунды
+    "rpm": 0,                    # лимиты в минуту; 0 — без лимита
+    "input_tpm": 0,
+    "output_tpm": 0,
+    "revoked_keys": [],          # ключи, на которые отвечаем 401 (отозванный ключ)
+    "batch_seconds": 2.0,        # через сколько батч считается готовым
+    "time_scale": 1.0,           # множитель всех задержек (0.1 — в 10 раз быстрее)
+    "stamp_deltas": False,       # метка времени отправки в начале каждого потокового фрагмента
+    "seed": None,
+}
+
+# ⟦t=<unix time>⟧ в тексте фрагмента: клиент на той же машине считает задержку доставки
+STAMP_FORMAT = "⟦t={:.6f}⟧"
+
+WORDS = ("ремонт", "техника", "мастер", "деталь", "замена", "проверка", "схема", "плата", "напряжение",
+         "корпус", "инструмент", "диагностика", "сервис", "гарантия", "модель", "датчик")
+
+class FakeLLM:
+    def __init__(self, config: dict):
+        self.config = {**DEFAULT_CONFIG, **config}
+        self.rng = random.Random(self.config["seed"])
+        # по ключу: (время, входные, выходные) за последнюю минуту
+        self.windows: dict[str, deque[tuple[float, int, int]]] = {}
+        self.batches: dict[str, dict] = {}
+        self.in_flight = 0
+        self.reset_stats()
+
+    def reset_stats(self) -> dict:
+        old = getattr(self, "stats", None)
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "limit_exceeded": 0, "server_errors": 0,
+                      "input_tokens": 0, "output_tokens": 0, "peak_in_flight": 0, "by_endpoint": {},
+                      "by_key": {}}
+        return old
+
+    # ---------- распределения ----------
+    def _sleep_s(self, seconds: float) -> float:
+        return max(0.0, seconds) * self.config["time_scale"]
+
+    def ttft(self) -> float:
+        c = self.config
+        median = c["ttft_ms"] / 1000
+        return self._sleep_s(median * math.exp(self.rng.gauss(0, c["ttft_sigma"])) if c["ttft_sigma"] else median)
+
+    def output_tokens(self, max_tokens: int) -> int:
+        c = self.config
+        ratio = self.rng.gauss(c["output_ratio"], c["output_ratio_sigma"])
+        return max(1, min(int(max_tokens * min(max(ratio, 0.02), 1.0)), max_tokens, c["max_output_tokens"]))
+
+    def text(self, prompt: str, tokens: int) -> str:
+        # Стабильный заголовок от промпта (для slug), дальше слова до нужной длины
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+        size = int(tokens * self.config["chars_per_token"])
+        words, length = [], 0
+        while length < size:
+            w = self.rng.choice(WORDS)
+            words.append(w)
+            length += len(w) + 1
+        return f"<h1>Статья {digest}</h1>\n<p>{' '.join(words)}</p>"
+
+    @staticmethod
+    def input_tokens(body: dict) -> int:
+        return max(1, len(json.dumps(body, ensure_ascii=False)) // 3)
+
+    # ---------- лимиты ----------
+    def admit(self, key: str, in_tokens: int, out_tokens: int) -> tuple[Optional[float], dict]:
+        # None — запрос принят; иначе через сколько секунд повторить. Плюс заголовки остатка ключа
+        c = self.config
+        now = time.monotonic()
+        window = self.windows.setdefault(key, deque())
+        while window and now - window[0][0] >= 60:
+            window.popleft()
+        used = {"requests": len(window),
+                "input-tokens": sum(w[1] for w in window),
+                "output-tokens": sum(w[2] for w in window)}
+        limits = {"requests": c["rpm"], "input-tokens": c["input_tpm"], "output-tokens": c["output_tpm"]}
+        need = {"requests": 1, "input-tokens": in_tokens, "output-tokens": out_tokens}
+        reset_in = 60 - (now - window[0][0]) if window else 60.0
+        reset_at = (datetime.now(timezone.utc) + timedelta(seconds=reset_in)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        headers = {}
+        exceeded = False
+        for key, limit in limits.items():
+            if not limit:
+                continue
+            remaining = max(0, int(limit - used[key]))
+            headers[f"anthropic-ratelimit-{key}-limit"] = str(int(limit))
+            headers[f"anthropic-ratelimit-{key}-remaining"] = str(remaining)
+            headers[f"anthropic-ratelimit-{key}-reset"] = reset_at
+            # запрос больше всего лимита пропускаем на пустом окне, иначе он не пройдёт никогда
+            if used[key] + need[key] > limit and used[key] > 0:
+                exceeded = True
+        if exceeded:
+            return max(1.0, math.ceil(reset_in)), headers
+        window.append((now, in_tokens, out_tokens))
+        return None, headers
+
+    # ---------- общий путь запроса ----------
+    def _count(self, endpoint: str) -> None:
+        self.stats["requests"] += 1
+        self.stats["by_endpoint"][endpoint] = self.stats["by_endpoint"].get(endpoint, 0) + 1
+
+    async def fault(self, key: str, in_tokens: int, out_tokens: int,
+                    openai: bool) -> tuple[Optional[JSONResponse], dict]:
+        # Отозванный ключ, случайная ошибка или превышение лимита; иначе (None, заголовки лимитов)
+        c = self.config
+        self.stats["by_key"][key] = self.stats["by_key"].get(key, 0) + 1
+        if key in c["revoked_keys"]:
+            await asyncio.sleep(self._sleep_s(c["error_ms"] / 1000))
+            return _error(401, "authentication_error", "invalid x-api-key", openai), {}
+        roll = self.rng.random()
+        if roll < c["rate_5xx"]:
+            self.stats["server_errors"] += 1
+            await asyncio.sleep(self._sleep_s(c["error_ms"] / 1000))
+            status = self.rng.choice((500, 529))
+            kind = "overloaded_error" if status == 529 else "api_error"
+            return _error(status, kind, "Fake server error", openai), {}
+        if roll < c["rate_5xx"] + c["rate_429"]:
+            self.stats["rate_limited"] += 1
+            await asyncio.sleep(self._sleep_s(c["error_ms"] / 1000))
+            return _error(429, "rate_limit_error", "Fake rate limit", openai,
+                          {"retry-after": str(c["retry_after"])}), {}
+        retry_after, headers = self.admit(key, in_tokens, out_tokens)
+        if retry_after is not None:
+            self.stats["limit_exceeded"] += 1
+            return _error(429, "rate_limit_error", "Fake rate limit exceeded", openai,
+                          {**headers, "retry-after": str(int(retry_after))}), {}
+        return None, headers
+
+    def _done(self, in_tokens: int, out_tokens: int) -> None:
+        self.stats["ok"] += 1
+        self.stats["input_tokens"] += in_tokens
+        self.stats["output_tokens"] += out_tokens
+
+    def _enter(self) -> None:
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+
+def _error(status: int, kind: str, message: str, openai: bool, headers: Optional[dict] = None) -> JSONResponse:
+    if openai:
+        body = {"error": {"message": message, "type": kind, "code": kind}}
+    else:
+        body = {"type": "error", "error": {"type": kind, "message": message}}
+    return JSONResponse(body, status_code=status, headers=headers)
+
+def _anthropic_message(model: str, text: str, in_tokens: int, out_tokens: int) -> dict:
+    return {"id": "msg_" + uuid.uuid4().hex, "type": "message", "role": "assistant", "model": model,
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": in_tokens, "output_tokens": out_tokens,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}}
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def create_app(config: dict) -> FastAPI:
+    fake = FakeLLM(config)
+    app = FastAPI(title="Fake LLM API")
+    app.state.fake = fake
+
+    def _key(request: Request) -> str:
+        auth = request.headers.get("authorization", "")
+        return request.headers.get("x-api-key") or auth.removeprefix("Bearer ").strip()
+
+    def _prompt(body: dict) -> str:
+        return json.dumps(body.get("messages") or body.get("input") or "", ensure_ascii=False)
+
+    async def _generate(key: str, body: dict, max_tokens: int, openai: bool):
+        # Общая часть: учёт, ошибки/лимиты, задержка; возвращает ответ-ошибку или (текст, токены, заголовки)
+        in_tokens = fake.input_tokens(body)
+        out_tokens = fake.output_tokens(max_tokens)
+        failed, headers = await fake.fault(key, in_tokens, out_tokens, openai)
+        if failed is not None:
+            return failed
+        return fake.text(_prompt(body), out_tokens), in_tokens, out_tokens, headers
+
+    # ---------- Anthropic ----------
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        fake._count("messages.stream" if body.get("stream") else "messages")
+        fake._enter()
+        try:
+            result = await _generate(_key(request), body, int(body.get("max_tokens", 1024)), openai=False)
+        except BaseException:
+            fake.in_flight -= 1
+            raise
+        if isinstance(result, JSONResponse):
+            fake.in_flight -= 1
+            return result
+        text, in_tokens, out_tokens, headers = result
+        model = body.get("model", "fake")
+        tps = fake.config["tokens_per_second"]
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(fake.ttft() + fake._sleep_s(out_tokens / tps))
+                fake._done(in_tokens, out_tokens)
+            finally:
+                fake.in_flight -= 1
+            return JSONResponse(_anthropic_message(model, text, in_tokens, out_tokens), headers=headers)
+
+        async def events():
+            try:
+                start = _anthropic_message(model, "", in_tokens, 1)
+                start["content"] = []
+                yield _sse("message_start", {"type": "message_start", "message": start})
+                await asyncio.sleep(fake.ttft())
+                yield _sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                                   "content_block": {"type": "text", "text": ""}})
+                chunks = max(1, min(50, out_tokens // 20))
+                step = math.ceil(len(text) / chunks)
+                for n in range(0, len(text), step):
+                    await asyncio.sleep(fake._sleep_s(out_tokens / chunks / tps))
+                    piece = text[n:n + step]
+                    if fake.config["stamp_deltas"]:
+                        piece = STAMP_FORMAT.format(time.time()) + piece
+                    yield _sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                       "delta": {"type": "text_delta", "text": piece}})
+                yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+                yield _sse("message_delta", {"type": "message_delta",
+                                             "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                             "usage": {"output_tokens": out_tokens}})
+                yield _sse("message_stop", {"type": "message_stop"})
+                fake._done(in_tokens, out_tokens)
+            finally:
+                fake.in_flight -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    def _batch(request: Request, batch_id: str) -> dict:
+        b = fake.batches[batch_id]
+        done = time.monotonic() >= b["ready"]
+        n = len(b["requests"])
+        canceled = n if b.get("canceled") else 0
+        return {"id": batch_id, "type": "message_batch", "processing_status": "ended" if done else "in_progress",
+                "request_counts": {"processing": 0 if done else n, "succeeded": n - canceled if done else 0,
+                                   "errored": 0, "canceled": canceled, "expired": 0},
+                "created_at": b["created_at"], "expires_at": b["created_at"],
+                "ended_at": b["created_at"] if done else None, "archived_at": None,
+                "cancel_initiated_at": b["created_at"] if canceled else None,
+                "results_url": str(request.url_for("batch_results", batch_id=batch_id)) if done else None}
+
+    @app.post("/v1/messages/batches")
+    async def batch_create(request: Request):
+        body = await request.json()
+        fake._count("batches")
+        batch_id = "msgbatch_" + uuid.uuid4().hex
+        fake.batches[batch_id] = {"requests": body["requests"],
+                                  "ready": time.monotonic() + fake._sleep_s(fake.config["batch_seconds"]),
+                                  "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+        return _batch(request, batch_id)
+
+    @app.get("/v1/messages/batches/{batch_id}")
+    async def batch_get(request: Request, batch_id: str):
+        return _batch(request, batch_id)
+
+    @app.post("/v1/messages/batches/{batch_id}/cancel")
+    async def batch_cancel(request: Request, batch_id: str):
+        fake._count("batch_cancels")
+        fake.batches[batch_id].update(canceled=True, ready=time.monotonic())
+        return _batch(request, batch_id)
+
+    @app.get("/v1/messages/batches/{batch_id}/results", name="batch_results")
+    async def batch_results(batch_id: str):
+        lines = []
+        for r in fake.batches[batch_id]["requests"]:
+            params = r["params"]
+            in_tokens = fake.input_tokens(params)
+            out_tokens = fake.output_tokens(int(params.get("max_tokens", 1024)))
+            fake._done(in_tokens, out_tokens)
+            message = _anthropic_message(params.get("model", "fake"), fake.text(_prompt(params), out_tokens),
+                                         in_tokens, out_tokens)
+            lines.append(json.dumps({"custom_id": r["custom_id"], "result": {"type": "succeeded", "message": message}},
+                                    ensure_ascii=False) + "\n")
+        return StreamingResponse(iter(lines), media_type="application/binary")
+
+    # ---------- OpenAI ----------
+    async def _openai(key: str, body: dict, endpoint: str, max_tokens: int):
+        fake._count(endpoint)
+        fake._enter()
+        try:
+            result = await _generate(key, body, max_tokens, openai=True)
+            if isinstance(result, JSONResponse):
+                return result
+            text, in_tokens, out_tokens, _ = result
+            await asyncio.sleep(fake.ttft() + fake._sleep_s(out_tokens / fake.config["tokens_per_second"]))
+            fake._done(in_tokens, out_tokens)
+            return text, in_tokens, out_tokens
+        finally:
+            fake.in_flight -= 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        result = await _openai(_key(request), body, "chat.completions", int(body.get("max_tokens") or 1024))
+        if isinstance(result, JSONResponse):
+            return result
+        text, in_tokens, out_tokens = result
+        return {"id": "chatcmpl-" + uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": in_tokens, "completion_tokens": out_tokens,
+                          "total_tokens": in_tokens + out_tokens}}
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        result = await _openai(_key(request), body, "responses", int(body.get("max_output_tokens") or 1024))
+        if isinstance(result, JSONResponse):
+            return result
+        text, in_tokens, out_tokens = result
+        return {"id": "resp_" + uuid.uuid4().hex, "object": "response", "created_at": int(time.time()),
+                "model": body.get("model", "fake"), "status": "completed", "parallel_tool_calls": True,
+                "tool_choice": "auto", "tools": [],
+                "output": [{"type": "message", "id": "msg_" + uuid.uuid4().hex, "status": "completed",
+                            "role": "assistant",
+                            "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+                "usage": {"input_tokens": in_tokens, "output_tokens": out_tokens,
+                          "total_tokens": in_tokens + out_tokens,
+                          "input_tokens_details": {"cached_tokens": 0},
+                          "output_tokens_details": {"reasoning_tokens": 0}}}
+
+    # ---------- служебное ----------
+    @app.get("/stats")
+    def stats(reset: bool = False):
+        # Счётчики с момента запуска (или прошлого reset=true)
+        return fake.reset_stats() if reset else fake.stats
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый LLM API для бенчмарка")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9990)
+    parser.add_argument("--config", help="JSON с параметрами (ключи DEFAULT_CONFIG)")
+    args = parser.parse_args()
+    config = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        parser.error(f"неизвестные параметры: {', '.join(sorted(unknown))}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
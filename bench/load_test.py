@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from fake_llm import DEFAULT_CONFIG
+from run_bench import FAKE_FLAGS, REPO_DIR, _free_port, _git_commit, make_groups_csv, percentile, start_fake
+
+# ─────────────────────────────── НАГРУЗОЧНЫЙ ТЕСТ HTTP-СЛОЯ ───────────────────────────────
+# Поднимает app.py (uvicorn) против fake_llm.py и открывает много одновременных сессий как у
+# client_stream.py: загрузка CSV в /articles_generator_stream_upload с чтением SSE до конца,
+# затем GET /download_once. Фейк ставит метку времени в каждый потоковый фрагмент
+# (stamp_deltas), поэтому задержка доставки события — от отправки фрагмента фейком до
+# получения клиентом через SDK, конвейер и SSE. Память сервера, опоздание event loop и
+# открытые SSE-потоки снимаются с /metrics во время теста.
+# Пример: python bench/load_test.py --clients 50 --groups 2 --time-scale 0.2
+
+STAMP_RE = re.compile(r"⟦t=([0-9.]+)⟧")
+METRIC_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{([^}]*)\})? (\S+)$')
+
+@dataclass
+class LoadStats:
+    started: int = 0
+    connected: int = 0
+    completed: int = 0
+    failed: int = 0
+    downloaded: int = 0
+    open_streams: int = 0
+    peak_open_streams: int = 0
+    events: int = 0
+    download_bytes: int = 0
+    event_latencies: list[float] = field(default_factory=list)
+    first_event: list[float] = field(default_factory=list)
+    sessions: list[float] = field(default_factory=list)
+    downloads: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def error(self, text: str) -> None:
+        self.failed += 1
+        key = text[:120]
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+def parse_metrics(text: str) -> dict:
+    # {имя: {строка меток: значение}} — достаточно для своих gauge и гистограмм
+    out: dict[str, dict[str, float]] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = METRIC_RE.match(line)
+        if m:
+            out.setdefault(m.group(1), {})[m.group(2) or ""] = float(m.group(3))
+    return out
+
+def _single(metrics: dict, name: str) -> Optional[float]:
+    return metrics.get(name, {}).get("")
+
+def _histogram_quantile(first: dict, last: dict, name: str, q: float) -> Optional[float]:
+    # Верхняя граница корзины, в которую попадает квантиль наблюдений между двумя снимками
+    def buckets(snapshot):
+        return {float(labels.split('"')[1]) if "+Inf" not in labels else float("inf"): v
+                for labels, v in snapshot.get(name + "_bucket", {}).items()}
+    start, end = buckets(first), buckets(last)
+    if not end:
+        return None
+    counts = sorted((le, end[le] - start.get(le, 0.0)) for le in end)
+    total = counts[-1][1]
+    if total <= 0:
+        return None
+    for le, cumulative in counts:
+        if cumulative >= q * total:
+            return le
+    return None
+
+async def sample_metrics(client: httpx.AsyncClient, base_url: str, interval: float, samples: list, stop: asyncio.Event):
+    while True:
+        try:
+            r = await client.get(base_url + "/metrics", timeout=10)
+            samples.append((time.perf_counter(), parse_metrics(r.text)))
+        except httpx.HTTPError:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+async def session(n: int, client: httpx.AsyncClient, base_url: str, csv_bytes: bytes, form: dict,
+                  delay: float, stats: LoadStats, download: bool):
+    await asyncio.sleep(delay)
+    stats.started += 1
+    t0 = time.perf_counter()
+    result = None
+    ended = False
+    try:
+        files = {"file": (f"load_{n}.csv", csv_bytes, "text/csv")}
+        async with client.stream("POST", base_url + "/articles_generator_stream_upload", files=files, data=form) as r:
+            if r.status_code != 200:
+                await r.aread()
+                stats.error(f"HTTP {r.status_code}: {r.text[:80]}")
+                return
+            stats.connected += 1
+            stats.open_streams += 1
+            stats.peak_open_streams = max(stats.peak_open_streams, stats.open_streams)
+            try:
+                event = None
+                async for line in r.aiter_lines():
+                    if not line:
+                        event = None
+                        continue
+                    if line.startswith("event: "):
+                        event = line[7:]
+                        if event == "end":
+                            ended = True
+                        continue
+                    if not line.startswith("data: "):
+                        continue
+                    received = time.time()
+                    payload = line[6:]
+                    stats.events += 1
+                    if event == "start":
+                        stats.first_event.append(time.perf_counter() - t0)
+                    if event == "delta":
+                        for m in STAMP_RE.finditer(json.loads(payload)["text"]):
+                            stats.event_latencies.append(received - float(m.group(1)))
+                    elif event is None and payload.startswith("{"):
+                        try:
+                            obj = json.loads(payload)
+                        except ValueError:
+                            continue
+                        result = obj.get("_result", result)
+                        if "_error" in obj:
+                            stats.error(f"_error: {obj['_error']}")
+                            return
+            finally:
+                stats.open_streams -= 1
+        if not ended or result is None:
+            stats.error("поток закрыт без результата")
+            return
+        stats.sessions.append(time.perf_counter() - t0)
+        stats.completed += 1
+        if download:
+            d0 = time.perf_counter()
+            r = await client.get(base_url + "/download_once", params={"path": result["articles_csv"]})
+            if r.status_code != 200:
+                stats.error(f"download HTTP {r.status_code}")
+                return
+            stats.downloads.append(time.perf_counter() - d0)
+            stats.download_bytes += len(r.content)
+            stats.downloaded += 1
+    except httpx.HTTPError as e:
+        stats.error(f"{type(e).__name__}: {e}")
+
+def start_app(workdir: Path, fake_url: str, extra_env: dict) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    app_dir = workdir / "app"
+    app_dir.mkdir()
+    env = {**os.environ, "HOST_WORKDIR": str(app_dir), "ANTHROPIC_API_KEY": "bench",
+           "ANTHROPIC_BASE_URL": fake_url, **extra_env}
+    log = (workdir / "app.log").open("w", encoding="utf-8")
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+                             "--no-access-log", "--log-level", "warning"],
+                            cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app.py завершился с кодом {proc.returncode}, см. {workdir / 'app.log'}")
+        try:
+            httpx.get(base_url + "/metrics", timeout=2).raise_for_status()
+            return proc, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("app.py не ответил за 60 с")
+
+def _stop(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def _round(value, digits=3):
+    return None if value is None else round(value, digits)
+
+def _dist(values: list[float]) -> dict:
+    return {"p50": _round(percentile(values, 0.5)), "p95": _round(percentile(values, 0.95)),
+            "p99": _round(percentile(values, 0.99)), "max": _round(max(values) if values else None), "n": len(values)}
+
+async def run_load(args, base_url: str, csv_bytes: bytes) -> dict:
+    stats = LoadStats()
+    form = {"groups_start": "0", "save_html": "false", "keep_server_copy": "true",
+            "concurrency": str(args.concurrency), "use_cache": str(args.use_cache).lower(),
+            "stream_tokens": str(not args.no_stream_tokens).lower()}
+    limits = httpx.Limits(max_connections=args.clients * 2 + 4, max_keepalive_connections=args.clients * 2 + 4)
+    timeout = httpx.Timeout(args.timeout, connect=30)
+    samples: list = []
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        sampler = asyncio.create_task(sample_metrics(client, base_url, args.sample_interval, samples, stop))
+        await asyncio.sleep(args.sample_interval)  # исходный снимок до нагрузки
+        t0 = time.perf_counter()
+        await asyncio.gather(*(session(n, client, base_url, csv_bytes, form, args.ramp * n / args.clients,
+                                       stats, not args.no_download) for n in range(args.clients)))
+        wall = time.perf_counter() - t0
+        stop.set()
+        await sampler
+
+    first, last = (samples[0][1], samples[-1][1]) if samples else ({}, {})
+    rss = [_single(m, "process_resident_memory_bytes") for _, m in samples]
+    rss = [v / 1024 / 1024 for v in rss if v is not None]
+    sse = [_single(m, "articles_sse_streams") for _, m in samples]
+    sse = [v for v in sse if v is not None]
+    return {
+        "wall_s": _round(wall),
+        "connections": {"started": stats.started, "connected": stats.connected, "completed": stats.completed,
+                        "failed": stats.failed, "downloaded": stats.downloaded,
+                        "peak_open_client": stats.peak_open_streams,
+                        "peak_open_server": int(max(sse)) if sse else None},
+        "errors": stats.errors,
+        "events": stats.events,
+        "events_per_s": _round(stats.events / wall if wall else None, 1),
+        "event_latency_s": _dist(stats.event_latencies),
+        "first_event_s": _dist(stats.first_event),
+        "session_s": _dist(stats.sessions),
+        "download_s": {**_dist(stats.downloads), "bytes": stats.download_bytes},
+        "server": {
+            "rss_start_mb": _round(rss[0], 1) if rss else None,
+            "rss_peak_mb": _round(max(rss), 1) if rss else None,
+            "rss_end_mb": _round(rss[-1], 1) if rss else None,
+            "loop_lag_p99_le_s": _histogram_quantile(first, last, "articles_event_loop_lag_seconds", 0.99),
+            "loop_lag_max_s": _round(_single(last, "articles_event_loop_lag_max_seconds"), 4),
+            "metrics_samples": len(samples),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест SSE-загрузки и /download_once на фейковом LLM API")
+    parser.add_argument("--clients", type=int, default=50, help="одновременных сессий client_stream.py")
+    parser.add_argument("--ramp", type=float, default=2.0, help="за сколько секунд стартуют все сессии")
+    parser.add_argument("--groups", type=int, default=2, help="групп в CSV каждой сессии")
+    parser.add_argument("--keywords", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=2, help="параметр concurrency каждой загрузки")
+    parser.add_argument("--use-cache", action="store_true", help="не отключать кэш ответов (одинаковые CSV попадут в кэш)")
+    parser.add_argument("--no-stream-tokens", action="store_true", help="без stream_tokens — только логи и результат")
+    parser.add_argument("--no-download", action="store_true", help="не вызывать /download_once")
+    parser.add_argument("--timeout", type=float, default=600, help="таймаут чтения потока, секунды")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="как часто снимать /metrics")
+    parser.add_argument("--url", help="уже запущенный сервер (фейк и app не поднимаются)")
+    parser.add_argument("--fake-config", help="JSON с параметрами fake_llm (флаги ниже имеют приоритет)")
+    for key, type_ in FAKE_FLAGS.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type_, default=None,
+                            help=f"fake_llm: {key} (по умолчанию {DEFAULT_CONFIG[key]})")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменная окружения для app.py")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--out", default=str(Path(__file__).with_name("load_results.jsonl")))
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку (логи фейка и app)")
+    args = parser.parse_args()
+
+    fake_config = {"seed": args.seed, "stamp_deltas": True}
+    if args.fake_config:
+        with open(args.fake_config, encoding="utf-8") as f:
+            fake_config.update(json.load(f))
+    fake_config.update({k: getattr(args, k) for k in FAKE_FLAGS if getattr(args, k) is not None})
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    workdir = Path(tempfile.mkdtemp(prefix="articles-load-"))
+    input_csv = workdir / "groups.csv"
+    make_groups_csv(input_csv, args.groups, args.keywords, args.seed)
+    procs = []
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            fake, fake_url = start_fake(fake_config, workdir)
+            procs.append(fake)
+            app_proc, base_url = start_app(workdir, fake_url, extra_env)
+            procs.append(app_proc)
+        report = asyncio.run(run_load(args, base_url, input_csv.read_bytes()))
+    finally:
+        for proc in reversed(procs):
+            _stop(proc)
+        if args.keep:
+            print(f"Рабочая папка: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "git_commit": _git_commit(),
+        "params": {"clients": args.clients, "ramp": args.ramp, "groups": args.groups, "concurrency": args.concurrency,
+                   "use_cache": args.use_cache, "stream_tokens": not args.no_stream_tokens,
+                   "download": not args.no_download, "url": args.url, "env": extra_env},
+        "fake": None if args.url else {**DEFAULT_CONFIG, **fake_config},
+        **report,
+    }
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with out.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    c, lat, srv = report["connections"], report["event_latency_s"], report["server"]
+    print(f"Сессии: {c['completed']}/{c['started']} завершены, ошибок {c['failed']}, скачано {c['downloaded']}, "
+          f"пик открытых потоков {c['peak_open_client']} (сервер: {c['peak_open_server']})")
+    print(f"События: {report['events']} ({report['events_per_s']}/с) | доставка p50 {lat['p50']}s "
+          f"p95 {lat['p95']}s p99 {lat['p99']}s max {lat['max']}s")
+    print(f"Сервер: RSS {srv['rss_start_mb']} → пик {srv['rss_peak_mb']} МБ | опоздание event loop "
+          f"p99 ≤ {srv['loop_lag_p99_le_s']}s, max {srv['loop_lag_max_s']}s")
+    for text, n in report["errors"].items():
+        print(f"  ошибка ×{n}: {text}")
+    print(f"Результаты дописаны в {out}")
+    if c["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
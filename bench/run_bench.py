@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from fake_llm import DEFAULT_CONFIG
+
+# ─────────────────────────────── БЕНЧМАРК ГЕНЕРАЦИИ ───────────────────────────────
+# Прогоняет app.generate_articles и app_openai.generate_articles (тот же движок, провайдер OpenAI)
+# на синтетическом CSV против локального fake_llm.py (без сети и без расходов) и дописывает по строке JSON на каждый движок
+# в файл результатов — прогоны можно сравнивать между коммитами и настройками.
+# Каждый движок работает в отдельном процессе со своей рабочей папкой, поэтому пиковая память
+# (ru_maxrss) и процессорное время относятся только к нему.
+# Пример: python bench/run_bench.py --groups 40 --concurrency 8 --time-scale 0.2 --rate-429 0.02
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+ENGINES = ("app", "app_openai")
+
+# CLI-флаг → ключ конфигурации fake_llm
+FAKE_FLAGS = {
+    "ttft_ms": float, "ttft_sigma": float, "tokens_per_second": float, "output_ratio": float,
+    "output_ratio_sigma": float, "max_output_tokens": int, "rate_429": float, "rate_5xx": float,
+    "retry_after": float, "rpm": int, "input_tpm": int, "output_tpm": int, "batch_seconds": float,
+    "time_scale": float,
+}
+
+TOPICS = ("стиральная машина", "холодильник", "посудомоечная машина", "микроволновка", "пылесос",
+          "кондиционер", "бойлер", "телевизор", "ноутбук", "кофемашина", "варочная панель", "духовой шкаф")
+PROBLEMS = ("не включается", "не греет", "шумит", "течёт", "ошибка", "не сливает", "выбивает автомат",
+            "не отжимает", "замена подшипника", "чистка", "ремонт своими руками", "стоимость ремонта")
+
+def make_groups_csv(path: Path, groups: int, keywords: int, seed: int) -> None:
+    # Формат как у iceberg.csv: заголовок group, в строке «фраза:частотность; ...»
+    rng = random.Random(seed)
+    lines = ["group"]
+    for n in range(groups):
+        topic = TOPICS[n % len(TOPICS)]
+        problems = rng.sample(PROBLEMS, min(keywords, len(PROBLEMS)))
+        freqs = sorted((rng.randint(10, 20000) for _ in problems), reverse=True)
+        lines.append("; ".join(f"{topic} {p} {n}:{f}" for p, f in zip(problems, freqs)))
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    # Линейная интерполяция между соседними рангами
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=5) as r:
+        return json.load(r)
+
+def start_fake(config: dict, workdir: Path) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    config_path = workdir / "fake_config.json"
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+    log = (workdir / "fake_llm.log").open("w", encoding="utf-8")
+    proc = subprocess.Popen([sys.executable, str(Path(__file__).with_name("fake_llm.py")),
+                             "--port", str(port), "--config", str(config_path)],
+                            stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"fake_llm.py завершился с кодом {proc.returncode}, см. {workdir / 'fake_llm.log'}")
+        try:
+            _get_json(base_url + "/health")
+            return proc, base_url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("fake_llm.py не ответил за 20 с")
+
+def _run_engine(engine: str, workdir: str, input_csv: str, base_url: str, opts: dict, extra_env: dict, conn) -> None:
+    # Выполняется в отдельном процессе: окружение задаётся до импорта модуля (BASE_DIR и ключи читаются при импорте)
+    os.environ.update({
+        "HOST_WORKDIR": workdir,
+        "ANTHROPIC_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": base_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": base_url + "/v1",
+        **extra_env,
+    })
+    log_fd = os.open(os.path.join(workdir, f"{engine}.log"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    sys.path.insert(0, str(REPO_DIR))
+    result: dict = {}
+    try:
+        if engine == "app":
+            import app as module
+        else:
+            import app_openai as module
+            Path(workdir, "state.json").write_text(json.dumps({"vector_store_id": "vs_bench"}), encoding="utf-8")
+        from tracing import load_chrome_trace
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.perf_counter()
+        # app_openai — тот же движок с провайдером OpenAI (батчи есть только у Anthropic)
+        out = module.generate_articles(Path(input_csv), 0, None, concurrency=opts["concurrency"],
+                                       tz_concurrency=opts["tz_concurrency"],
+                                       batch=opts["batch"] and engine == "app",
+                                       use_cache=opts["use_cache"], job_id="bench", trace=True)
+        trace_path = Path(workdir, "jobs", "bench", "trace.jsonl")
+        latencies = [e["dur"] / 1_000_000 for e in load_chrome_trace(trace_path)["traceEvents"]
+                     if e.get("name") == "group" and e.get("ph") == "X"]
+        wall = time.perf_counter() - t0
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        result = {
+            "wall_s": wall,
+            "cpu_s": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+            "rss_start_mb": rss_start / 1024,
+            "peak_rss_mb": after.ru_maxrss / 1024,  # ru_maxrss в КБ на Linux
+            "latencies": latencies,
+            "groups_processed": out.get("groups_processed"),
+            "total_cost": out.get("total_cost"),
+        }
+    except BaseException as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        conn.send(result)
+        conn.close()
+
+def run_engine(engine: str, workdir: Path, input_csv: Path, base_url: str, opts: dict, extra_env: dict) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    engine_dir = workdir / engine
+    engine_dir.mkdir()
+    proc = ctx.Process(target=_run_engine,
+                       args=(engine, str(engine_dir), str(input_csv), base_url, opts, extra_env, child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {"error": "процесс движка завершился без результата"}
+    proc.join()
+    if result.get("error"):
+        result["log"] = str(engine_dir / f"{engine}.log")
+    return result
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _round(value, digits=3):
+    return None if value is None else round(value, digits)
+
+def summarize(engine: str, raw: dict, server: dict, groups: int) -> dict:
+    if raw.get("error"):
+        return {"engine": engine, "error": raw["error"], "log": raw.get("log"), "server": server}
+    lat = raw["latencies"]
+    wall = raw["wall_s"]
+    return {
+        "engine": engine,
+        "groups": raw["groups_processed"] or groups,
+        "wall_s": _round(wall),
+        "groups_per_min": _round((raw["groups_processed"] or groups) / wall * 60, 2),
+        "latency_s": {"p50": _round(percentile(lat, 0.5)), "p95": _round(percentile(lat, 0.95)),
+                      "max": _round(max(lat) if lat else None), "n": len(lat)},
+        "cpu_s": _round(raw["cpu_s"]),
+        "cpu_util": _round(raw["cpu_s"] / wall if wall else None),
+        "rss_start_mb": _round(raw["rss_start_mb"], 1),
+        "peak_rss_mb": _round(raw["peak_rss_mb"], 1),
+        "total_cost": raw["total_cost"],
+        "server": server,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк генерации статей на фейковом LLM API")
+    parser.add_argument("--engines", default="app,app_openai", help="через запятую: app, app_openai")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--keywords", type=int, default=6, help="ключей в группе")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tz-concurrency", type=int, default=None)
+    parser.add_argument("--batch", action="store_true", help="app через Message Batches")
+    parser.add_argument("--use-cache", action="store_true", help="не отключать кэш ответов")
+    parser.add_argument("--fake-config", help="JSON с параметрами fake_llm (флаги ниже имеют приоритет)")
+    for key, type_ in FAKE_FLAGS.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type_, default=None,
+                            help=f"fake_llm: {key} (по умолчанию {DEFAULT_CONFIG[key]})")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменная окружения для движков, например CLAUDE_MODEL_TZ=...")
+    parser.add_argument("--label", default="", help="метка прогона в результатах")
+    parser.add_argument("--out", default=str(Path(__file__).with_name("results.jsonl")))
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку (логи, CSV, трассы)")
+    args = parser.parse_args()
+
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    if bad := [e for e in engines if e not in ENGINES]:
+        parser.error(f"неизвестные движки: {', '.join(bad)}")
+    fake_config = {"seed": args.seed}
+    if args.fake_config:
+        with open(args.fake_config, encoding="utf-8") as f:
+            fake_config.update(json.load(f))
+    fake_config.update({k: getattr(args, k) for k in FAKE_FLAGS if getattr(args, k) is not None})
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    opts = {"concurrency": args.concurrency, "tz_concurrency": args.tz_concurrency,
+            "batch": args.batch, "use_cache": args.use_cache}
+
+    workdir = Path(tempfile.mkdtemp(prefix="articles-bench-"))
+    input_csv = workdir / "groups.csv"
+    make_groups_csv(input_csv, args.groups, args.keywords, args.seed)
+    fake, base_url = start_fake(fake_config, workdir)
+    records = []
+    try:
+        for engine in engines:
+            _get_json(base_url + "/stats?reset=true")
+            raw = run_engine(engine, workdir, input_csv, base_url, opts, extra_env)
+            summary = summarize(engine, raw, _get_json(base_url + "/stats"), args.groups)
+            records.append({
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "label": args.label,
+                "git_commit": _git_commit(),
+                "python": platform.python_version(),
+                "params": {**opts, "groups": args.groups, "keywords": args.keywords, "env": extra_env},
+                "fake": {**DEFAULT_CONFIG, **fake_config},
+                **summary,
+            })
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+        if args.keep:
+            print(f"Рабочая папка: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with out.open("a", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    for rec in records:
+        if rec.get("error"):
+            print(f"{rec['engine']:<11} ОШИБКА: {rec['error']}")
+            continue
+        lat = {k: "—" if v is None else f"{v}s" for k, v in rec["latency_s"].items()}
+        print(f"{rec['engine']:<11} {rec['groups_per_min']:>8.2f} групп/мин | "
+              f"p50 {lat['p50']} p95 {lat['p95']} | CPU {rec['cpu_s']}s ({rec['cpu_util']:.0%}) | "
+              f"пик RSS {rec['peak_rss_mb']} МБ | 429: {rec['server']['rate_limited'] + rec['server']['limit_exceeded']}, "
+              f"5xx: {rec['server']['server_errors']}")
+    print(f"Результаты дописаны в {out}")
+    if any(rec.get("error") for rec in records):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
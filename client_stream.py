@@ -1,6 +1,14 @@
 import requests, json, re
 import os
+import time
 import argparse
+import gzip
+import hashlib
+import urllib3
+try:
+    import zstandard  # необязательно: если установлен, файл придёт в zstd (меньше и быстрее gzip)
+except ImportError:
+    zstandard = None
 #❗❗❗эти параметры надо изменять (остальное не трогать!)--------------------❗❗❗
 INPUT_FILE = "iceberg.csv" # входной CSV-файл с ключевыми словами
 GROUPS_START = 0 # с какой группы начать (индексация с 0)
@@ -44,6 +52,17 @@ KEEP_SERVER_COPY = True  # важно!
 
 API_STREAM = "http://62.197.49.99:8001/articles_generator_stream_upload"
 API_DOWNLOAD = "http://62.197.49.99:8001/download_once"
+API_STREAM_RESUME = "http://62.197.49.99:8001/articles_generator_stream"
+
+# Обрыв связи: переподключаемся к тому же заданию и дочитываем события после последнего полученного.
+# Сервер шлёт ping каждые 15 с, поэтому 2 минуты тишины — это мёртвое соединение
+RECONNECT_ATTEMPTS = 20
+RECONNECT_DELAY = 5
+STREAM_TIMEOUT = (30, 120)
+# Скачивание результата: сжатый файл докачивается с места обрыва (Range), после распаковки
+# сверяется с контрольной суммой сервера (X-Content-SHA256)
+DOWNLOAD_ATTEMPTS = 20
+DOWNLOAD_CHUNK = 256 * 1024
 
 files = {"file": (INPUT_FILE, open(INPUT_FILE, "rb"), "text/csv")}
 data = {
@@ -55,14 +74,21 @@ if GROUPS_END is not None:
     data["groups_end"] = str(GROUPS_END)
 
 articles_csv_path = None
+last_event_id = None
 
-with requests.post(API_STREAM, files=files, data=data, stream=True, timeout=3600) as r:
-    r.raise_for_status()
+
+def read_stream(r):
+    """Печатает логи из потока; True — сервер дослал поток до конца (event: end)."""
+    global articles_csv_path, last_event_id
     for raw in r.iter_lines():
         if not raw:
             continue
         line = raw.decode("utf-8")
-        if line.startswith("data: "):
+        if line.startswith("id: "):
+            last_event_id = line[4:]
+        elif line.startswith("event: end"):
+            return True
+        elif line.startswith("data: "):
             payload = line[6:]
             print(payload)  # печатаем логи как есть
             # ловим финальную строку с результатом
@@ -73,14 +99,100 @@ with requests.post(API_STREAM, files=files, data=data, stream=True, timeout=3600
                         articles_csv_path = obj["_result"]["articles_csv"]
                 except json.JSONDecodeError:
                     pass
+    return False
+
+
+finished = False
+with requests.post(API_STREAM, files=files, data=data, stream=True, timeout=STREAM_TIMEOUT) as r:
+    r.raise_for_status()
+    job_id = r.headers.get("X-Job-Id")
+    try:
+        finished = read_stream(r)
+    except requests.RequestException as e:
+        print(f"⚠️ Соединение прервано: {e}")
+
+attempt = 0
+while not finished and job_id and attempt < RECONNECT_ATTEMPTS:
+    attempt += 1
+    print(f"🔄 Переподключение к заданию {job_id} ({attempt}/{RECONNECT_ATTEMPTS})...")
+    time.sleep(RECONNECT_DELAY)
+    headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+    try:
+        with requests.get(f"{API_STREAM_RESUME}/{job_id}", headers=headers, stream=True, timeout=STREAM_TIMEOUT) as r:
+            if r.status_code == 404:
+                print("Сервер больше не хранит поток задания.")
+                break
+            r.raise_for_status()
+            finished = read_stream(r)
+    except requests.RequestException as e:
+        print(f"⚠️ Соединение прервано: {e}")
 
 if not articles_csv_path:
     raise SystemExit("Не получил путь к файлу из стрима (_result.articles_csv).")
 
+def download(url, params, dest):
+    """Качает файл в dest + ".part" (сжатые байты как есть), докачивает после обрыва,
+    затем распаковывает в dest и проверяет SHA-256."""
+    part, meta_path = dest + ".part", dest + ".part.json"
+    meta = {}
+    if os.path.exists(part) and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+    else:
+        open(part, "wb").close()
+    accept = "zstd, gzip" if zstandard is not None else "gzip"
+
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        have = os.path.getsize(part)
+        headers = {"Accept-Encoding": accept}
+        if have and meta.get("etag"):
+            # If-Range: если файл на сервере изменился, придёт целиком (200), а не кусок
+            headers.update({"Range": f"bytes={have}-", "If-Range": meta["etag"]})
+        try:
+            with requests.get(url, params=params, headers=headers, stream=True, timeout=STREAM_TIMEOUT) as r:
+                if r.status_code == 416:
+                    break  # уже скачано целиком
+                r.raise_for_status()
+                if r.status_code == 200:
+                    have = 0
+                    meta = {"etag": r.headers.get("ETag"), "encoding": r.headers.get("Content-Encoding", ""),
+                            "sha256": r.headers.get("X-Content-SHA256")}
+                    with open(meta_path, "w", encoding="utf-8") as f:
+                        json.dump(meta, f)
+                elif have:
+                    print(f"⏩ Докачка с {have} байт")
+                with open(part, "r+b" if have else "wb") as f:
+                    f.seek(have)
+                    # decode_content=False — пишем сжатые байты, чтобы докачка совпадала по смещениям
+                    for chunk in r.raw.stream(DOWNLOAD_CHUNK, decode_content=False):
+                        f.write(chunk)
+            break
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            print(f"⚠️ Скачивание прервано ({attempt}/{DOWNLOAD_ATTEMPTS}): {e}")
+            time.sleep(RECONNECT_DELAY)
+    else:
+        raise SystemExit("Не удалось скачать файл — запустите клиент ещё раз, загрузка продолжится.")
+
+    encoding = meta.get("encoding", "")
+    with open(part, "rb") as raw, open(dest, "wb") as out:
+        if encoding == "zstd":
+            src = zstandard.ZstdDecompressor().stream_reader(raw)
+        elif encoding == "gzip":
+            src = gzip.GzipFile(fileobj=raw)
+        else:
+            src = raw
+        digest = hashlib.sha256()
+        while (chunk := src.read(DOWNLOAD_CHUNK)):
+            digest.update(chunk)
+            out.write(chunk)
+    os.remove(part)
+    os.remove(meta_path)
+    if meta.get("sha256") and digest.hexdigest() != meta["sha256"]:
+        os.remove(dest)
+        raise SystemExit("Контрольная сумма не совпала — файл повреждён, запустите скачивание ещё раз.")
+
+
 # Скачиваем файл отдельным GET
-resp = requests.get(API_DOWNLOAD, params={"path": articles_csv_path}, timeout=3600)
-resp.raise_for_status()
-with open("articles.csv", "wb") as f:
-    f.write(resp.content)
+download(API_DOWNLOAD, {"path": articles_csv_path}, "articles.csv")
 
 print("✅ Сохранено: articles.csv")
\ No newline at end of file
@@ -1,14 +1,16 @@
+import time
+
 import requests
 
 # Основные параметры
-API_URL = "http://62.197.49.99:8001/articles_generator_upload"
+API_URL = "http://62.197.49.99:8001"
 INPUT_FILE = "iceberg.csv"   # входной CSV-файл с ключевыми словами
 OUTPUT_FILE = "articles.csv" # куда сохранить результат
 GROUPS_START = 0             # с какой группы начать (индексация с 0)
 GROUPS_END = 1               # до какой группы (не включительно), None — до конца
 SAVE_HTML = False            # сохранять ли отдельные HTML-файлы
-KEEP_SERVER_COPY = False     # оставлять ли итоговый файл на сервере
-TIMEOUT = 3600               # таймаут на запрос в секундах
+POLL_INTERVAL = 15           # как часто спрашивать статус задания, секунд
+TIMEOUT = 60                 # таймаут на отдельный запрос в секундах
 
 # Формируем данные для POST-запроса
 files = {"file": (INPUT_FILE, open(INPUT_FILE, "rb"), "text/csv")}
@@ -16,19 +18,32 @@ data = {
     "groups_start": str(GROUPS_START),
     "groups_end": str(GROUPS_END) if GROUPS_END is not None else "",
     "save_html": str(SAVE_HTML).lower(),
-    "keep_server_copy": str(KEEP_SERVER_COPY).lower(),
 }
 
-# Отправляем запрос
-with requests.post(API_URL, files=files, data=data, stream=True, timeout=TIMEOUT) as r:
-    r.raise_for_status()
+# Ставим задание в очередь — сервер сразу отвечает job_id
+r = requests.post(f"{API_URL}/jobs", files=files, data=data, timeout=TIMEOUT)
+r.raise_for_status()
+job_id = r.json()["job_id"]
+print(f"Задание поставлено в очередь: {job_id}")
 
-    groups = r.headers.get("X-Groups-Processed", "?")
-    total = r.headers.get("X-Total-Cost", "?")
+# Ждём завершения, периодически спрашивая статус
+while True:
+    time.sleep(POLL_INTERVAL)
+    job = requests.get(f"{API_URL}/jobs/{job_id}", timeout=TIMEOUT).json()
+    print(f"{job['status']}: {job['groups_done']}/{job['groups_total']} групп, сумма ${job['total_cost']}")
+    if job["status"] == "done":
+        break
+    if job["status"] in ("failed", "cancelled"):
+        reason = f": {job['error']}" if job.get("error") else ""
+        raise SystemExit(f"Задание {job_id} завершилось со статусом {job['status']}{reason}. "
+                         f"Продолжить: POST {API_URL}/jobs/{job_id}/resume")
 
+# Скачиваем результат
+with requests.get(f"{API_URL}/jobs/{job_id}/download", stream=True, timeout=TIMEOUT) as r:
+    r.raise_for_status()
     with open(OUTPUT_FILE, "wb") as f:
         for chunk in r.iter_content(1 << 14):
             if chunk:
                 f.write(chunk)
 
-print(f"Обработано статей: {groups}. Итоговая сумма: ${total}")
\ No newline at end of file
+print(f"Обработано статей: {job['groups_done']}. Итоговая сумма: ${job['total_cost']}")
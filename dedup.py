@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import re
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+# ─────────────────────────────── ДЕДУПЛИКАЦИЯ ГРУПП ───────────────────────────────
+# До генерации: ключи нормализуются (регистр, ё→е, пунктуация, порядок слов), и группа
+# считается дублем более ранней группы, если
+#   exact — совпадает нормализованный главный запрос (первый ключ группы);
+#   near  — множества ключей пересекаются почти целиком: Jaccard ≥ threshold.
+# Точный дубль не генерируется — в результат идёт копия строки первой (представительной) группы.
+# Похожие (near) по умолчанию только отмечаются в отчёте и генерируются как обычно; схлопывать
+# их так же, как точные, — collapse_near=True.
+# Сравниваем только с представителями (не с дублями) через индекс «ключ → группы»,
+# поэтому проверяются лишь группы с общими ключами, а не все пары.
+
+_NON_WORD = re.compile(r"[\W_]+", re.U)
+
+def normalize_keyword(text: str) -> str:
+    words = _NON_WORD.sub(" ", text.lower().replace("ё", "е")).split()
+    return " ".join(sorted(words))
+
+class DedupPlan:
+    def __init__(self, threshold: float, collapse_near: bool = False):
+        self.threshold = threshold
+        self.collapse_near = collapse_near
+        self.groups = 0
+        self.duplicates: dict[int, dict] = {}  # i -> {"of", "kind", "jaccard", "main_query"} — не генерируются
+        self.flagged: dict[int, dict] = {}     # похожие, которые только отмечены (генерируются)
+        self.followers: Counter = Counter()    # представитель -> сколько дублей после него
+
+    @property
+    def exact(self) -> int:
+        return sum(1 for d in self.duplicates.values() if d["kind"] == "exact")
+
+    @property
+    def near(self) -> int:
+        return len(self.duplicates) - self.exact
+
+    @property
+    def llm_calls_saved(self) -> int:
+        return 2 * len(self.duplicates)  # ТЗ + статья на группу
+
+    def summary(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "groups": self.groups,
+            "unique": self.groups - len(self.duplicates),
+            "exact": self.exact,
+            "near": self.near,
+            "near_flagged": len(self.flagged),
+            "collapse_near": self.collapse_near,
+            "llm_calls_saved": self.llm_calls_saved,
+        }
+
+    def report(self) -> dict:
+        return {
+            **self.summary(),
+            "duplicates": [{"group": i, "duplicate_of": d["of"], "kind": d["kind"], "jaccard": d["jaccard"],
+                            "main_query": d["main_query"], "collapsed": i in self.duplicates}
+                           for i, d in sorted({**self.duplicates, **self.flagged}.items())],
+        }
+
+def plan_dedup(groups: Iterable[tuple[int, list[str]]], threshold: float = 0.9,
+               collapse_near: bool = False) -> DedupPlan:
+    # groups — (номер группы, ключи по порядку); группы без ключей не участвуют.
+    # threshold <= 0 — только точные совпадения главного запроса
+    plan = DedupPlan(threshold, collapse_near)
+    by_main: dict[str, int] = {}
+    index: dict[str, list[int]] = defaultdict(list)
+    sizes: dict[int, int] = {}
+    for i, keywords in groups:
+        plan.groups += 1
+        normalized = [k for k in map(normalize_keyword, keywords) if k]
+        if not normalized:
+            continue
+        main, keys = normalized[0], set(normalized)
+
+        rep: Optional[int] = by_main.get(main)
+        kind, score = "exact", None
+        if rep is None and threshold > 0:
+            shared = Counter(r for k in keys for r in index.get(k, ()))
+            best = None
+            for r, n in shared.items():
+                jaccard = n / (len(keys) + sizes[r] - n)
+                if jaccard >= threshold and (best is None or jaccard > best[1]):
+                    best = (r, jaccard)
+            if best is not None:
+                rep, score, kind = best[0], best[1], "near"
+
+        if rep is not None:
+            # у точного дубля совпал главный запрос, Jaccard не считаем
+            match = {"of": rep, "kind": kind, "jaccard": score and round(score, 4), "main_query": keywords[0]}
+            if kind == "exact" or collapse_near:
+                plan.duplicates[i] = match
+                plan.followers[rep] += 1
+                continue
+            # похожая группа только отмечена: генерируется и сама становится представителем
+            plan.flagged[i] = match
+        by_main[main] = i
+        sizes[i] = len(keys)
+        for k in keys:
+            index[k].append(i)
+    return plan
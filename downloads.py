@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import shutil
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from fastapi.responses import FileResponse
+
+try:
+    import zstandard
+except ImportError:  # zstd — необязательная зависимость, без неё отдаём gzip
+    zstandard = None
+
+# ─────────────────────────────── СКАЧИВАНИЕ ФАЙЛОВ ───────────────────────────────
+# Сжатие по Accept-Encoding (zstd, если установлен zstandard, иначе gzip). Сжатая копия
+# пишется один раз рядом с файлом (articles.csv.gz / .zst) с тем же mtime, что у оригинала,
+# и отдаётся как обычный файл — поэтому Range/If-Range работают и для сжатого ответа:
+# клиент докачивает сырые (сжатые) байты и распаковывает их у себя. Изменился оригинал —
+# копия пересоздаётся, ETag меняется, и If-Range заставит клиента начать заново.
+# X-Content-SHA256 — контрольная сумма исходного (несжатого) файла для проверки у клиента.
+
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+# уже сжатые форматы не жмём повторно
+INCOMPRESSIBLE = {".parquet", ".gz", ".zst", ".zip"}
+CHUNK_SIZE = 1024 * 1024
+
+def available_encodings() -> tuple[str, ...]:
+    return ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    # Accept-Encoding: "gzip, zstd;q=0.9" — берём лучшую по q; при равенстве — наш порядок
+    offered: dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = offered.get(encoding, offered.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+@lru_cache(maxsize=256)
+def _sha256(path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while (chunk := f.read(CHUNK_SIZE)):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path: Path) -> str:
+    st = path.stat()
+    return _sha256(str(path), st.st_size, st.st_mtime_ns)
+
+def compressed_copy(path: Path, encoding: str) -> Path:
+    # Копия актуальна, пока её mtime совпадает с mtime оригинала
+    st = path.stat()
+    target = path.with_name(path.name + SUFFIXES[encoding])
+    if target.exists() and target.stat().st_mtime_ns == st.st_mtime_ns:
+        return target
+    tmp = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with path.open("rb") as src, tmp.open("wb") as raw:
+            if encoding == "zstd":
+                with zstandard.ZstdCompressor(level=6).stream_writer(raw, closefd=False) as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            else:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return target
+
+def compressed_copies(path: Path) -> list[Path]:
+    return [path.with_name(path.name + suffix) for suffix in SUFFIXES.values()]
+
+def file_response(path: Path, media_type: str, filename: str, accept_encoding: Optional[str] = None,
+                  min_size: int = 1024, background=None) -> FileResponse:
+    # Вызывать из потока (to_thread): сжатие и контрольная сумма читают файл целиком
+    headers = {"X-Content-SHA256": file_sha256(path), "Vary": "Accept-Encoding"}
+    body = path
+    encoding = choose_encoding(accept_encoding)
+    if encoding and path.suffix not in INCOMPRESSIBLE and path.stat().st_size >= min_size:
+        try:
+            body = compressed_copy(path, encoding)
+            headers["Content-Encoding"] = encoding
+        except OSError:
+            body = path  # папка только для чтения — отдаём как есть
+    return FileResponse(body, media_type=media_type, filename=filename, headers=headers, background=background)
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Callable, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401 — HTTP/2 в httpx работает только с пакетом h2
+except ImportError:  # без h2 — HTTP/1.1 с keep-alive
+    h2 = None
+
+# ─────────────────────────────── ОБЩИЕ HTTP-КЛИЕНТЫ ───────────────────────────────
+# Один httpx-клиент (пул соединений) на API-сервис на весь процесс API: его создаёт старт
+# приложения, закрывает остановка, а клиенты SDK (AsyncAnthropic, AsyncOpenAI) строятся
+# поверх него один раз. Задания не открывают соединения заново: TLS-рукопожатие платит
+# только первый запрос (или прогрев при старте), дальше соединения переиспользуются
+# (keep-alive; по HTTP/2 — ещё и мультиплексирование запросов в одном соединении).
+# Пул httpx привязан к event loop, поэтому общие клиенты отдаются только корутинам цикла,
+# в котором они созданы; запуски через asyncio.run (скрипты) создают клиентов на запуск.
+# Статистика — по трассировке httpcore: новые TCP-соединения и TLS-рукопожатия против
+# числа запросов, версия HTTP и состояние пула.
+
+class HttpPool:
+    def __init__(self, name: str, limits: httpx.Limits, http2: bool, timeout: httpx.Timeout):
+        self.name = name
+        self.http2 = http2
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.by_version: dict[str, int] = {"HTTP/1.1": 0, "HTTP/2": 0}
+        self.warmed_up = 0
+        self.client = httpx.AsyncClient(limits=limits, http2=http2, timeout=timeout,
+                                        event_hooks={"request": [self._on_request]})
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event: str, info: dict) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+        elif event == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+        elif event == "http11.send_request_headers.started":
+            self.by_version["HTTP/1.1"] += 1
+        elif event == "http2.send_request_headers.started":
+            self.by_version["HTTP/2"] += 1
+
+    def _connections(self) -> list:
+        # Состояние пула httpcore — не публичное API httpx: при смене версии просто без него
+        try:
+            return list(self.client._transport._pool.connections)
+        except AttributeError:
+            return []
+
+    async def warm_up(self, url: str, connections: int = 1) -> int:
+        # Заранее открыть соединения (TCP + TLS): любые ответы сервера подходят, ошибки не страшны.
+        # По HTTP/2 достаточно одного соединения — запросы мультиплексируются
+        n = 1 if self.http2 else max(1, connections)
+        results = await asyncio.gather(*(self.client.head(url) for _ in range(n)), return_exceptions=True)
+        ok = sum(1 for r in results if not isinstance(r, BaseException))
+        self.warmed_up += ok
+        return ok
+
+    def stats(self) -> dict:
+        conns = self._connections()
+        reused = max(0, self.requests - self.connections_opened)
+        return {
+            "http2": self.http2,
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_requests": reused,
+            "reuse_ratio": round(reused / self.requests, 3) if self.requests else None,
+            "requests_by_version": dict(self.by_version),
+            "warmed_up": self.warmed_up,
+            "open_connections": len(conns),
+            "idle_connections": sum(1 for c in conns if c.is_idle()),
+        }
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+class HttpClients:
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 60.0,
+                 http2: bool = True, connect_timeout: float = 5.0, read_timeout: float = 600.0):
+        # http2=True без пакета h2 — HTTP/1.1 (см. http2_unavailable)
+        self.loop = asyncio.get_running_loop()
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.http2_unavailable = http2 and h2 is None
+        self.http2 = http2 and h2 is not None
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.pools: dict[str, HttpPool] = {}
+        self._sdk: dict[str, object] = {}
+
+    def pool(self, name: str) -> HttpPool:
+        if name not in self.pools:
+            self.pools[name] = HttpPool(name, self.limits, self.http2, self.timeout)
+        return self.pools[name]
+
+    def sdk(self, name: str, factory: Callable[[httpx.AsyncClient], object]):
+        # Клиент SDK поверх общего пула name — создаётся один раз; закрывать его нельзя
+        # (закроется и общий пул), это делает aclose
+        if name not in self._sdk:
+            self._sdk[name] = factory(self.pool(name).client)
+        return self._sdk[name]
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "pools": {name: pool.stats() for name, pool in self.pools.items()},
+        }
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*(pool.aclose() for pool in self.pools.values()), return_exceptions=True)
+        self.pools.clear()
+        self._sdk.clear()
+
+_current: Optional[HttpClients] = None
+_sync_client: Optional[httpx.Client] = None
+_sync_lock = threading.Lock()
+
+def install(clients: Optional[HttpClients]) -> None:
+    global _current
+    _current = clients
+
+def current() -> Optional[HttpClients]:
+    # Общие клиенты, если они созданы в этом же event loop; иначе None — клиенты на запуск
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    return _current if _current is not None and _current.loop is loop else None
+
+def sync_client(max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 60.0,
+                connect_timeout: float = 5.0, read_timeout: float = 600.0) -> httpx.Client:
+    # Синхронный httpx.Client потокобезопасен и не привязан к event loop — один на процесс
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is None:
+            _sync_client = httpx.Client(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                    keepalive_expiry=keepalive_expiry),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        return _sync_client
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import json
+import random
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+
+from pydantic import BaseModel
+
+# ─────────────────────────────── РЕЕСТР И ОЧЕРЕДЬ ЗАДАНИЙ ───────────────────────────────
+# Всё состояние — в SQLite (BASE_DIR/queue.db), поэтому задания переживают перезапуск
+# контейнера, а обрабатывать их могут несколько процессов-воркеров одновременно.
+#   jobs  — одно задание = один загруженный CSV и диапазон групп;
+#   tasks — одна группа ключей; воркер берёт её в аренду (lease) на LEASE_SECONDS и
+#           продлевает аренду, пока работает. Если воркер умер, аренда истекает и группу
+#           забирает другой воркер. Группа с ошибкой возвращается в очередь не сразу, а после
+#           паузы retry_at (экспоненциально по номеру попытки).
+# Готовые строки дописываются в выходной файл строго по порядку групп (rows_written/out_offset);
+# писать файл задания в каждый момент может только один воркер (flush_token/flush_until).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id       TEXT PRIMARY KEY,
+    status       TEXT NOT NULL,
+    params       TEXT NOT NULL,
+    created_at   TEXT NOT NULL,
+    started_at   TEXT,
+    finished_at  TEXT,
+    groups_total INTEGER NOT NULL DEFAULT 0,
+    groups_done  INTEGER NOT NULL DEFAULT 0,
+    total_cost   REAL NOT NULL DEFAULT 0,
+    articles_csv TEXT,
+    error        TEXT,
+    rows_written INTEGER NOT NULL DEFAULT 0,
+    out_offset   INTEGER NOT NULL DEFAULT 0,
+    flush_token  TEXT,
+    flush_until  REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    job_id      TEXT NOT NULL,
+    idx         INTEGER NOT NULL,
+    block       TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    retry_at    REAL,
+    worker      TEXT,
+    result      TEXT,
+    cost        REAL NOT NULL DEFAULT 0,
+    error       TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (job_id, status, idx);
+"""
+
+class Job(BaseModel):
+    job_id: str
+    status: str = "queued"  # queued | running | done | failed | cancelled
+    params: dict = {}
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    groups_total: int = 0
+    groups_done: int = 0
+    total_cost: float = 0.0
+    articles_csv: Optional[str] = None
+    error: Optional[str] = None
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class JobRegistry:
+    def __init__(self, root: Path, db_path: Path, lease_seconds: int = 300, max_attempts: int = 5,
+                 retry_backoff: float = 15.0, retry_backoff_max: float = 600.0):
+        self.root = root
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            # базы, созданные до появления этих колонок
+            for table, column, kind in (("tasks", "retry_at", "REAL"), ("jobs", "flush_token", "TEXT"),
+                                        ("jobs", "flush_until", "REAL")):
+                if column not in {r["name"] for r in db.execute(f"PRAGMA table_info({table})")}:
+                    db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Новое соединение на каждую операцию: безопасно из разных потоков и процессов
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA busy_timeout=30000")
+        return db
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи — две аренды одной группы не гоняются
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    # ─────────────── задания ───────────────
+    def create(self, job_id: str, params: dict, groups: Iterable[tuple[int, str]], out_path: Path,
+               out_offset: int) -> Job:
+        # out_path — уже созданный выходной файл (его готовит вызывающий), out_offset — позиция
+        # в файле строк после заголовка
+        with self._tx() as db:
+            db.execute(
+                "INSERT INTO jobs (job_id, status, params, created_at, articles_csv, out_offset) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(params, ensure_ascii=False), _now(), str(out_path), out_offset),
+            )
+            db.executemany("INSERT INTO tasks (job_id, idx, block) VALUES (?, ?, ?)",
+                           ((job_id, i, block) for i, block in groups))
+            db.execute("UPDATE jobs SET groups_total = (SELECT COUNT(*) FROM tasks WHERE job_id = ?) WHERE job_id = ?",
+                       (job_id, job_id))
+            # пустой диапазон — делать нечего
+            db.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE job_id = ? AND groups_total = 0",
+                       (_now(), job_id))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        db = self._connect()
+        try:
+            row = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        return self._job(row) if row else None
+
+    def list(self) -> list[Job]:
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT * FROM jobs ORDER BY created_at DESC").fetchall()
+        finally:
+            db.close()
+        return [self._job(r) for r in rows]
+
+    def resume(self, job_id: str) -> None:
+        # Группы, исчерпавшие попытки или отменённые, снова в очередь
+        with self._tx() as db:
+            db.execute("UPDATE tasks SET status = 'pending', attempts = 0, error = NULL, retry_at = NULL "
+                       "WHERE job_id = ? AND status IN ('failed', 'cancelled')", (job_id,))
+            db.execute("UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL WHERE job_id = ?",
+                       (job_id,))
+
+    def cancel(self, job_id: str) -> bool:
+        # Незавершённые группы больше не выдаются; воркеры с группами в работе видят это
+        # через is_cancelled() и прерывают запросы. False — задание уже завершено
+        with self._tx() as db:
+            cur = db.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                             "WHERE job_id = ? AND status IN ('queued', 'running', 'failed')", (_now(), job_id))
+            if cur.rowcount == 1:
+                db.execute("UPDATE tasks SET status = 'cancelled', lease_until = NULL "
+                           "WHERE job_id = ? AND status IN ('pending', 'leased', 'failed')", (job_id,))
+        return cur.rowcount == 1
+
+    def is_cancelled(self, job_id: str) -> bool:
+        db = self._connect()
+        try:
+            row = db.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        return row is not None and row["status"] == "cancelled"
+
+    def counts(self) -> dict[str, int]:
+        # Число заданий по статусам
+        db = self._connect()
+        try:
+            return {r["status"]: r["n"] for r in db.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+        finally:
+            db.close()
+
+    def depth(self) -> int:
+        db = self._connect()
+        try:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')").fetchone()[0]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        fields = {k: row[k] for k in Job.model_fields if k != "params"}
+        fields["total_cost"] = round(fields["total_cost"], 4)
+        return Job(**fields, params=json.loads(row["params"]))
+
+    # ─────────────── группы (задачи воркеров) ───────────────
+    def lease(self, worker_id: str) -> Optional[dict]:
+        now = time.time()
+        with self._tx() as db:
+            # Берём задание с наименьшим числом групп в работе — задания разных пользователей идут параллельно
+            job = db.execute(
+                """
+                SELECT j.job_id FROM jobs j
+                WHERE j.status IN ('queued', 'running') AND EXISTS (
+                    SELECT 1 FROM tasks t WHERE t.job_id = j.job_id
+                      AND ((t.status = 'pending' AND COALESCE(t.retry_at, 0) <= ?)
+                           OR (t.status = 'leased' AND t.lease_until < ?)))
+                ORDER BY (SELECT COUNT(*) FROM tasks t WHERE t.job_id = j.job_id
+                            AND t.status = 'leased' AND t.lease_until >= ?), j.created_at
+                LIMIT 1
+                """, (now, now, now)).fetchone()
+            if job is None:
+                return None
+            task = db.execute(
+                """
+                SELECT idx, block, attempts FROM tasks
+                WHERE job_id = ? AND ((status = 'pending' AND COALESCE(retry_at, 0) <= ?)
+                                      OR (status = 'leased' AND lease_until < ?))
+                ORDER BY idx LIMIT 1
+                """, (job["job_id"], now, now)).fetchone()
+            db.execute("UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_until = ?, worker = ? "
+                       "WHERE job_id = ? AND idx = ?",
+                       (now + self.lease_seconds, worker_id, job["job_id"], task["idx"]))
+            db.execute("UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) "
+                       "WHERE job_id = ? AND status = 'queued'", (_now(), job["job_id"]))
+            row = db.execute("SELECT params, groups_total FROM jobs WHERE job_id = ?", (job["job_id"],)).fetchone()
+        return {
+            "job_id": job["job_id"], "idx": task["idx"], "block": task["block"],
+            "attempt": task["attempts"] + 1, "total": row["groups_total"], "params": json.loads(row["params"]),
+        }
+
+    def heartbeat(self, job_id: str, idx: int, worker_id: str) -> bool:
+        with self._tx() as db:
+            cur = db.execute("UPDATE tasks SET lease_until = ? WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'leased'",
+                             (time.time() + self.lease_seconds, job_id, idx, worker_id))
+        return cur.rowcount == 1
+
+    def complete(self, job_id: str, idx: int, worker_id: str, result: Optional[dict], cost: float) -> bool:
+        # result=None — группа без ключей (пропущена)
+        with self._tx() as db:
+            cur = db.execute(
+                "UPDATE tasks SET status = ?, result = ?, cost = ?, lease_until = NULL, error = NULL "
+                "WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'leased'",
+                ("done" if result is not None else "skipped",
+                 json.dumps(result, ensure_ascii=False) if result is not None else None, cost, job_id, idx, worker_id))
+            if cur.rowcount == 1:
+                db.execute("UPDATE jobs SET groups_done = groups_done + 1, total_cost = total_cost + ? WHERE job_id = ?",
+                           (cost, job_id))
+        return cur.rowcount == 1
+
+    def fail(self, job_id: str, idx: int, worker_id: str, error: str) -> bool:
+        # Возвращает True, если попытки исчерпаны и задание помечено как failed
+        with self._tx() as db:
+            row = db.execute("SELECT attempts FROM tasks WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'leased'",
+                             (job_id, idx, worker_id)).fetchone()
+            if row is None:
+                return False
+            final = row["attempts"] >= self.max_attempts
+            # следующая попытка — не раньше паузы: retry_backoff, 2×, 4×… плюс джиттер
+            delay = min(self.retry_backoff_max, self.retry_backoff * 2 ** (row["attempts"] - 1))
+            retry_at = time.time() + delay * random.uniform(1.0, 1.2)
+            db.execute("UPDATE tasks SET status = ?, lease_until = NULL, retry_at = ?, error = ? "
+                       "WHERE job_id = ? AND idx = ?",
+                       ("failed" if final else "pending", None if final else retry_at, error, job_id, idx))
+            if final:
+                db.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE job_id = ?",
+                           (f"группа {idx}: {error}", _now(), job_id))
+        return final
+
+    def stalled(self) -> list[str]:
+        # Задания в работе, где все группы готовы, но строки не дописаны или статус не обновлён:
+        # воркер, закончивший последнюю группу, упал до flush_ready. Их доводит любой свободный воркер
+        db = self._connect()
+        try:
+            rows = db.execute(
+                """
+                SELECT j.job_id FROM jobs j
+                WHERE j.status = 'running' AND NOT EXISTS (
+                    SELECT 1 FROM tasks t WHERE t.job_id = j.job_id AND t.status NOT IN ('done', 'skipped'))
+                """).fetchall()
+        finally:
+            db.close()
+        return [r["job_id"] for r in rows]
+
+    def flush_ready(self, job_id: str, write_rows) -> list[dict]:
+        """
+        Дописывает в выходной файл готовые группы, идущие подряд после уже записанных.
+        write_rows(groups, offset, final) -> новая позиция файла строк, где groups —
+        [(idx, строка или None для пропущенной группы)], final — это последние группы задания.
+        Файл пишется вне блокировки БД: короткая транзакция берёт право записи (flush_token),
+        вторая фиксирует rows_written/out_offset. Пока право у другого воркера, возвращает [] —
+        тот сам допишет и эти группы. write_rows сначала обрезает файл до offset — строки,
+        записанные до падения без коммита, не задваиваются.
+        """
+        written: list[dict] = []
+        while True:
+            claim = self._claim_flush(job_id)
+            if claim is None:
+                return written
+            token, offset, first, ready, final = claim
+            try:
+                new_offset = write_rows(ready, offset, final)
+            except BaseException:
+                self._release_flush(job_id, token)
+                raise
+            if not self._commit_flush(job_id, token, first, ready[-1][0], new_offset, final):
+                return written
+            written += [row for _, row in ready if row is not None]
+
+    def _claim_flush(self, job_id: str):
+        # (token, offset, rows_written, готовые группы, final) или None — писать нечего или пишет другой
+        now = time.time()
+        with self._tx() as db:
+            job = db.execute("SELECT rows_written, out_offset, groups_total, flush_until FROM jobs WHERE job_id = ?",
+                             (job_id,)).fetchone()
+            if job is None or (job["flush_until"] or 0) > now:
+                return None
+            # Завершение идемпотентно: его повторяет и stalled(), если воркер упал между complete и flush_ready
+            if job["rows_written"] == job["groups_total"]:
+                db.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE job_id = ? AND status = 'running'",
+                           (_now(), job_id))
+                return None
+            rows = db.execute("SELECT idx, status, result FROM tasks WHERE job_id = ? AND idx > ? ORDER BY idx",
+                              (job_id, job["rows_written"])).fetchall()
+            ready: list[tuple[int, Optional[dict]]] = []
+            last = job["rows_written"]
+            for r in rows:
+                if r["idx"] != last + 1 or r["status"] not in ("done", "skipped"):
+                    break
+                last = r["idx"]
+                ready.append((r["idx"], json.loads(r["result"]) if r["status"] == "done" else None))
+            if not ready:
+                return None
+            token = uuid.uuid4().hex
+            # право записи истекает, как аренда группы, — если воркер упал посреди записи
+            db.execute("UPDATE jobs SET flush_token = ?, flush_until = ? WHERE job_id = ?",
+                       (token, now + self.lease_seconds, job_id))
+        return token, job["out_offset"], job["rows_written"], ready, last == job["groups_total"]
+
+    def _commit_flush(self, job_id: str, token: str, first: int, last: int, new_offset: int, final: bool) -> bool:
+        with self._tx() as db:
+            cur = db.execute("UPDATE jobs SET rows_written = ?, out_offset = ?, flush_token = NULL, flush_until = NULL "
+                             "WHERE job_id = ? AND flush_token = ?", (last, new_offset, job_id, token))
+            if cur.rowcount == 0:
+                # право записи истекло и перешло к другому воркеру — он перепишет эти группы сам
+                return False
+            # тексты уже в файле — в БД их не держим
+            db.execute("UPDATE tasks SET result = NULL WHERE job_id = ? AND idx > ? AND idx <= ?",
+                       (job_id, first, last))
+            if final:
+                db.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE job_id = ? AND status = 'running'",
+                           (_now(), job_id))
+        return True
+
+    def _release_flush(self, job_id: str, token: str) -> None:
+        with self._tx() as db:
+            db.execute("UPDATE jobs SET flush_token = NULL, flush_until = NULL WHERE job_id = ? AND flush_token = ?",
+                       (job_id, token))
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+# ─────────────────────────────── ЖУРНАЛ ЗАДАНИЯ ───────────────────────────────
+# JSONL-файл: первая запись "start" (параметры запуска и смещение после заголовка CSV),
+# затем по записи "group" на каждую завершённую группу (с её стоимостью и смещением
+# конца строки в выходном файле), в конце — "done". Каждая запись сбрасывается на диск,
+# поэтому после падения журнал точно описывает, что уже лежит в выходном файле.
+
+class JobJournal:
+    def __init__(self, path: Path):
+        self.path = path
+        self._f = None
+        self._valid_size: Optional[int] = None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def read(self) -> tuple[Optional[dict], list[dict], Optional[dict]]:
+        start, groups, done = None, [], None
+        if not self.path.exists():
+            return start, groups, done
+        size = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # недописанная последняя строка после падения
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                size += len(line)
+                if rec.get("type") == "start":
+                    start = rec
+                elif rec.get("type") == "group":
+                    groups.append(rec)
+                elif rec.get("type") == "done":
+                    done = rec
+        self._valid_size = size
+        return start, groups, done
+
+    def truncate(self, keep) -> None:
+        # Оставить записи до первой, для которой keep(record) ложно: откат хвоста, записанного
+        # до падения без фиксации в очереди заданий
+        if not self.path.exists():
+            return
+        size = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                if not keep(rec):
+                    break
+                size += len(line)
+        os.truncate(self.path, size)
+        self._valid_size = size
+
+    def append(self, record: dict) -> None:
+        if self._f is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self._valid_size is not None and self.path.exists():
+                os.truncate(self.path, self._valid_size)
+            self._f = self.path.open("a", encoding="utf-8")
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
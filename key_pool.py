@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from rate_limit import RateLimiter
+
+# ─────────────────────────────── ПУЛ API-КЛЮЧЕЙ ───────────────────────────────
+# У каждого ключа свой аккаунт и свои лимиты, поэтому и свой RateLimiter (вёдра по заголовкам
+# anthropic-ratelimit-* ответов этого ключа). Запрос уходит через ключ с наибольшим свободным
+# остатком, который может принять его прямо сейчас; если таких нет — ждём ближайший.
+# 429 останавливает только свой ключ (до retry-after), остальные продолжают работать.
+# 401/403 (ключ отозван или заблокирован) — ключ выводится из ротации на revoked_cooldown
+# секунд; если выведены все ключи, запросы идут через них как есть, чтобы ошибка дошла до
+# вызывающего кода, а не зависала в ожидании.
+# Расход (USD, токены, запросы) считается по каждому ключу.
+
+class ApiKey:
+    def __init__(self, name: str, secret: str, limiter: RateLimiter):
+        self.name = name
+        self.secret = secret
+        self.limiter = limiter
+        self.disabled_until = 0.0
+        self.disabled_reason: Optional[str] = None
+        self.requests = 0
+        self.errors = 0
+        self.revoked = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost_usd = 0.0
+
+    @property
+    def headers(self) -> dict[str, str]:
+        # подменяет ключ клиента в отдельном запросе — один клиент и пул соединений на все ключи
+        return {"X-Api-Key": self.secret}
+
+    def stats(self, now: float) -> dict:
+        disabled = self.disabled_until > now
+        return {
+            "name": self.name,
+            "status": self.disabled_reason if disabled else "active",
+            "disabled_seconds": round(self.disabled_until - now, 1) if disabled else 0,
+            "requests": self.requests,
+            "errors": self.errors,
+            "revoked": self.revoked,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost_usd": round(self.cost_usd, 4),
+            **self.limiter.stats(),
+        }
+
+def mask_key(secret: str) -> str:
+    return f"…{secret[-4:]}" if len(secret) > 8 else "…"
+
+class KeyPool:
+    def __init__(self, keys: list[dict], rpm: Optional[int] = None, input_tpm: Optional[int] = None,
+                 output_tpm: Optional[int] = None, revoked_cooldown: float = 300.0, max_wait_step: float = 5.0):
+        # keys: [{"key": "...", "name": "...", "rpm": ..., "input_tpm": ..., "output_tpm": ...}];
+        # лимиты ключа по умолчанию — общие rpm/input_tpm/output_tpm
+        if not keys:
+            raise RuntimeError("Пул ключей пуст")
+        self.keys = [
+            ApiKey(k.get("name") or mask_key(k["key"]), k["key"],
+                   RateLimiter(k.get("rpm", rpm), k.get("input_tpm", input_tpm), k.get("output_tpm", output_tpm)))
+            for k in keys
+        ]
+        self.revoked_cooldown = revoked_cooldown
+        self.max_wait_step = max_wait_step
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _pick(self, input_tokens: int, output_tokens: int) -> tuple[Optional[ApiKey], float]:
+        with self._lock:
+            now = time.monotonic()
+            usable = [k for k in self.keys if k.disabled_until <= now]
+            if not usable:
+                usable = [min(self.keys, key=lambda k: k.disabled_until)]
+            # больше свободного остатка — раньше; при равенстве — реже использованный
+            usable.sort(key=lambda k: (-k.limiter.headroom(), k.requests))
+            wait = float("inf")
+            for k in usable:
+                w = k.limiter.try_acquire(input_tokens, output_tokens)
+                if w <= 0:
+                    k.requests += 1
+                    return k, 0.0
+                wait = min(wait, w)
+            return None, wait
+
+    async def acquire(self, input_tokens: int, output_tokens: int) -> ApiKey:
+        while True:
+            key, wait = self._pick(input_tokens, output_tokens)
+            if key is not None:
+                return key
+            wait = min(wait, self.max_wait_step)
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, input_tokens: int, output_tokens: int) -> ApiKey:
+        while True:
+            key, wait = self._pick(input_tokens, output_tokens)
+            if key is not None:
+                return key
+            wait = min(wait, self.max_wait_step)
+            self.throttled_seconds += wait
+            time.sleep(wait)
+
+    def pin(self) -> ApiKey:
+        # Ключ для операций, которые нельзя разнести по ключам (батч: создать, опросить и
+        # забрать результаты можно только тем же ключом) — самый свободный из активных
+        with self._lock:
+            now = time.monotonic()
+            usable = [k for k in self.keys if k.disabled_until <= now] or self.keys
+            key = max(usable, key=lambda k: k.limiter.headroom())
+            key.requests += 1
+            return key
+
+    def ready_in(self, input_tokens: int, output_tokens: int) -> float:
+        # Через сколько секунд какой-нибудь ключ примет запрос (0 — сейчас), без резерва;
+        # если выведены все ключи — до конца ближайшего вывода
+        with self._lock:
+            now = time.monotonic()
+            usable = [k for k in self.keys if k.disabled_until <= now]
+            if not usable:
+                return min(k.disabled_until for k in self.keys) - now
+            return min(k.limiter.wait_for(input_tokens, output_tokens) for k in usable)
+
+    def active(self) -> int:
+        now = time.monotonic()
+        return sum(1 for k in self.keys if k.disabled_until <= now)
+
+    def disable(self, key: ApiKey, reason: str) -> None:
+        with self._lock:
+            key.revoked += 1
+            key.disabled_reason = reason
+            key.disabled_until = time.monotonic() + self.revoked_cooldown
+
+    def record(self, key: ApiKey, input_tokens: int, output_tokens: int, cost_usd: float) -> None:
+        with self._lock:
+            key.input_tokens += input_tokens
+            key.output_tokens += output_tokens
+            key.cost_usd += cost_usd
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        keys = [k.stats(now) for k in self.keys]
+        return {
+            "keys_total": len(keys),
+            "keys_active": sum(1 for k in keys if k["status"] == "active"),
+            "throttled_seconds": round(self.throttled_seconds, 2),
+            "rate_limited": sum(k["rate_limited"] for k in keys),
+            "cost_usd": round(sum(k.cost_usd for k in self.keys), 4),
+            "keys": keys,
+        }
@@ -0,0 +1,369 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+import httpx
+import openai
+
+from response_cache import ResponseCache
+from rate_limit import retry_after_seconds
+from tracing import instant, span
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken токены (если API не вернул usage) оцениваем по длине текста
+    tiktoken = None
+
+# ─────────────────────────────── ПРОВАЙДЕРЫ LLM ───────────────────────────────
+# Один конвейер ТЗ → статья поверх нескольких API. Каждый вызов этапа («tz», «article»)
+# маршрутизатор отдаёт провайдеру по весам (LLM_PROVIDERS="anthropic:3,openai:1"; вес 0 —
+# только запасной). Ошибка ставит провайдера на паузу (cooldown):
+#   429        — до retry-after (у Anthropic паузу держит пул ключей, см. ready_in);
+#   401/403    — надолго (ключ отозван);
+#   5xx/529, 408/409, обрывы, таймауты — экспоненциально по числу ошибок подряд.
+# Прочие 4xx (неверный запрос) и ошибки кода не повторяются и паузу не ставят: у другого
+# провайдера и в следующей попытке будет то же, а пауза остановила бы все задания процесса.
+# Следующая попытка уходит доступному провайдеру — 529 от Anthropic не останавливает
+# задание, пока отвечает OpenAI. Если на паузе все — ждём ближайшего.
+# Состояние провайдеров (паузы, запросы, токены, стоимость) общее на процесс: его видят
+# все запуски, /providers/stats и /metrics.
+
+STAGES = ("tz", "article")
+PROVIDERS = ("anthropic", "openai")
+
+# OpenAI: модель по умолчанию и цены за 1M токенов (вход, вход из кэша, выход), USD
+OPENAI_MODEL = "gpt-4.1"
+OPENAI_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+# Стиль статьи по примерам из vector store (Responses API с file_search)
+FILE_SEARCH_INSTRUCTION = "Стиль, структура, лексика — как в примерах из vector store."
+
+def estimate_tokens(system_prompt: str, user_text: str) -> int:
+    # Грубая оценка входа для резерва в лимитере (кириллица — около 3 символов на токен)
+    return (len(system_prompt) + len(user_text)) // 3 + 1
+
+def count_tokens(text: str, model: str = OPENAI_MODEL) -> int:
+    if tiktoken is None:
+        return len(text) // 3 + 1
+    try:
+        encoder = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoder = tiktoken.get_encoding("cl100k_base")
+    return len(encoder.encode(text))
+
+def calculate_cost(tokens: int, input: bool = True, model: str = OPENAI_MODEL) -> float:
+    # Неизвестная модель — по ценам gpt-4.1
+    price_in, _, price_out = OPENAI_PRICES.get(model, OPENAI_PRICES[OPENAI_MODEL])
+    return tokens / 1_000_000 * (price_in if input else price_out)
+
+def openai_cost_usd(input_tokens: int, output_tokens: int, cached_tokens: int = 0,
+                    model: str = OPENAI_MODEL) -> float:
+    cached_price = OPENAI_PRICES.get(model, OPENAI_PRICES[OPENAI_MODEL])[1]
+    return (calculate_cost(input_tokens, True, model) + calculate_cost(output_tokens, False, model)
+            + cached_tokens / 1_000_000 * cached_price)
+
+def parse_provider_weights(spec: str) -> list[tuple[str, float]]:
+    # "anthropic:3, openai:1" → [("anthropic", 3.0), ("openai", 1.0)]; без веса — 1
+    weights: list[tuple[str, float]] = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition(":")
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in PROVIDERS:
+            raise ValueError(f"Неизвестный провайдер LLM: {name} (доступны: {', '.join(PROVIDERS)})")
+        try:
+            value = float(weight) if weight.strip() else 1.0
+        except ValueError:
+            raise ValueError(f"Вес провайдера {name} — не число: {weight}")
+        if value < 0:
+            raise ValueError(f"Вес провайдера {name} не может быть отрицательным")
+        if name not in (n for n, _ in weights):
+            weights.append((name, value))
+    if not weights:
+        raise ValueError("Не задан ни один провайдер LLM")
+    return weights
+
+class ProviderHealth:
+    def __init__(self, name: str):
+        self.name = name
+        self.cooldown_until = 0.0
+        self.cooldown_reason: Optional[str] = None
+        self.failures = 0        # ошибок подряд (сбрасывается успешным ответом)
+        self.requests = 0
+        self.errors = 0
+        self.spillover = 0       # вызовы, пришедшие сюда, пока другой провайдер был недоступен
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost_usd = 0.0
+        self._lock = threading.Lock()
+
+    def success(self, result: tuple[str, int, int, int, int], cost_usd: float) -> None:
+        with self._lock:
+            self.failures = 0
+            self.input_tokens += result[1] + result[3] + result[4]
+            self.output_tokens += result[2]
+            self.cost_usd += cost_usd
+
+    def rejected(self) -> None:
+        # Запрос отклонён не по вине провайдера (неверный запрос) — без паузы и серии ошибок
+        with self._lock:
+            self.errors += 1
+
+    def failure(self, reason: str, cooldown: float) -> None:
+        with self._lock:
+            self.errors += 1
+            self.failures += 1
+            if cooldown > 0:
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+                self.cooldown_reason = reason
+
+    def stats(self, now: float) -> dict:
+        cooling = self.cooldown_until > now
+        return {
+            "status": f"cooldown ({self.cooldown_reason})" if cooling else "active",
+            "cooldown_seconds": round(self.cooldown_until - now, 1) if cooling else 0,
+            "requests": self.requests,
+            "errors": self.errors,
+            "failures_in_row": self.failures,
+            "spillover": self.spillover,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost_usd": round(self.cost_usd, 4),
+        }
+
+_HEALTH: dict[str, ProviderHealth] = {}
+_HEALTH_LOCK = threading.Lock()
+
+def provider_health(name: str) -> ProviderHealth:
+    with _HEALTH_LOCK:
+        if name not in _HEALTH:
+            _HEALTH[name] = ProviderHealth(name)
+        return _HEALTH[name]
+
+def providers_stats() -> dict[str, dict]:
+    now = time.monotonic()
+    with _HEALTH_LOCK:
+        health = list(_HEALTH.values())
+    return {h.name: h.stats(now) for h in health}
+
+class Provider:
+    name = ""
+    # ошибки без кода HTTP, после которых стоит повторить запрос: обрывы связи и таймауты
+    transient_errors: tuple[type[BaseException], ...] = (httpx.TransportError, TimeoutError, ConnectionError)
+
+    def __init__(self, weight: float = 1.0, backoff_max: float = 30.0, auth_cooldown: float = 300.0,
+                 owns_client: bool = True):
+        # owns_client=False — клиент SDK общий (http_clients), его закрывает владелец, а не провайдер
+        self.weight = weight
+        self.owns_client = owns_client
+        self.client = None
+        self.backoff_max = backoff_max
+        self.auth_cooldown = auth_cooldown
+        self.health = provider_health(self.name)
+
+    def model_for(self, stage: str) -> str:
+        raise NotImplementedError
+
+    def cache_key(self, stage: str, system_prompt: str, user_text: str, max_tokens: int, temperature: float) -> str:
+        return ResponseCache.make_key(self.model_for(stage), system_prompt, user_text, max_tokens, temperature)
+
+    async def complete(self, stage: str, system_prompt: str, user_text: str, max_tokens: int,
+                       temperature: float, on_delta=None) -> tuple[str, int, int, int, int]:
+        # Одна попытка: (text, in, out, cache_write, cache_read); повторы — в ProviderRouter
+        raise NotImplementedError
+
+    def cost_usd(self, result: tuple[str, int, int, int, int], model: str) -> float:
+        raise NotImplementedError
+
+    def ready_in(self, input_tokens: int, output_tokens: int) -> float:
+        # Через сколько секунд провайдер примет запрос по своим лимитам (без паузы после ошибок)
+        return 0.0
+
+    def retryable(self, exc: Exception) -> bool:
+        # Сбой провайдера, а не запроса: 408/409/429, 401/403 (ключ), 5xx/529, обрывы и таймауты.
+        # Код < 400 — ошибка, пришедшая событием внутри успешного потока (overloaded посреди ответа)
+        status = getattr(exc, "status_code", None)
+        if isinstance(status, int):
+            return status < 400 or status >= 500 or status in (401, 403, 408, 409, 429)
+        return isinstance(exc, self.transient_errors)
+
+    def cooldown_for(self, exc: Exception) -> tuple[str, float]:
+        # (причина, пауза провайдера в секундах) после ошибки запроса
+        status = getattr(exc, "status_code", None)
+        reason = str(status) if status else type(exc).__name__
+        if status == 429:
+            response = getattr(exc, "response", None)
+            return reason, retry_after_seconds(response.headers if response is not None else None) or 1.0
+        if status in (401, 403):
+            return reason, self.auth_cooldown
+        # 5xx/529 и сетевые ошибки: 1, 2, 4… с, не больше backoff_max, плюс джиттер
+        return reason, min(self.backoff_max, 2.0 ** self.health.failures) + random.uniform(0, 1)
+
+    async def close(self) -> None:
+        if self.owns_client and self.client is not None:
+            await self.client.close()
+
+class OpenAIProvider(Provider):
+    name = "openai"
+    transient_errors = (*Provider.transient_errors, openai.APIConnectionError)
+
+    def __init__(self, client, weight: float = 1.0, model_tz: str = OPENAI_MODEL, model_article: str = OPENAI_MODEL,
+                 vector_store_id: Optional[str] = None, **kwargs):
+        # client — AsyncOpenAI с max_retries=0; vector_store_id — статьи через Responses API с file_search
+        super().__init__(weight, **kwargs)
+        self.client = client
+        self.models = {"tz": model_tz, "article": model_article}
+        self.vector_store_id = vector_store_id
+
+    def model_for(self, stage: str) -> str:
+        return self.models[stage]
+
+    def _file_search(self, stage: str) -> bool:
+        return stage == "article" and bool(self.vector_store_id)
+
+    def cache_key(self, stage: str, system_prompt: str, user_text: str, max_tokens: int, temperature: float) -> str:
+        if self._file_search(stage):
+            return ResponseCache.make_key(self.model_for(stage), f"{system_prompt} {FILE_SEARCH_INSTRUCTION}",
+                                          user_text, max_tokens, temperature, vector_store_id=self.vector_store_id)
+        return super().cache_key(stage, system_prompt, user_text, max_tokens, temperature)
+
+    async def complete(self, stage: str, system_prompt: str, user_text: str, max_tokens: int,
+                       temperature: float, on_delta=None) -> tuple[str, int, int, int, int]:
+        model = self.model_for(stage)
+        file_search = self._file_search(stage)
+        with span("openai_request", model=model, max_tokens=max_tokens, file_search=file_search) as sp:
+            if file_search:
+                response = await self.client.responses.create(
+                    model=model,
+                    input=user_text,
+                    instructions=f"{system_prompt} {FILE_SEARCH_INSTRUCTION}",
+                    tools=[{"type": "file_search", "vector_store_ids": [self.vector_store_id], "max_num_results": 10}],
+                    temperature=temperature,
+                    max_output_tokens=max_tokens,
+                )
+                text = (response.output_text or "").strip()
+                usage = response.usage
+                # usage учитывает и найденные file_search фрагменты
+                in_toks = usage.input_tokens if usage else count_tokens(system_prompt + user_text, model)
+                out_toks = usage.output_tokens if usage else count_tokens(text, model)
+                details = getattr(usage, "input_tokens_details", None)
+            else:
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_text}],
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                )
+                text = (response.choices[0].message.content or "").strip()
+                usage = response.usage
+                in_toks = usage.prompt_tokens if usage else count_tokens(system_prompt + user_text, model)
+                out_toks = usage.completion_tokens if usage else count_tokens(text, model)
+                details = getattr(usage, "prompt_tokens_details", None)
+            # закэшированный у OpenAI префикс промпта — дешевле, считаем его как чтение кэша
+            cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+            sp.set(in_tokens=in_toks, out_tokens=out_toks, cache_read=cached)
+        if on_delta:
+            # без потоковой выдачи: ответ приходит целиком
+            on_delta(None)
+            on_delta(text)
+        return text, in_toks - cached, out_toks, 0, cached
+
+    def cost_usd(self, result: tuple[str, int, int, int, int], model: str) -> float:
+        return openai_cost_usd(result[1], result[2], result[4], model=model)
+
+class ProviderRouter:
+    def __init__(self, providers: list[Provider], cache: ResponseCache, max_attempts: int = 6,
+                 spill_after: float = 2.0, on_retry: Optional[Callable[[Provider, str, int, float], None]] = None):
+        # spill_after — провайдер, который примет запрос позже, чем через столько секунд
+        # (пауза или лимиты), пропускается, пока есть доступный
+        if not providers:
+            raise ValueError("Не задан ни один провайдер LLM")
+        self.providers = providers
+        self.cache = cache
+        self.max_attempts = max(1, max_attempts)
+        self.spill_after = spill_after
+        self.on_retry = on_retry
+
+    def get(self, name: str) -> Optional[Provider]:
+        return next((p for p in self.providers if p.name == name), None)
+
+    @property
+    def names(self) -> list[str]:
+        return [p.name for p in self.providers]
+
+    def _choose(self, input_tokens: int, output_tokens: int) -> tuple[Provider, float]:
+        # (провайдер, сколько подождать перед запросом)
+        now = time.monotonic()
+        delays = {p.name: max(p.health.cooldown_until - now, p.ready_in(input_tokens, output_tokens), 0.0)
+                  for p in self.providers}
+        ready = [p for p in self.providers if delays[p.name] <= self.spill_after]
+        if not ready:
+            provider = min(self.providers, key=lambda p: delays[p.name])
+            return provider, delays[provider.name]
+        weighted = [p for p in ready if p.weight > 0] or ready
+        provider = random.choices(weighted, weights=[p.weight or 1.0 for p in weighted])[0]
+        if len(ready) < len(self.providers) and any(p.weight > 0 for p in self.providers if p not in ready):
+            provider.health.spillover += 1
+        return provider, 0.0
+
+    def _cached(self, stage: str, system_prompt: str, user_text: str, max_tokens: int,
+                temperature: float) -> Optional[tuple[Provider, str]]:
+        # Ответ любого провайдера из кэша — без запроса; сначала провайдеры с большим весом.
+        # В статистике кэша один поиск — одно попадание или промах, сколько бы ключей ни проверили
+        for p in sorted(self.providers, key=lambda p: -p.weight):
+            hit = self.cache.get(p.cache_key(stage, system_prompt, user_text, max_tokens, temperature), count=False)
+            if hit:
+                self.cache.record(True)
+                return p, hit["text"]
+        self.cache.record(False)
+        return None
+
+    async def complete(self, stage: str, system_prompt: str, user_text: str, max_tokens: int,
+                       temperature: float, use_cache: bool = True,
+                       on_delta=None) -> tuple[tuple[str, int, int, int, int], Provider]:
+        # on_delta(text) — потоковая выдача текста (None — начало новой попытки)
+        if use_cache and (hit := self._cached(stage, system_prompt, user_text, max_tokens, temperature)):
+            provider, text = hit
+            instant("response_cache_hit", provider=provider.name, model=provider.model_for(stage))
+            if on_delta:
+                on_delta(None)
+                on_delta(text)
+            return (text, 0, 0, 0, 0), provider
+
+        reserve_in = estimate_tokens(system_prompt, user_text)
+        for attempt in range(1, self.max_attempts + 1):
+            provider, wait = self._choose(reserve_in, max_tokens)
+            if wait > 0:
+                with span("provider_wait", provider=provider.name):
+                    await asyncio.sleep(wait)
+            provider.health.requests += 1
+            try:
+                result = await provider.complete(stage, system_prompt, user_text, max_tokens, temperature, on_delta)
+            except Exception as e:
+                if not provider.retryable(e):
+                    provider.health.rejected()
+                    raise
+                reason, cooldown = provider.cooldown_for(e)
+                provider.health.failure(reason, cooldown)
+                if self.on_retry:
+                    self.on_retry(provider, reason, attempt, cooldown)
+                if attempt >= self.max_attempts:
+                    raise
+                continue
+            provider.health.success(result, provider.cost_usd(result, provider.model_for(stage)))
+            if use_cache and result[0]:
+                self.cache.put(provider.cache_key(stage, system_prompt, user_text, max_tokens, temperature),
+                               {"text": result[0]})
+            return result, provider
+
+    async def close(self) -> None:
+        await asyncio.gather(*(p.close() for p in self.providers), return_exceptions=True)
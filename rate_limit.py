@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Mapping, Optional
+
+# ─────────────────────────────── ОГРАНИЧИТЕЛЬ ЗАПРОСОВ К API ───────────────────────────────
+# Три «ведра» на процесс: запросы, входные и выходные токены в минуту. Ведро пополняется
+# равномерно (limit/60 в секунду), а после каждого ответа уровень и лимит берутся из
+# заголовков anthropic-ratelimit-*-{limit,remaining,reset}, поэтому несколько процессов
+# с общим ключом подстраиваются под фактический остаток аккаунта.
+# Перед запросом резервируются оценка входных токенов и max_tokens выходных; после ответа
+# разница с фактическим расходом возвращается. 429 с retry-after останавливает все запросы
+# процесса до указанного момента.
+
+HEADER_PREFIX = "anthropic-ratelimit-"
+RESOURCES = {"requests": "requests", "input": "input-tokens", "output": "output-tokens"}
+
+class _Bucket:
+    def __init__(self, limit: Optional[float]):
+        self.limit = limit            # в минуту; None — лимит неизвестен, не ограничиваем
+        self.rate = limit / 60 if limit else 0.0
+        self.level = limit or 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.limit:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        if not self.limit:
+            return 0.0
+        amount = min(amount, self.limit)  # запрос больше лимита всё равно должен пройти
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+def _parse_reset(value: str) -> Optional[float]:
+    # RFC 3339 → секунды от текущего момента
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time()
+    except ValueError:
+        return None
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+class RateLimiter:
+    def __init__(self, rpm: Optional[int] = None, input_tpm: Optional[int] = None,
+                 output_tpm: Optional[int] = None, max_wait_step: float = 5.0):
+        self.buckets = {"requests": _Bucket(rpm), "input": _Bucket(input_tpm), "output": _Bucket(output_tpm)}
+        self.max_wait_step = max_wait_step
+        self.blocked_until = 0.0
+        self.throttled_seconds = 0.0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, amounts: dict[str, float], commit: bool = True) -> float:
+        # 0 — резерв сделан; иначе сколько подождать перед следующей попыткой.
+        # commit=False — только узнать ожидание, ничего не резервируя
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            for b in self.buckets.values():
+                b.refill(now)
+            wait = max(self.buckets[name].wait_for(amount) for name, amount in amounts.items())
+            if wait > 0 or not commit:
+                return wait
+            for name, amount in amounts.items():
+                self.buckets[name].level -= amount
+            return 0.0
+
+    def try_acquire(self, input_tokens: int, output_tokens: int) -> float:
+        # Резерв без ожидания: 0 — сделан, иначе через сколько секунд попробовать снова
+        return self._reserve({"requests": 1, "input": input_tokens, "output": output_tokens})
+
+    def wait_for(self, input_tokens: int, output_tokens: int) -> float:
+        # Через сколько секунд запрос пройдёт (0 — сейчас), без резерва
+        return self._reserve({"requests": 1, "input": input_tokens, "output": output_tokens}, commit=False)
+
+    def headroom(self) -> float:
+        # Доля свободного остатка в самом загруженном ведре (1.0 — лимиты неизвестны)
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return 0.0
+            for b in self.buckets.values():
+                b.refill(now)
+            return min((max(b.level, 0.0) / b.limit for b in self.buckets.values() if b.limit), default=1.0)
+
+    async def acquire(self, input_tokens: int, output_tokens: int) -> None:
+        amounts = {"requests": 1, "input": input_tokens, "output": output_tokens}
+        while (wait := self._reserve(amounts)) > 0:
+            wait = min(wait, self.max_wait_step)
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, input_tokens: int, output_tokens: int) -> None:
+        amounts = {"requests": 1, "input": input_tokens, "output": output_tokens}
+        while (wait := self._reserve(amounts)) > 0:
+            wait = min(wait, self.max_wait_step)
+            self.throttled_seconds += wait
+            time.sleep(wait)
+
+    def settle(self, reserved_input: int, reserved_output: int, used_input: int, used_output: int) -> None:
+        # Возвращаем в вёдра то, что зарезервировали сверх фактического расхода
+        with self._lock:
+            for name, reserved, used in (("input", reserved_input, used_input),
+                                         ("output", reserved_output, used_output)):
+                b = self.buckets[name]
+                if b.limit:
+                    b.level = min(b.limit, b.level + reserved - used)
+
+    def update(self, headers: Optional[Mapping[str, str]]) -> None:
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for name, key in RESOURCES.items():
+                try:
+                    limit = float(headers[f"{HEADER_PREFIX}{key}-limit"])
+                    remaining = float(headers[f"{HEADER_PREFIX}{key}-remaining"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                b = self.buckets[name]
+                b.refill(now)
+                b.limit = limit
+                b.level = min(b.level, remaining) if b.rate else remaining
+                # полное восстановление к моменту reset — пополнение не медленнее номинального
+                b.rate = limit / 60
+                reset_in = _parse_reset(headers.get(f"{HEADER_PREFIX}{key}-reset", ""))
+                if reset_in and reset_in > 0 and remaining < limit:
+                    b.rate = max(b.rate, (limit - remaining) / reset_in)
+
+    def penalize(self, retry_after: Optional[float]) -> None:
+        # 429: стоп всем запросам процесса до retry-after (без заголовка — хотя бы на секунду)
+        with self._lock:
+            self.rate_limited += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or 1.0))
+            for b in self.buckets.values():
+                if b.limit:
+                    b.level = min(b.level, 0.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            for b in self.buckets.values():
+                b.refill(now)
+            return {
+                **{f"{name}_limit": b.limit for name, b in self.buckets.items()},
+                **{f"{name}_available": round(b.level) if b.limit else None for name, b in self.buckets.items()},
+                "throttled_seconds": round(self.throttled_seconds, 2),
+                "rate_limited": self.rate_limited,
+            }
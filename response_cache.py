@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+# ─────────────────────────────── КЭШ ОТВЕТОВ LLM ───────────────────────────────
+# Ключ — sha256 от (модель, системный промпт, промпт пользователя, max_tokens, temperature).
+# Каждый ответ — отдельный JSON-файл; при превышении лимита удаляются самые давно
+# использованные (mtime обновляется при каждом попадании). Подсчёт размера и вытеснение —
+# в фоновом потоке: обход каталога не держит event loop, из которого вызывается put.
+# Кэш — только ускорение: ошибка записи не должна ронять группу, за ответ которой уже заплачено.
+
+log = logging.getLogger("uvicorn.error")
+
+class ResponseCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None
+        self._busy = False  # идёт подсчёт размера или вытеснение
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_text: str, max_tokens: int, temperature: float,
+                 **extra) -> str:
+        payload = json.dumps(
+            {"model": model, "system": system_prompt, "user": user_text,
+             "max_tokens": max_tokens, "temperature": temperature, **extra},
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str, count: bool = True) -> Optional[dict]:
+        # count=False — вызывающий проверяет несколько ключей и сам отметит итог через record()
+        p = self._path(key)
+        try:
+            with p.open(encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(p)  # LRU: отмечаем использование
+        except (OSError, ValueError):
+            value = None
+        if count:
+            self.record(value is not None)
+        return value
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: str, value: dict) -> None:
+        p = self._path(key)
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            # Уникальный временный файл: у процессов-воркеров после fork одинаковый id главного потока
+            fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=f".{key}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, p)
+            except BaseException:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        except OSError as e:
+            log.warning("Кэш ответов: не удалось сохранить ответ %s…: %s", key[:12], e)
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            # первый put процесса — подсчёт размера каталога, дальше — вытеснение сверх лимита
+            start = not self._busy and (self._size is None or self._size > self.max_bytes)
+            if start:
+                self._busy = True
+        if start:
+            threading.Thread(target=self._maintain, name="response-cache", daemon=True).start()
+
+    def _maintain(self) -> None:
+        try:
+            with self._lock:
+                scanned = self._size is not None
+            if not scanned:
+                size = self._scan_size()
+                with self._lock:
+                    self._size = size
+            with self._lock:
+                over = self._size > self.max_bytes
+            if over:
+                self._evict()
+        except Exception:
+            log.exception("Кэш ответов: ошибка обслуживания каталога")
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def _scan_size(self) -> int:
+        size = 0
+        for p in self.root.glob("*/*.json"):
+            try:
+                size += p.stat().st_size
+            except OSError:
+                pass
+        return size
+
+    def _evict(self) -> None:
+        # удаляем самые старые по mtime, пока не уложимся в 90% лимита (в фоновом потоке)
+        with self._lock:
+            size_before = self._size
+        entries = []
+        for p in self.root.glob("*/*.json"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, sz, p in entries:
+            if size <= target:
+                break
+            try:
+                p.unlink()
+                size -= sz
+            except OSError:
+                pass
+        with self._lock:
+            # записи, добавленные во время обхода, учитываем поверх
+            self._size = size + max(0, self._size - size_before)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size_bytes": self._size, "max_bytes": self.max_bytes}
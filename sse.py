@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+# ─────────────────────────────── SSE-БРОКЕР ───────────────────────────────
+# События запуска пишутся в кольцевой буфер потока задания (не больше max_events), у каждого
+# свой номер — поле id в SSE. Подписчиков может быть сколько угодно: каждый читает буфер со
+# своей позиции, поэтому генерация никогда не ждёт медленного клиента, а память не растёт.
+# Кто отстал дальше буфера, получает event: gap с числом пропущенных событий.
+# Переподключение с Last-Event-ID досылает всё, что ещё в буфере; закрытый поток хранится
+# retain_seconds, чтобы можно было дочитать результат после обрыва.
+# Пока событий нет, подписчику раз в heartbeat секунд уходит комментарий ": ping" —
+# прокси не закрывают «молчащее» соединение.
+
+def format_event(data: str, event: Optional[str] = None, event_id: Optional[int] = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    # многострочные данные — несколько полей data (клиент склеит их через \n)
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+class EventStream:
+    def __init__(self, job_id: str, max_events: int):
+        self.job_id = job_id
+        self.events: deque[tuple[int, Optional[str], str]] = deque(maxlen=max_events)  # (id, event, data)
+        self.last_id = 0
+        self.closed_at: Optional[float] = None
+        self.subscribers = 0
+        self._lock = threading.Lock()
+        self._changed = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+
+    def publish(self, data: str, event: Optional[str] = None) -> int:
+        # Можно звать и из потоков (asyncio.to_thread): подписчиков будим через event loop
+        with self._lock:
+            if self.closed_at is not None:
+                return self.last_id
+            self.last_id += 1
+            self.events.append((self.last_id, event, data))
+            changed, self._changed = self._changed, asyncio.Event()
+        self._wake(changed)
+        return self.last_id
+
+    def close(self) -> None:
+        with self._lock:
+            if self.closed_at is not None:
+                return
+            self.closed_at = time.monotonic()
+            changed, self._changed = self._changed, asyncio.Event()
+        self._wake(changed)
+
+    def _wake(self, changed: asyncio.Event) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            changed.set()
+        else:
+            self._loop.call_soon_threadsafe(changed.set)
+
+    def _since(self, cursor: int) -> tuple[list, int, bool, asyncio.Event]:
+        # События после cursor, сколько вытеснено из буфера, закрыт ли поток, чего ждать дальше
+        with self._lock:
+            first = self.events[0][0] if self.events else self.last_id + 1
+            events = [e for e in self.events if e[0] > cursor]
+            return events, max(0, first - cursor - 1), self.closed_at is not None, self._changed
+
+    async def subscribe(self, last_event_id: int = 0, heartbeat: float = 15.0,
+                        retry_ms: int = 3000) -> AsyncIterator[str]:
+        cursor = last_event_id
+        self.subscribers += 1
+        try:
+            yield f"retry: {retry_ms}\n\n"
+            while True:
+                events, missed, closed, changed = self._since(cursor)
+                if missed:
+                    yield format_event(json.dumps({"missed": missed}), "gap")
+                for event_id, event, data in events:
+                    yield format_event(data, event, event_id)
+                    cursor = event_id
+                if closed:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            self.subscribers -= 1
+
+class SSEBroker:
+    def __init__(self, max_events: int = 10000, retain_seconds: float = 600.0):
+        self.max_events = max_events
+        self.retain_seconds = retain_seconds
+        self.streams: dict[str, EventStream] = {}
+
+    def open(self, job_id: str) -> EventStream:
+        self._cleanup()
+        stream = EventStream(job_id, self.max_events)
+        self.streams[job_id] = stream
+        return stream
+
+    def get(self, job_id: str) -> Optional[EventStream]:
+        self._cleanup()
+        return self.streams.get(job_id)
+
+    def _cleanup(self) -> None:
+        now = time.monotonic()
+        for job_id, stream in list(self.streams.items()):
+            if stream.closed_at is not None and now - stream.closed_at > self.retain_seconds:
+                del self.streams[job_id]
+
+    def subscribers(self) -> int:
+        return sum(s.subscribers for s in self.streams.values())
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+# ─────────────────────────────── ТРАССИРОВКА ЗАДАНИЙ ───────────────────────────────
+# Спаны пишутся в формате Chrome trace (события "X": ts/dur в микросекундах), открываются
+# в chrome://tracing или https://ui.perfetto.dev. Трасса задания и «дорожка» (tid = номер
+# группы) передаются через contextvars, поэтому параллельные группы и задания не путаются.
+# Без активной трассы span() возвращает общий пустой объект — накладные расходы только на
+# чтение contextvar.
+# События копятся в памяти и дописываются одной записью в JOBS_DIR/<job_id>/trace.jsonl,
+# так что возобновления и разные процессы-воркеры дополняют одну трассу.
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_lane: ContextVar[int] = ContextVar("trace_lane", default=0)
+
+# Момент времени для ts: стенные часы в начале + монотонный счётчик
+_WALL0 = time.time()
+_PERF0 = time.perf_counter()
+
+def _now_us() -> float:
+    return (_WALL0 + (time.perf_counter() - _PERF0)) * 1_000_000
+
+class Trace:
+    def __init__(self, job_id: str, path: Path):
+        self.job_id = job_id
+        self.path = path
+        self.pid = os.getpid()
+        self.events: list[dict] = []
+        self.token = None
+        self._lock = threading.Lock()
+
+    def add(self, event: dict) -> None:
+        with self._lock:
+            self.events.append(event)
+
+    def flush(self) -> None:
+        with self._lock:
+            events, self.events = self.events, []
+        if not events:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events).encode("utf-8")
+        # один write с O_APPEND — строки разных процессов не перемешиваются
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "tid", "start")
+
+    def __init__(self, trace: Trace, name: str, args: dict):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.tid = _lane.get()
+
+    def set(self, **args) -> None:
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = _now_us()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add({"name": self.name, "ph": "X", "ts": round(self.start, 1), "dur": round(end - self.start, 1),
+                        "pid": self.trace.pid, "tid": self.tid, "args": self.args})
+        return False
+
+    # можно ставить в один async with со слотами/семафорами
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **args) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP = _NoopSpan()
+
+def span(name: str, **args):
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, args)
+
+def instant(name: str, **args) -> None:
+    trace = _trace.get()
+    if trace is not None:
+        trace.add({"name": name, "ph": "i", "s": "t", "ts": round(_now_us(), 1),
+                   "pid": trace.pid, "tid": _lane.get(), "args": args})
+
+def start_trace(job_id: str, path: Path) -> Trace:
+    trace = Trace(job_id, path)
+    trace.token = _trace.set(trace)
+    return trace
+
+def stop_trace(trace: Trace) -> None:
+    # Дописать события на диск и вернуть контекст к состоянию до start_trace
+    try:
+        trace.flush()
+    finally:
+        _trace.reset(trace.token)
+
+def set_lane(tid: int, name: str = "") -> None:
+    # Вызывать внутри задачи группы: у каждой asyncio-задачи своя копия контекста
+    _lane.set(tid)
+    trace = _trace.get()
+    if trace is not None and name:
+        trace.add({"name": "thread_name", "ph": "M", "pid": trace.pid, "tid": tid, "args": {"name": name}})
+
+def load_chrome_trace(path: Path) -> dict:
+    events = []
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue  # недописанная строка после падения
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from app import WORKER_CONCURRENCY, _enable_timestamps_in_uvicorn_logs, run_queue_worker
+
+# Отдельный процесс-воркер очереди заданий (BASE_DIR/queue.db).
+# Запускается рядом с API:  python worker.py --processes 4 --concurrency 4
+
+
+def parse_cli_params():
+    parser = argparse.ArgumentParser(description="Воркер очереди генерации статей.")
+    parser.add_argument(
+        "-p", "--processes",
+        type=int,
+        default=int(os.getenv("WORKER_PROCESSES", "1")),
+        help="Сколько процессов-воркеров запустить (по умолчанию WORKER_PROCESSES или 1).",
+    )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=WORKER_CONCURRENCY,
+        help=f"Сколько групп одновременно в одном процессе. По умолчанию: {WORKER_CONCURRENCY}.",
+    )
+    return parser.parse_args()
+
+
+def run_process(n: int, concurrency: int):
+    _enable_timestamps_in_uvicorn_logs()
+    logging.getLogger("uvicorn.error").setLevel(logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    async def main():
+        # SIGTERM/SIGINT: слоты доделывают текущие группы и выходят;
+        # незавершённые аренды истекут и группы заберут другие воркеры
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await run_queue_worker(f"{socket.gethostname()}-{os.getpid()}-w{n}", concurrency, stop)
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    args = parse_cli_params()
+    if args.processes <= 1:
+        run_process(0, args.concurrency)
+    else:
+        procs = [multiprocessing.Process(target=run_process, args=(n, args.concurrency))
+                 for n in range(args.processes)]
+        for p in procs:
+            p.start()
+        # docker stop шлёт SIGTERM только главному процессу — передаём его воркерам
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: [p.terminate() for p in procs])
+        for p in procs:
+            p.join()
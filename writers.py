@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet — необязательная зависимость
+    pa = pq = None
+
+# ─────────────────────────────── ВЫХОДНЫЕ ФАЙЛЫ ЗАДАНИЯ ───────────────────────────────
+# Строки (title, slug, tz, html) пишутся по одной на группу и сразу сбрасываются на диск.
+# Позиция (offset) — размер файла строк после последней полной строки: её хранит журнал,
+# по ней возобновление обрезает недописанный хвост, а GET /jobs/{job_id}/rows читает готовые
+# строки, пока задание ещё идёт.
+#   csv     — articles.csv (как раньше);
+#   jsonl   — articles.jsonl, строка JSON на группу;
+#   parquet — articles.parquet группами строк (row group). Файл читаем только после
+#             закрытия, поэтому строки параллельно пишутся в articles.jsonl: по нему идут
+#             журнал, /rows и возобновление (Parquet пересобирается из него).
+
+FIELDS = ("title", "slug", "tz", "html")
+OUTPUT_FORMATS = ("csv", "jsonl", "parquet")
+MEDIA_TYPES = {".csv": "text/csv", ".jsonl": "application/x-ndjson", ".parquet": "application/vnd.apache.parquet"}
+
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP_SIZE", "64"))
+
+class CsvRowWriter:
+    format = "csv"
+    suffix = ".csv"
+
+    def __init__(self, path: Path):
+        self.path = path          # итоговый файл (его отдают на скачивание)
+        self.rows_path = path     # файл, к которому относятся offset
+        self._f = None
+
+    def open(self, offset: Optional[int] = None) -> int:
+        # offset=None — новый файл; иначе продолжение после offset (хвост обрезается)
+        if offset is None:
+            self._f = self.rows_path.open("w", newline="", encoding="utf-8")
+            self._start()
+        else:
+            os.truncate(self.rows_path, offset)
+            self._f = self.rows_path.open("a", newline="", encoding="utf-8")
+        return self._sync()
+
+    def _start(self) -> None:
+        csv.DictWriter(self._f, fieldnames=FIELDS).writeheader()
+
+    def _encode(self, row: dict) -> str:
+        buf = io.StringIO()
+        csv.DictWriter(buf, fieldnames=FIELDS).writerow({k: row[k] for k in FIELDS})
+        return buf.getvalue()
+
+    def _sync(self) -> int:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        return self._f.tell()
+
+    def write(self, row: dict) -> int:
+        self._f.write(self._encode(row))
+        return self._sync()
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    @staticmethod
+    def parse(text: str) -> list[dict]:
+        return list(csv.DictReader(io.StringIO(text, newline=""), fieldnames=FIELDS))
+
+class JsonlRowWriter(CsvRowWriter):
+    format = "jsonl"
+    suffix = ".jsonl"
+
+    def _start(self) -> None:
+        pass
+
+    def _encode(self, row: dict) -> str:
+        return json.dumps({k: row[k] for k in FIELDS}, ensure_ascii=False) + "\n"
+
+    @staticmethod
+    def parse(text: str) -> list[dict]:
+        return [json.loads(line) for line in text.splitlines() if line]
+
+class ParquetRowWriter(JsonlRowWriter):
+    format = "parquet"
+    suffix = ".parquet"
+
+    def __init__(self, path: Path, row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        if pq is None:
+            raise RuntimeError("Для вывода в Parquet нужен pyarrow: pip install pyarrow")
+        super().__init__(path)
+        self.rows_path = path.with_suffix(".jsonl")
+        self.row_group_size = max(1, row_group_size)
+        self._schema = pa.schema([(k, pa.string()) for k in FIELDS])
+        self._pq = None
+        self._buffer: list[dict] = []
+
+    def open(self, offset: Optional[int] = None) -> int:
+        position = super().open(offset)
+        self._pq = pq.ParquetWriter(self.path, self._schema, compression="zstd")
+        if offset is not None:
+            # Parquet без футера после падения не прочитать — пересобираем из готовых строк
+            with self.rows_path.open(encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._buffer.append(json.loads(line))
+                        if len(self._buffer) >= self.row_group_size:
+                            self._flush_group()
+        return position
+
+    def write(self, row: dict) -> int:
+        position = super().write(row)
+        self._buffer.append({k: row[k] for k in FIELDS})
+        if len(self._buffer) >= self.row_group_size:
+            self._flush_group()
+        return position
+
+    def _flush_group(self) -> None:
+        if self._buffer:
+            self._pq.write_table(pa.Table.from_pylist(self._buffer, schema=self._schema))
+            self._buffer = []
+
+    def close(self) -> None:
+        if self._pq is not None:
+            self._flush_group()
+            self._pq.close()
+            self._pq = None
+        super().close()
+
+WRITERS = {w.format: w for w in (CsvRowWriter, JsonlRowWriter, ParquetRowWriter)}
+
+def make_writer(output_format: str, directory: Path, name: str = "articles"):
+    if output_format not in WRITERS:
+        raise ValueError(f"Неизвестный формат вывода: {output_format} (доступны: {', '.join(OUTPUT_FORMATS)})")
+    cls = WRITERS[output_format]
+    return cls(directory / f"{name}{cls.suffix}")
+
+def read_rows(output_format: str, rows_path: Path, start: int, end: int) -> list[dict]:
+    # Строки из участка [start, end) файла строк — границы берутся из журнала
+    with rows_path.open("rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    return WRITERS[output_format].parse(text)